@@ -51,8 +51,8 @@ metadatas = [
     {"source": "website", "topic": "University"},
 ]
 
-# compute embeddings (list of np arrays)
-vectors = embed_texts(docs)
+# compute embeddings (float32 matrix, one unit-length row per doc)
+vectors = embed_texts(docs, normalize=True)
 
 print("##########Step3 loading and embedding the documents✅#############")
 
@@ -120,7 +120,7 @@ print("##########Step6 update the collection✅#############")
 print("\nSemantic Search")
 query = "Suggest to me university specializations to apply for"
 print(f"Query: {query}")
-q_vec = embed_texts([query])[0]  # single embedding vector
+q_vec = embed_texts([query], normalize=True)[0]  # single embedding vector (normalized like the docs)
 
 results = my_db_collection.query(
     #query_texts=[query],
@@ -1,24 +1,95 @@
-from sentence_transformers import SentenceTransformer
-#SentenceTransformer: This is the main class from the sentence-transformers library, 
-# which provides easy-to-use models for converting text into dense vector embeddings 
-# (numerical representations that capture semantic meaning).
 import numpy as np
+from embedding_cache import get_cached_embeddings, make_embedding_key, put_cached_embeddings
+from embedding_backend import EMBEDDING_BACKEND, load_sentence_transformer
+#the backend (torch, onnx or onnx-int8) is chosen with EMBEDDING_BACKEND, see embedding_backend.py
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+# Pin a Hugging Face revision (commit hash) so cached vectors always match the model
+MODEL_REVISION = None
 
 _model = None
+_model_key = None
 
-def get_embedder(model_name="all-MiniLM-L6-v2"):
+def get_embedder(model_name=MODEL_NAME, revision=MODEL_REVISION, backend=EMBEDDING_BACKEND):
     #all-MiniLM-L6-v2 is a model that creates 384-dimensional embeddings.
-    global _model
+    global _model, _model_key
     if _model is None:
-        _model = SentenceTransformer(model_name)
+        _model = load_sentence_transformer(model_name, revision, backend)
+        # part of the embedding cache key
+        _model_key = (model_name, revision, backend)
     return _model
 
-def embed_texts(texts):
+def l2_normalize_rows(embeddings, block_rows=4096):
+    """L2-normalize the rows of a float32 matrix in place, block by block (so memmaps are not loaded at once)."""
+    for start in range(0, len(embeddings), block_rows):
+        block = embeddings[start:start + block_rows]
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        # zero vectors stay zero
+        np.divide(block, norms, out=block, where=norms > 0)
+    return embeddings
+
+def create_embedding_memmap(path, num_texts, dim=None):
+    """
+    Create a float32 .npy file on disk of shape (num_texts, dim), to pass as
+    out= to embed_texts when the vectors do not fit in memory.
+    Open it again later with np.load(path, mmap_mode="r").
+    """
+    if dim is None:
+        dim = get_embedder().get_sentence_embedding_dimension()
+    return np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(num_texts, dim))
+
+def _output_buffer(out, num_texts, dim):
+    # the matrix embed_texts writes into: a new one, or the caller's buffer / memmap
+    if out is None:
+        return np.empty((num_texts, dim), dtype=np.float32)
+    if out.shape != (num_texts, dim) or out.dtype != np.float32 or not out.flags.c_contiguous:
+        raise ValueError(
+            f"out must be a C-contiguous float32 array of shape {(num_texts, dim)}, "
+            f"got {out.dtype} array of shape {out.shape}"
+        )
+    return out
+
+def embed_texts(texts, use_cache=True, normalize=False, out=None):
     #texts is a list of string(s)
-    """Return list of vectors (numpy arrays) for a list of texts."""
+    """
+    Return a C-contiguous float32 matrix with one vector (row) per text.
+    With normalize, every vector is L2-normalized (unit length).
+    The vectors are written straight into out when given: a C-contiguous
+    float32 array or memmap of shape (len(texts), dim), see create_embedding_memmap.
+    """
     model = get_embedder()
-    embeddings = model.encode(texts, convert_to_numpy=True, show_progress_bar=False)
-    # ensure float32 for chroma
-    return [vec.astype(np.float32) for vec in embeddings]
+    embeddings = _output_buffer(out, len(texts), model.get_sentence_embedding_dimension())
+
+    # only texts that are not in the embedding cache yet are encoded
+    missing = list(range(len(texts)))
+    if use_cache and texts:
+        keys = [make_embedding_key(text, *_model_key) for text in texts]
+        cached = get_cached_embeddings(keys)
+        missing = []
+        first_index = {}
+        for i, key in enumerate(keys):
+            if key in cached:
+                embeddings[i] = cached[key]
+            elif key not in first_index:
+                # encode every distinct text only once
+                first_index[key] = i
+                missing.append(i)
+
+    if missing:
+        rows = np.asarray(missing)
+        embeddings[rows] = model.encode([texts[i] for i in missing], convert_to_numpy=True, show_progress_bar=False)
+        if use_cache:
+            # the cache keeps the vectors as the model returns them (before normalize)
+            put_cached_embeddings([keys[i] for i in missing], embeddings[rows])
+            # texts that appeared more than once in this call
+            for i, key in enumerate(keys):
+                if key in first_index and first_index[key] != i:
+                    embeddings[i] = embeddings[first_index[key]]
+
+    if normalize:
+        l2_normalize_rows(embeddings)
+
+    # already float32 for chroma, rows are views into one matrix (no copies)
+    return embeddings
 #Why float32? This is specifically for Chroma DB (a vector database), which requires float32 format for optimal storage and similarity search performance
-#Returns: A list of NumPy arrays, where each array is a 384-dimensional vector for the corresponding input text
\ No newline at end of file
+#Returns: A (len(texts), 384) float32 NumPy matrix, where row i is the vector for texts[i]
@@ -0,0 +1,25 @@
+import sys
+from rag_step_1_loading import iter_documents_from_folder
+from rag_step_2_chunking import chunk_documents
+from rag_step_3_embeddings import embed_texts, get_embedder, get_max_chunk_tokens
+from rag_vector_compression import recall_at_k_report
+
+# (dim, dtype, method) settings compared with the uncompressed float32 vectors
+SETTINGS = [
+    (None, "float16", "pca"),
+    (256, "float32", "pca"),
+    (128, "float32", "pca"),
+    (128, "float16", "pca"),
+    (64, "float16", "pca"),
+    (128, "float32", "truncate")
+]
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "./sample_docs"
+    chunks = chunk_documents(iter_documents_from_folder(folder),
+                             chunk_size=get_max_chunk_tokens(),
+                             overlap=32,
+                             tokenizer=get_embedder().tokenizer)
+    # Same vectors as rag_step_by_step stores (mostly read from the embedding cache)
+    embeddings = embed_texts([chunk["text"] for chunk in chunks], normalize=True)
+    recall_at_k_report(embeddings, SETTINGS, k=10)
@@ -0,0 +1,67 @@
+import numpy as np
+from rag_numpy_store import NumpyCollection
+
+# Sources searched by the chunk search after routing (None = flat search over all chunks)
+DEFAULT_TOP_DOCUMENTS = 5
+
+_document_collections = {}
+
+def get_document_collection(collection, persist_directory="./document_index"):
+    """
+    Return the document-level index of a chunk collection: one vector per source
+    (the normalized mean of its chunk vectors), in a NumpyCollection with id = source.
+    """
+    if collection.name not in _document_collections:
+        _document_collections[collection.name] = NumpyCollection(f"{collection.name}_documents",
+                                                                 persist_directory=persist_directory,
+                                                                 space="cosine")
+    return _document_collections[collection.name]
+
+def update_document_index(collection, sources):
+    """
+    Recompute the document vectors of the given sources from their stored chunks
+    (call after chunks of those sources were added or deleted). Returns the number of documents updated.
+    """
+    document_collection = get_document_collection(collection)
+    updated = 0
+    for source in sources:
+        chunks = collection.get(where={"source": source}, include=["embeddings"])
+        if not chunks["ids"]:
+            document_collection.delete(ids=[source])
+            continue
+
+        # The stored vectors are already compressed, so queries compressed the same way compare to the centroid
+        centroid = np.asarray(chunks["embeddings"], dtype=np.float32).mean(axis=0)
+        centroid /= max(float(np.linalg.norm(centroid)), 1e-12)
+        document_collection.upsert(ids=[source],
+                                   embeddings=centroid.reshape(1, -1),
+                                   metadatas=[{"source": source, "chunk_count": len(chunks["ids"])}])
+        updated += 1
+    return updated
+
+def remove_from_document_index(collection, sources):
+    if sources:
+        get_document_collection(collection).delete(ids=list(sources))
+
+def rebuild_document_index(collection):
+    """Build the document index from all chunks of the collection (e.g. for a collection stored before it existed)."""
+    sources = {metadata["source"] for metadata in collection.get(include=["metadatas"])["metadatas"]}
+    document_collection = get_document_collection(collection)
+    stale_sources = set(document_collection.get(include=[])["ids"]) - sources
+    remove_from_document_index(collection, stale_sources)
+    print(f"Building the document index of {len(sources)} sources...")
+    return update_document_index(collection, sorted(sources))
+
+def route_query(query_embedding, collection, top_documents=DEFAULT_TOP_DOCUMENTS):
+    """
+    Return the sources whose document vector is closest to the query, best first.
+    Returns None when routing would not narrow the search (fewer documents than top_documents).
+    """
+    document_collection = get_document_collection(collection)
+    if document_collection.count() == 0 and collection.count() > 0:
+        rebuild_document_index(collection)
+    if top_documents is None or document_collection.count() <= top_documents:
+        return None
+
+    results = document_collection.query(query_embeddings=query_embedding, n_results=top_documents, include=[])
+    return results["ids"][0]
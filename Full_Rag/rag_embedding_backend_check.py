@@ -0,0 +1,71 @@
+import sys
+import time
+import numpy as np
+from rag_embedding_backend import BACKENDS, load_sentence_transformer
+from rag_step_3_embeddings import MODEL_NAME, MODEL_REVISION
+
+# Minimum cosine similarity between a backend and PyTorch for every text
+PARITY_THRESHOLD = 0.99
+
+def _encode_timed(model, texts, batch_size):
+    # Warm up first, so model loading / graph optimisation is not measured
+    model.encode(texts[:batch_size], batch_size=batch_size)
+    start = time.perf_counter()
+    embeddings = model.encode(texts, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+    return embeddings.astype(np.float32, copy=False), time.perf_counter() - start
+
+def compare_backends(texts, backends=BACKENDS, model_name=MODEL_NAME, revision=MODEL_REVISION,
+                     threshold=PARITY_THRESHOLD, batch_size=32):
+    """
+    Check that every backend gives (almost) the same vectors as PyTorch, and compare their speed.
+    Args:
+        texts: Texts to embed (e.g. real chunks)
+        backends: Backends to compare with "torch"
+        threshold: Minimum cosine similarity with the PyTorch vector, per text
+    Returns: {backend: {"texts_per_sec", "min_cosine", "mean_cosine", "passed"}}
+    """
+    reference, reference_time = _encode_timed(
+        load_sentence_transformer(model_name, revision, "torch"), texts, batch_size
+    )
+    results = {"torch": {
+        "texts_per_sec": len(texts) / reference_time,
+        "min_cosine": 1.0,
+        "mean_cosine": 1.0,
+        "passed": True
+    }}
+
+    for backend in backends:
+        if backend == "torch":
+            continue
+        embeddings, elapsed = _encode_timed(
+            load_sentence_transformer(model_name, revision, backend), texts, batch_size
+        )
+        # Both are normalized, so the row-wise dot product is the cosine similarity
+        cosines = np.einsum("ij,ij->i", reference, embeddings)
+        results[backend] = {
+            "texts_per_sec": len(texts) / elapsed,
+            "min_cosine": float(cosines.min()),
+            "mean_cosine": float(cosines.mean()),
+            "passed": bool(cosines.min() >= threshold)
+        }
+
+    print(f"\nBackend comparison on {len(texts)} texts (parity threshold {threshold}):")
+    torch_speed = results["torch"]["texts_per_sec"]
+    for backend, result in results.items():
+        print(
+            f"  {backend:10s} {result['texts_per_sec']:8.1f} texts/s "
+            f"({result['texts_per_sec'] / torch_speed:.2f}x), "
+            f"cosine min {result['min_cosine']:.4f} mean {result['mean_cosine']:.4f} "
+            f"{'OK' if result['passed'] else 'FAILED'}"
+        )
+    return results
+
+if __name__ == "__main__":
+    from rag_step_1_loading import iter_documents_from_folder
+    from rag_step_2_chunking import chunk_documents
+
+    folder = sys.argv[1] if len(sys.argv) > 1 else "./sample_docs"
+    chunks = chunk_documents(iter_documents_from_folder(folder), chunk_size=500, overlap=50)
+    results = compare_backends([chunk["text"] for chunk in chunks])
+    # Fail (e.g. in CI) when a backend drifts from PyTorch
+    sys.exit(0 if all(result["passed"] for result in results.values()) else 1)
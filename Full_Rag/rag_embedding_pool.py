@@ -0,0 +1,113 @@
+import os
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+_pool = None
+_pool_settings = None
+
+# Model of the worker process (each worker loads its own copy)
+_worker_model = None
+
+def _init_worker(model_name, revision, backend, threads_per_worker):
+    global _worker_model
+
+    # Limit the threads so the workers do not fight for the cores. With "spawn" the main
+    # module is imported again before this runs, so torch (and its thread pool) may already
+    # be loaded: the env vars only reach libraries loaded later, torch is limited directly.
+    # ONNX Runtime ignores OMP_NUM_THREADS, its session gets the thread count explicitly
+    os.environ["OMP_NUM_THREADS"] = str(threads_per_worker)
+    os.environ["MKL_NUM_THREADS"] = str(threads_per_worker)
+    import torch
+    from rag_embedding_backend import load_sentence_transformer
+
+    torch.set_num_threads(threads_per_worker)
+    _worker_model = load_sentence_transformer(
+        model_name, revision, backend, num_threads=threads_per_worker, device="cpu"
+    )
+
+def _encode_shard(texts, batch_size):
+    embeddings = _worker_model.encode(
+        texts,
+        batch_size=batch_size,
+        show_progress_bar=False,
+        convert_to_numpy=True
+    )
+    return embeddings.astype(np.float32, copy=False)
+
+def get_embedding_pool(model_name, revision=None, backend="torch", num_workers=None, threads_per_worker=None):
+    """
+    Return the process pool used by encode_multi_process.
+    The pool is created once and reused; it is only recreated when the settings change.
+    Args:
+        model_name: Sentence-transformers model loaded by every worker
+        revision: Model revision
+        backend: Embedding backend (see rag_embedding_backend)
+        num_workers: Number of worker processes (default: one per 4 CPU cores)
+        threads_per_worker: Torch / ONNX Runtime threads per worker (default: cores / workers)
+    """
+    global _pool, _pool_settings
+
+    cpu_count = os.cpu_count() or 1
+    if num_workers is None:
+        num_workers = max(1, cpu_count // 4)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, cpu_count // num_workers)
+
+    settings = (model_name, revision, backend, num_workers, threads_per_worker)
+    if _pool is not None and _pool_settings != settings:
+        shutdown_embedding_pool()
+
+    if _pool is None:
+        print(f"Starting {num_workers} embedding workers with {threads_per_worker} threads each")
+        # "spawn" gives every worker a clean torch runtime
+        _pool = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_name, revision, backend, threads_per_worker)
+        )
+        _pool_settings = settings
+
+    return _pool
+
+def shutdown_embedding_pool():
+    global _pool, _pool_settings
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+        _pool_settings = None
+
+atexit.register(shutdown_embedding_pool)
+
+def encode_multi_process(texts, model_name, revision=None, backend="torch", num_workers=None,
+                         threads_per_worker=None, batch_size=32):
+    """
+    Encode texts with several CPU worker processes.
+    The texts are split in shards (several per worker, so fast workers take more),
+    and the results are written into one contiguous float32 matrix in input order.
+    (Call this from inside an `if __name__ == "__main__":` block.)
+    Returns: NumPy float32 array of shape (len(texts), dimension)
+    """
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+
+    pool = get_embedding_pool(model_name, revision, backend, num_workers, threads_per_worker)
+    workers = _pool_settings[3]
+
+    shard_size = max(batch_size, -(-len(texts) // (workers * 4)))
+    shard_starts = list(range(0, len(texts), shard_size))
+
+    embeddings = None
+    results = pool.map(
+        _encode_shard,
+        [texts[start:start + shard_size] for start in shard_starts],
+        [batch_size] * len(shard_starts)
+    )
+    for start, shard_embeddings in zip(shard_starts, results):
+        if embeddings is None:
+            embeddings = np.empty((len(texts), shard_embeddings.shape[1]), dtype=np.float32)
+        embeddings[start:start + len(shard_embeddings)] = shard_embeddings
+
+    return embeddings
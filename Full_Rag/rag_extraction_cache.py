@@ -0,0 +1,234 @@
+import os
+import json
+import zlib
+import hashlib
+
+# Bump this when the text extraction code (or the entry format) changes, old cache entries are then ignored
+PARSER_VERSION = "2"
+
+# Only the slow parsers are cached, plain text files are cheap to read again
+CACHED_EXTS = {".pdf", ".docx", ".xlsx"}
+
+DEFAULT_CACHE_DIR = "./extraction_cache"
+DEFAULT_MAX_CACHE_BYTES = 512 * 1024 * 1024  # 512 MB
+# The cache size is counted on disk again after this many writes, because other
+# loader processes write to the same cache without updating this process's count
+RECOUNT_EVERY_WRITES = 100
+
+# Bytes in each cache directory as far as this process knows, and writes since they were counted
+_cache_bytes = {}
+_writes_since_count = {}
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+def make_cache_key(content_hash, ext):
+    # Same content parsed by another parser version gets another key
+    return hashlib.sha256(f"{PARSER_VERSION}|{ext}|{content_hash}".encode("utf-8")).hexdigest()
+
+def _cache_file_path(key, cache_dir):
+    return os.path.join(cache_dir, key[:2], key + ".json.z")
+
+class CorruptCacheEntry(ValueError):
+    pass
+
+def _read_cached_segments(path, block_size=64 * 1024):
+    # Entries are a zlib stream of JSON lines, one segment per line, read one block at a time
+    decompressor = zlib.decompressobj()
+    pending = b""
+    with open(path, "rb") as f:
+        try:
+            for block in iter(lambda: f.read(block_size), b""):
+                lines = (pending + decompressor.decompress(block)).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    yield json.loads(line.decode("utf-8"))
+            pending += decompressor.flush()
+        except (zlib.error, ValueError) as e:
+            raise CorruptCacheEntry(f"Corrupt extraction cache entry {path}: {e}") from e
+    if pending or not decompressor.eof:
+        raise CorruptCacheEntry(f"Truncated extraction cache entry {path}")
+
+def iter_cached_segments(key, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Read extracted text from the cache one segment at a time.
+    Returns: generator of text segments (e.g. one per PDF page), or None on a cache miss.
+             The generator raises CorruptCacheEntry (and removes the entry) if the entry is damaged.
+    """
+    path = _cache_file_path(key, cache_dir)
+    if not os.path.exists(path):
+        return None
+
+    # Mark the entry as recently used for the eviction
+    try:
+        os.utime(path)
+    except OSError:
+        return None
+
+    def segments():
+        try:
+            yield from _read_cached_segments(path)
+        except CorruptCacheEntry:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            raise
+        except FileNotFoundError as e:
+            # Evicted by another process while being read
+            raise CorruptCacheEntry(f"Extraction cache entry {path} was removed") from e
+    return segments()
+
+def get_cached_segments(key, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Read extracted text from the cache.
+    Returns: list of text segments (e.g. one per PDF page), or None on a cache miss
+    """
+    segments = iter_cached_segments(key, cache_dir)
+    if segments is None:
+        return None
+    try:
+        return list(segments)
+    except CorruptCacheEntry:
+        return None
+
+def write_cached_segments(key, segments, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """
+    Pass text segments through while writing them to the cache, compressed with zlib.
+    The entry only appears once the last segment went through; if the consumer stops
+    early or extraction fails, nothing is stored. Old entries are evicted if needed.
+    Returns: generator of the same segments
+    """
+    path = _cache_file_path(key, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    try:
+        replaced_bytes = os.path.getsize(path)
+    except OSError:
+        replaced_bytes = 0
+
+    # Write to a temporary file first, several loader processes may write at the same time
+    tmp_path = f"{path}.{os.getpid()}.{id(segments)}.tmp"
+    compressor = zlib.compressobj()
+    written_bytes = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for segment in segments:
+                data = compressor.compress((json.dumps(segment, ensure_ascii=False) + "\n").encode("utf-8"))
+                f.write(data)
+                written_bytes += len(data)
+                yield segment
+            data = compressor.flush()
+            f.write(data)
+            written_bytes += len(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    _track_cache_write(cache_dir, written_bytes - replaced_bytes, max_bytes)
+
+def put_cached_segments(key, segments, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """Store extracted text segments, compressed with zlib, then evict old entries if needed."""
+    for _ in write_cached_segments(key, segments, cache_dir, max_bytes):
+        pass
+
+def _track_cache_write(cache_dir, added_bytes, max_bytes):
+    # Keep a running size instead of walking the cache on every write; the cache
+    # is only walked (and evicted) when the size goes over max_bytes or is due for a recount
+    cache_dir = os.path.abspath(cache_dir)
+    writes = _writes_since_count.get(cache_dir, 0) + 1
+    known_bytes = _cache_bytes.get(cache_dir)
+    if known_bytes is None or known_bytes + added_bytes > max_bytes or writes >= RECOUNT_EVERY_WRITES:
+        _cache_bytes[cache_dir] = evict_extraction_cache(cache_dir, max_bytes)
+        _writes_since_count[cache_dir] = 0
+    else:
+        _cache_bytes[cache_dir] = known_bytes + added_bytes
+        _writes_since_count[cache_dir] = writes
+
+def iter_cached_extract(content_hash, ext, extract_fn, cache_dir=DEFAULT_CACHE_DIR,
+                        max_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """
+    Stream the extracted text segments of a file, only calling extract_fn on a cache miss.
+    On a miss the segments are passed on while they are extracted and written to the
+    cache, so a large PDF is never held in memory as a whole.
+    Args:
+        content_hash: Hash of the file content (hash_file / hash_bytes)
+        ext: File extension, e.g. ".pdf"
+        extract_fn: Function without arguments that returns an iterable of text segments
+    Returns: generator of text segments
+    """
+    key = make_cache_key(content_hash, ext)
+    yielded = 0
+    cached = iter_cached_segments(key, cache_dir)
+    if cached is not None:
+        try:
+            for segment in cached:
+                yield segment
+                yielded += 1
+            return
+        except CorruptCacheEntry as e:
+            print(f"{e}, extracting the file again")
+
+    # After a damaged entry, the segments already passed on are extracted again but not repeated
+    for i, segment in enumerate(write_cached_segments(key, extract_fn(), cache_dir, max_bytes)):
+        if i >= yielded:
+            yield segment
+
+def cached_extract(content_hash, ext, extract_fn, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """
+    Return the extracted text segments of a file, only calling extract_fn on a cache miss.
+    Same as iter_cached_extract, as a list.
+    """
+    return list(iter_cached_extract(content_hash, ext, extract_fn, cache_dir, max_bytes))
+
+def _list_cache_files(cache_dir):
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith(".json.z"):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+def evict_extraction_cache(cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """
+    Delete the least recently used entries until the cache is smaller than max_bytes.
+    Returns: Size of the cache in bytes after the eviction
+    """
+    entries = _list_cache_files(cache_dir)
+    total_bytes = sum(size for _, size, _ in entries)
+
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+    return total_bytes
+
+def invalidate_extraction_cache(content_hash, ext, cache_dir=DEFAULT_CACHE_DIR):
+    """Remove the cached text of one file."""
+    try:
+        os.remove(_cache_file_path(make_cache_key(content_hash, ext), cache_dir))
+    except FileNotFoundError:
+        pass
+
+def clear_extraction_cache(cache_dir=DEFAULT_CACHE_DIR):
+    """Remove all cached text."""
+    removed = 0
+    for _, _, path in _list_cache_files(cache_dir):
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    _cache_bytes.pop(os.path.abspath(cache_dir), None)
+    print(f"Removed {removed} entries from the extraction cache")
+    return removed
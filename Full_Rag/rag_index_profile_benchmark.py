@@ -0,0 +1,69 @@
+import sys
+import tempfile
+import time
+import chromadb
+import numpy as np
+from rag_step_1_loading import iter_documents_from_folder
+from rag_step_2_chunking import chunk_documents
+from rag_step_3_embeddings import embed_texts, get_embedder, get_max_chunk_tokens
+from rag_step_4_vector_db import INDEX_PROFILES, get_index_metadata
+
+def benchmark_index_profiles(embeddings, num_queries=200, top_k=10, seed=0):
+    """
+    Build one Chroma collection per index profile from the same vectors and measure
+    recall@k (against exact cosine search) and p50/p99 query latency.
+    Chunk vectors are used as queries, with their own chunk left out of the comparison.
+    Returns: {profile: {"recall", "p50_ms", "p99_ms", "build_seconds"}}
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    top_k = min(top_k, len(embeddings) - 1)
+    rng = np.random.default_rng(seed)
+    query_indexes = rng.choice(len(embeddings), size=min(num_queries, len(embeddings)), replace=False)
+    ids = [str(i) for i in range(len(embeddings))]
+
+    scores = embeddings[query_indexes] @ embeddings.T
+    scores[np.arange(len(query_indexes)), query_indexes] = -np.inf
+    exact = [set(np.argpartition(-row, top_k)[:top_k].tolist()) for row in scores]
+
+    print(f"\nIndex profiles on {len(embeddings)} chunks, {len(query_indexes)} queries, recall@{top_k}:")
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        client = chromadb.PersistentClient(path=directory)
+        for profile in INDEX_PROFILES:
+            start = time.perf_counter()
+            collection = client.create_collection(name=f"profile_{profile}", metadata=get_index_metadata(profile))
+            batch_size = client.get_max_batch_size()
+            for batch_start in range(0, len(ids), batch_size):
+                collection.add(ids=ids[batch_start:batch_start + batch_size],
+                               embeddings=embeddings[batch_start:batch_start + batch_size])
+            build_seconds = time.perf_counter() - start
+
+            latencies = []
+            recalls = []
+            for query_index, expected in zip(query_indexes, exact):
+                start = time.perf_counter()
+                result = collection.query(query_embeddings=embeddings[query_index:query_index + 1],
+                                          n_results=top_k + 1, include=[])
+                latencies.append((time.perf_counter() - start) * 1000)
+                found = [int(i) for i in result["ids"][0] if int(i) != query_index][:top_k]
+                recalls.append(len(expected.intersection(found)) / top_k)
+
+            results[profile] = {
+                "recall": float(np.mean(recalls)),
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p99_ms": float(np.percentile(latencies, 99)),
+                "build_seconds": build_seconds
+            }
+            print(f"  - {profile:12s} recall {results[profile]['recall']:.3f}, "
+                  f"p50 {results[profile]['p50_ms']:.2f} ms, p99 {results[profile]['p99_ms']:.2f} ms, "
+                  f"build {build_seconds:.1f}s")
+    return results
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "./sample_docs"
+    chunks = chunk_documents(iter_documents_from_folder(folder),
+                             chunk_size=get_max_chunk_tokens(),
+                             overlap=32,
+                             tokenizer=get_embedder().tokenizer)
+    # Same vectors as rag_step_by_step stores (mostly read from the embedding cache)
+    benchmark_index_profiles(embed_texts([chunk["text"] for chunk in chunks], normalize=True))
@@ -0,0 +1,98 @@
+import os
+import json
+import hashlib
+
+MANIFEST_FILE_NAME = "ingest_manifest.json"
+
+def get_manifest_path(persist_directory="./chroma_persist"):
+    # The manifest lives next to the vector database it describes
+    return os.path.join(persist_directory, MANIFEST_FILE_NAME)
+
+def load_manifest(persist_directory="./chroma_persist"):
+    """
+    Load the ingestion manifest.
+    Args: persist_directory (str): Folder of the vector database.
+    Returns: dict: {"files": {path: {"size", "mtime", "hash"}}}
+             (empty if nothing was ingested yet)
+    """
+    manifest_path = get_manifest_path(persist_directory)
+    if not os.path.exists(manifest_path):
+        return {"files": {}}
+
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest, persist_directory="./chroma_persist"):
+    os.makedirs(persist_directory, exist_ok=True)
+    manifest_path = get_manifest_path(persist_directory)
+
+    # Write to a temporary file first so a crash never leaves a half-written manifest
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+def hash_file(file_path, block_size=1024 * 1024):
+    """Return the SHA-256 hash of a file's content, read block by block."""
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def scan_file_changes(file_paths, manifest):
+    """
+    Compare the files on disk with the manifest.
+    Files whose size and mtime did not change are not read at all,
+    the others are hashed to find out if their content really changed.
+    Args:
+        file_paths: List of file paths currently in the folder
+        manifest: Manifest returned by load_manifest
+    Returns: dict with lists 'new', 'modified', 'unchanged', 'deleted'
+             and 'entries' (the manifest entries of the current files)
+    """
+    print("=" * 60)
+    print("STEP 0: Checking which files changed since the last run")
+    print("=" * 60)
+
+    known_files = manifest.get("files", {})
+    changes = {"new": [], "modified": [], "unchanged": [], "deleted": [], "entries": {}}
+
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        entry = known_files.get(file_path)
+
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            changes["unchanged"].append(file_path)
+            changes["entries"][file_path] = entry
+            continue
+
+        file_hash = hash_file(file_path)
+        changes["entries"][file_path] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": file_hash
+        }
+
+        if entry is None:
+            changes["new"].append(file_path)
+        elif entry["hash"] != file_hash:
+            changes["modified"].append(file_path)
+        else:
+            # Only touched, the content is the same
+            changes["unchanged"].append(file_path)
+
+    current_files = set(file_paths)
+    changes["deleted"] = [path for path in known_files if path not in current_files]
+
+    print(f"  - New files: {len(changes['new'])}")
+    print(f"  - Modified files: {len(changes['modified'])}")
+    print(f"  - Deleted files: {len(changes['deleted'])}")
+    print(f"  - Unchanged files: {len(changes['unchanged'])}")
+
+    return changes
+
+def update_manifest(manifest, changes):
+    """Replace the manifest's file list with the current one (call after a successful ingest)."""
+    manifest["files"] = changes["entries"]
+    return manifest
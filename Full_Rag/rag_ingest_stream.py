@@ -0,0 +1,98 @@
+from itertools import islice
+from rag_step_2_chunking import make_chunk_id, make_chunk_metadata
+from rag_step_4_vector_db import bulk_upsert_batches, delete_stale_chunks, find_existing_ids
+
+def ingest_chunk_stream(collection, chunks, embed_fn, batch_size=1000, deduplicator=None, keyword_index=None,
+                        failed_sources=None):
+    """
+    Store a stream of chunks batch by batch, so memory holds one batch of chunks
+    (and the chunk ids of the file being read), however large the corpus is.
+    For every batch: drop duplicates within their file, skip the chunks already
+    stored, then embed and upsert the rest (the next batch is read and embedded
+    while one is written). When all chunks of a file went through, the chunks of
+    its older version are deleted, unless the file failed to load partway: then
+    its stored chunks are kept (only the chunks read are updated) and it is retried.
+    Args:
+        collection: Vector store collection
+        chunks: Iterable of chunk dictionaries grouped by source (e.g. iter_chunk_documents)
+        embed_fn: Function turning a list of texts into a matrix of vectors
+        batch_size: Chunks read, deduplicated and upserted per batch
+        deduplicator: ChunkDeduplicator (None = keep every chunk)
+        keyword_index: KeywordIndex kept in step with the stored chunks (None = no keyword index)
+        failed_sources: Set the loader adds the files it could not (fully) read to
+                        (e.g. iter_documents_from_files(failed_sources=...))
+    Returns: Dictionary with the sources seen, the chunk / duplicate / existing / removed counts,
+             'duplicate_of' (id of every dropped chunk -> id of the stored chunk it duplicates)
+             and the stats of bulk_upsert_batches (upserted, failed_ids, failed_sources, rows/s)
+    """
+    counts = {"sources": set(), "chunks": 0, "duplicates": 0, "existing": 0, "removed": 0, "duplicate_of": {}}
+    failed_sources = failed_sources if failed_sources is not None else set()
+    # Kept chunk ids of the sources that may continue in the next batch
+    # (None for a source seen again after it was finished, its stale chunks are already gone)
+    open_sources = {}
+    # Stored ids of the kept chunks by their chunk_id (the key 'duplicate_of' of a dropped chunk), per open source
+    kept_ids = {}
+
+    def finish_sources(sources):
+        for source in sources:
+            kept_ids.pop(source, None)
+            keep_ids = open_sources.pop(source)
+            # A file that failed partway was not read completely: its unseen chunks are not stale
+            if keep_ids is not None and source not in failed_sources:
+                stale_ids = delete_stale_chunks(collection, [source], keep_ids)
+                if keyword_index is not None and stale_ids:
+                    keyword_index.delete(ids=stale_ids)
+                counts["removed"] += len(stale_ids)
+
+    def new_rows():
+        chunk_iter = iter(chunks)
+        while True:
+            batch = list(islice(chunk_iter, batch_size))
+            if not batch:
+                break
+            counts["chunks"] += len(batch)
+            kept, dropped = deduplicator.deduplicate(batch) if deduplicator is not None else (batch, [])
+            counts["duplicates"] += len(dropped)
+
+            for chunk in batch:
+                source = chunk['source']
+                if source not in open_sources:
+                    open_sources[source] = set() if source not in counts["sources"] else None
+                    counts["sources"].add(source)
+
+            ids = [make_chunk_id(chunk) for chunk in kept]
+            for chunk_id, chunk in zip(ids, kept):
+                if open_sources[chunk['source']] is not None:
+                    open_sources[chunk['source']].add(chunk_id)
+                if deduplicator is not None:
+                    kept_ids.setdefault(chunk['source'], {})[chunk['chunk_id']] = chunk_id
+            # Keep a pointer from every dropped chunk to the chunk it duplicates, so it can be traced
+            for chunk in dropped:
+                counts["duplicate_of"][make_chunk_id(chunk)] = kept_ids[chunk['source']][chunk['duplicate_of']]
+            # Sources are read one after another: all but the last one of the batch are complete
+            finish_sources([source for source in open_sources if source != batch[-1]['source']])
+
+            if keyword_index is not None:
+                keyword_index.upsert(ids, [chunk['text'] for chunk in kept],
+                                     [{'source': chunk['source']} for chunk in kept])
+
+            # Only chunks that are not stored yet are embedded and written
+            existing_ids = find_existing_ids(collection, ids)
+            counts["existing"] += len(existing_ids)
+            new = [(chunk_id, chunk) for chunk_id, chunk in zip(ids, kept) if chunk_id not in existing_ids]
+            if new:
+                yield {
+                    "ids": [chunk_id for chunk_id, _ in new],
+                    "documents": [chunk['text'] for _, chunk in new],
+                    "metadatas": [make_chunk_metadata(chunk) for _, chunk in new]
+                }
+        finish_sources(list(open_sources))
+
+    stats = bulk_upsert_batches(collection, new_rows(), embed_fn, batch_size)
+    stats["failed_sources"] |= failed_sources
+    if keyword_index is not None and stats["failed_ids"]:
+        keyword_index.delete(ids=stats["failed_ids"])
+    if deduplicator is not None:
+        deduplicator.print_summary()
+    print(f"Chunks already stored: {counts['existing']}, outdated chunks removed: {counts['removed']}")
+    return {**counts, **stats}
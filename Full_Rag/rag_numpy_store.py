@@ -0,0 +1,300 @@
+import json
+import os
+import sqlite3
+import threading
+import numpy as np
+
+# Rows the vector file grows by at least, when it is full
+_MIN_CAPACITY = 1024
+# Rows of a float16 matrix converted to float32 at once when scoring a query
+_SCORE_BLOCK_ROWS = 65536
+
+DISTANCE_SPACES = ("l2", "cosine", "ip")
+
+def _matches(metadata, where):
+    # Subset of Chroma's where filter: {"key": value}, $eq, $ne, $in, $nin, $and, $or
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(_matches(metadata, part) for part in condition):
+                return False
+        elif key == "$or":
+            if not any(_matches(metadata, part) for part in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for operator, operand in condition.items():
+                if operator == "$eq" and value != operand:
+                    return False
+                if operator == "$ne" and value == operand:
+                    return False
+                if operator == "$in" and value not in operand:
+                    return False
+                if operator == "$nin" and value in operand:
+                    return False
+                if operator not in ("$eq", "$ne", "$in", "$nin"):
+                    raise ValueError(f"Unsupported where operator: {operator}")
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+def _source_values(condition):
+    # Sources selected by {"source": value}, {"$eq": value} or {"$in": [...]}; None for other conditions
+    if not isinstance(condition, dict):
+        return [condition]
+    if list(condition) == ["$eq"]:
+        return [condition["$eq"]]
+    if list(condition) == ["$in"]:
+        return condition["$in"]
+    return None
+
+class NumpyCollection:
+    """
+    Exact-search vector store with the collection methods the RAG steps use
+    (upsert, query, get, delete, count).
+    Vectors live in a memory-mapped .npy matrix (vectors.npy), ids,
+    documents and metadata in a SQLite side table (rows.sqlite) that is also
+    kept in memory. A query is one matrix-vector product plus argpartition.
+    The matrix is float32, or float16 (half the bytes) when the first vectors
+    upserted are float16; float16 rows are scored block by block in float32.
+    Distances follow Chroma: squared L2 ("l2", default), 1 - cosine ("cosine")
+    or 1 - dot product ("ip").
+    """
+
+    max_batch_size = 100000
+
+    def __init__(self, name, persist_directory="./numpy_store", space="l2"):
+        if space not in DISTANCE_SPACES:
+            raise ValueError(f"Unknown distance space '{space}', use one of {DISTANCE_SPACES}")
+        self.name = name
+        self.space = space
+        self.directory = os.path.join(persist_directory, name)
+        os.makedirs(self.directory, exist_ok=True)
+        self._vectors_path = os.path.join(self.directory, "vectors.npy")
+        # Writes can come from the bulk_upsert writer thread
+        self._lock = threading.RLock()
+
+        self._conn = sqlite3.connect(os.path.join(self.directory, "rows.sqlite"), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rows (id TEXT PRIMARY KEY, row INTEGER, document TEXT, metadata TEXT)"
+        )
+
+        self._vectors = np.load(self._vectors_path, mmap_mode="r+") if os.path.exists(self._vectors_path) else None
+        self._row_of = {}
+        self._rows = {}
+        # Rows per metadata source, so filtering on source does not scan every row
+        self._rows_by_source = {}
+        for chunk_id, row, document, metadata in self._conn.execute("SELECT id, row, document, metadata FROM rows"):
+            self._set_row(row, chunk_id, document, json.loads(metadata) if metadata else None)
+        self._refresh_index()
+
+    def _set_row(self, row, chunk_id, document, metadata):
+        self._unset_row(row)
+        self._row_of[chunk_id] = row
+        self._rows[row] = (chunk_id, document, metadata)
+        self._rows_by_source.setdefault((metadata or {}).get("source"), set()).add(row)
+
+    def _unset_row(self, row):
+        if row in self._rows:
+            source = (self._rows[row][2] or {}).get("source")
+            self._rows_by_source[source].discard(row)
+            if not self._rows_by_source[source]:
+                del self._rows_by_source[source]
+            del self._rows[row]
+
+    def _refresh_index(self):
+        # Live rows, their squared norms (for l2) and the rows that can be reused
+        capacity = 0 if self._vectors is None else len(self._vectors)
+        self._live = np.zeros(capacity, dtype=bool)
+        self._live[list(self._rows)] = True
+        self._free_rows = sorted(set(range(capacity)) - set(self._rows), reverse=True)
+        self._norms = np.zeros(capacity, dtype=np.float32)
+        if capacity:
+            live_vectors = self._vectors[self._live]
+            self._norms[self._live] = np.einsum("ij,ij->i", live_vectors, live_vectors, dtype=np.float32)
+
+    def _grow(self, dim, needed_rows, dtype):
+        # Copy the vectors into a bigger file (at least doubled) and swap it in
+        capacity = 0 if self._vectors is None else len(self._vectors)
+        new_capacity = max(_MIN_CAPACITY, capacity * 2, capacity + needed_rows)
+        tmp_path = self._vectors_path + ".tmp.npy"
+        grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=(new_capacity, dim))
+        if capacity:
+            grown[:capacity] = self._vectors
+        grown.flush()
+        del grown
+        self._vectors = None
+        os.replace(tmp_path, self._vectors_path)
+        self._vectors = np.load(self._vectors_path, mmap_mode="r+")
+
+        self._live = np.concatenate([self._live, np.zeros(new_capacity - capacity, dtype=bool)])
+        self._norms = np.concatenate([self._norms, np.zeros(new_capacity - capacity, dtype=np.float32)])
+        self._free_rows = list(range(new_capacity - 1, capacity - 1, -1)) + self._free_rows
+
+    @property
+    def metadata(self):
+        # Same key as Chroma's collection metadata, for code that reads the distance space
+        return {"hnsw:space": self.space}
+
+    def count(self):
+        return len(self._row_of)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            self._vectors = None
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        embeddings = np.asarray(embeddings)
+        if self._vectors is not None:
+            dtype = self._vectors.dtype
+        else:
+            dtype = np.float16 if embeddings.dtype == np.float16 else np.float32
+        embeddings = embeddings.astype(dtype, copy=False)
+        if embeddings.ndim != 2 or len(embeddings) != len(ids):
+            raise ValueError("embeddings must be a matrix with one row per id")
+        if self._vectors is not None and embeddings.shape[1] != self._vectors.shape[1]:
+            raise ValueError(
+                f"Embedding dimension {embeddings.shape[1]} does not match collection dimensionality "
+                f"{self._vectors.shape[1]}"
+            )
+        documents = documents if documents is not None else [None] * len(ids)
+        metadatas = metadatas if metadatas is not None else [None] * len(ids)
+
+        with self._lock:
+            new_ids = [chunk_id for chunk_id in dict.fromkeys(ids) if chunk_id not in self._row_of]
+            if len(new_ids) > len(self._free_rows):
+                self._grow(embeddings.shape[1], len(new_ids) - len(self._free_rows), dtype)
+            for chunk_id in new_ids:
+                self._row_of[chunk_id] = self._free_rows.pop()
+
+            rows = np.array([self._row_of[chunk_id] for chunk_id in ids], dtype=np.int64)
+            self._vectors[rows] = embeddings
+            self._vectors.flush()
+            self._norms[rows] = np.einsum("ij,ij->i", embeddings, embeddings, dtype=np.float32)
+            self._live[rows] = True
+
+            for chunk_id, row, document, metadata in zip(ids, rows.tolist(), documents, metadatas):
+                self._set_row(row, chunk_id, document, metadata)
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO rows (id, row, document, metadata) VALUES (?, ?, ?, ?)",
+                    [
+                        (chunk_id, row, document, json.dumps(metadata) if metadata is not None else None)
+                        for chunk_id, row, document, metadata in zip(ids, rows.tolist(), documents, metadatas)
+                    ]
+                )
+
+    def _select_rows(self, ids=None, where=None):
+        # Rows of the given ids (in that order) or all rows, filtered by where
+        if ids is None and where and list(where) == ["source"]:
+            sources = _source_values(where["source"])
+            if sources is not None:
+                # Only the rows of those sources, without scanning the others
+                return sorted(set().union(*[self._rows_by_source.get(source, ()) for source in sources]))
+
+        if ids is not None:
+            rows = [self._row_of[chunk_id] for chunk_id in ids if chunk_id in self._row_of]
+        else:
+            rows = sorted(self._rows)
+        if where:
+            rows = [row for row in rows if _matches(self._rows[row][2] or {}, where)]
+        return rows
+
+    def _result(self, rows, include):
+        result = {"ids": [self._rows[row][0] for row in rows]}
+        result["documents"] = [self._rows[row][1] for row in rows] if "documents" in include else None
+        result["metadatas"] = [self._rows[row][2] for row in rows] if "metadatas" in include else None
+        if "embeddings" in include:
+            result["embeddings"] = (np.asarray(self._vectors[rows], dtype=np.float32) if rows
+                                    else np.empty((0, 0), dtype=np.float32))
+        else:
+            result["embeddings"] = None
+        return result
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("metadatas", "documents")):
+        with self._lock:
+            rows = self._select_rows(ids, where)
+            rows = rows[offset or 0:]
+            if limit is not None:
+                rows = rows[:limit]
+            return self._result(rows, include)
+
+    def delete(self, ids=None, where=None):
+        # Like Chroma, never read a missing filter as "delete everything"
+        if ids is None and not where:
+            raise ValueError("delete needs ids or a where filter")
+        with self._lock:
+            rows = self._select_rows(ids, where)
+            if not rows:
+                return
+            deleted_ids = [self._rows[row][0] for row in rows]
+            for chunk_id, row in zip(deleted_ids, rows):
+                del self._row_of[chunk_id]
+                self._unset_row(row)
+                self._free_rows.append(row)
+            self._live[rows] = False
+            with self._conn:
+                self._conn.executemany("DELETE FROM rows WHERE id = ?", [(chunk_id,) for chunk_id in deleted_ids])
+
+    def _scores(self, vectors, query):
+        # Dot products with the query; a float16 matrix is converted in blocks, never as a whole
+        if vectors.dtype == np.float32:
+            return vectors @ query
+        scores = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), _SCORE_BLOCK_ROWS):
+            block = vectors[start:start + _SCORE_BLOCK_ROWS]
+            scores[start:start + len(block)] = np.asarray(block, dtype=np.float32) @ query
+        return scores
+
+    def _distances(self, query, scores, norms):
+        if self.space == "l2":
+            return float(np.dot(query, query)) + norms - 2 * scores
+        if self.space == "cosine":
+            query_norm = max(float(np.linalg.norm(query)), 1e-12)
+            return 1 - scores / (query_norm * np.maximum(np.sqrt(norms), 1e-12))
+        return 1 - scores
+
+    def query(self, query_embeddings, n_results=10, where=None,
+              include=("metadatas", "documents", "distances")):
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        if query_embeddings.ndim == 1:
+            query_embeddings = query_embeddings.reshape(1, -1)
+
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": [], "embeddings": []}
+        with self._lock:
+            # With a where filter only the matching rows are scored, so the cost follows their number
+            candidates = np.array(self._select_rows(where=where), dtype=np.int64) if where else None
+            if candidates is not None:
+                candidate_vectors = self._vectors[candidates]
+            k = min(n_results, len(self._rows) if candidates is None else len(candidates))
+
+            for query in query_embeddings:
+                if k == 0:
+                    rows = np.empty(0, dtype=np.int64)
+                    distances = np.empty(0, dtype=np.float32)
+                elif candidates is None:
+                    # One matrix-vector product straight on the memmap, free rows pushed to the end
+                    all_distances = self._distances(query, self._scores(self._vectors, query), self._norms)
+                    all_distances[~self._live] = np.inf
+                    rows = np.argpartition(all_distances, k - 1)[:k]
+                    rows = rows[np.argsort(all_distances[rows], kind="stable")]
+                    distances = all_distances[rows]
+                else:
+                    all_distances = self._distances(query, self._scores(candidate_vectors, query),
+                                                    self._norms[candidates])
+                    top = np.argpartition(all_distances, k - 1)[:k]
+                    top = top[np.argsort(all_distances[top], kind="stable")]
+                    rows = candidates[top]
+                    distances = all_distances[top]
+
+                found = self._result(rows.tolist(), include)
+                result["ids"].append(found["ids"])
+                result["documents"].append(found["documents"])
+                result["metadatas"].append(found["metadatas"])
+                result["embeddings"].append(found["embeddings"])
+                result["distances"].append(distances.tolist())
+
+        for key in ("documents", "metadatas", "embeddings", "distances"):
+            if key not in include:
+                result[key] = None
+        return result
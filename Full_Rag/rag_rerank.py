@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import OrderedDict
+from sentence_transformers import CrossEncoder
+
+# Small local cross-encoder trained on MS MARCO passage ranking (about 22M parameters)
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+# Candidates fetched by the vector / keyword search and scored by the cross-encoder
+RERANK_CANDIDATES = 50
+# Number of (query, chunk) scores kept in memory
+PAIR_CACHE_SIZE = 4096
+
+_reranker = None
+_reranker_lock = threading.Lock()
+_load_thread = None
+# Measured seconds per scored pair, used to predict whether scoring fits before the deadline
+_seconds_per_pair = None
+
+_pair_scores = OrderedDict()
+_pair_scores_lock = threading.Lock()
+
+def get_reranker(model_name=RERANK_MODEL):
+    global _reranker
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                _reranker = CrossEncoder(model_name)
+    return _reranker
+
+def load_reranker_in_background():
+    """Start loading the cross-encoder in a background thread (no-op when loaded or loading)."""
+    global _load_thread
+    if _reranker is None and (_load_thread is None or not _load_thread.is_alive()):
+        _load_thread = threading.Thread(target=get_reranker, name="reranker-preload", daemon=True)
+        _load_thread.start()
+
+def _score_pairs(query, ids, documents, batch_size):
+    # Cross-encoder scores of (query, document) pairs, cached by query and chunk id
+    # (chunk ids are content-addressed, so an id always stands for the same text)
+    global _seconds_per_pair
+    query = " ".join(query.split())
+    scores = {}
+    with _pair_scores_lock:
+        for chunk_id in ids:
+            score = _pair_scores.get((query, chunk_id))
+            if score is not None:
+                _pair_scores.move_to_end((query, chunk_id))
+                scores[chunk_id] = score
+
+    missing = [(chunk_id, document) for chunk_id, document in zip(ids, documents) if chunk_id not in scores]
+    if missing:
+        started = time.perf_counter()
+        # All candidates in one batch, so one forward pass scores them
+        predicted = get_reranker().predict([(query, document) for _, document in missing],
+                                           batch_size=batch_size, show_progress_bar=False)
+        _seconds_per_pair = (time.perf_counter() - started) / len(missing)
+        with _pair_scores_lock:
+            for (chunk_id, _), score in zip(missing, predicted):
+                scores[chunk_id] = float(score)
+                _pair_scores[(query, chunk_id)] = float(score)
+            while len(_pair_scores) > PAIR_CACHE_SIZE:
+                _pair_scores.popitem(last=False)
+    return scores
+
+def _uncached_count(query, ids):
+    query = " ".join(query.split())
+    with _pair_scores_lock:
+        return sum((query, chunk_id) not in _pair_scores for chunk_id in ids)
+
+def rerank_chunks(query, results, top_k=3, deadline=None, batch_size=RERANK_CANDIDATES):
+    """
+    Reorder retrieved chunks by cross-encoder score and keep the best top_k.
+    Args:
+        query: Query text
+        results: Results of retrieve_relevant_chunks (one query, ideally RERANK_CANDIDATES chunks)
+        top_k: Number of chunks to keep
+        deadline: time.perf_counter() value the reranking must finish by; when the model
+                  is not loaded yet or scoring is predicted to take longer, the chunks
+                  keep their retrieval order (None = always rerank)
+        batch_size: Pairs per forward pass
+    Returns: Results with the same keys, cut to top_k, plus 'rerank_scores' (None when skipped)
+    """
+    print("\n" + "=" * 25)
+    print("STEP 6b: Rerank Chunks")
+    print("=" * 25)
+
+    ids = results['ids'][0]
+    skip_reason = None
+    if deadline is not None:
+        remaining = deadline - time.perf_counter()
+        # Cached pairs cost nothing, only the others are checked against the deadline
+        uncached = _uncached_count(query, ids)
+        if _reranker is None:
+            # Loading takes seconds, so this query goes without reranking and the next ones get it
+            load_reranker_in_background()
+            skip_reason = "cross-encoder still loading"
+        elif uncached and remaining <= 0:
+            # Checked even before the first scoring has given a time estimate
+            skip_reason = f"deadline passed {-1000 * remaining:.0f} ms ago"
+        elif uncached and _seconds_per_pair is not None and uncached * _seconds_per_pair > remaining:
+            skip_reason = f"scoring would exceed the deadline ({1000 * remaining:.0f} ms left)"
+
+    order = list(range(len(ids)))
+    scores = None
+    if skip_reason:
+        print(f"Skipping reranking: {skip_reason}")
+    elif ids:
+        pair_scores = _score_pairs(query, ids, results['documents'][0], batch_size)
+        order.sort(key=lambda i: pair_scores[ids[i]], reverse=True)
+        scores = [pair_scores[ids[i]] for i in order[:top_k]]
+        print(f"✓ Reranked {len(ids)} chunks with the cross-encoder")
+
+    reranked = {key: [[results[key][0][i] for i in order[:top_k]]]
+                for key in ('ids', 'documents', 'distances', 'metadatas', 'embeddings')
+                if results.get(key) is not None}
+    reranked['rerank_scores'] = [scores]
+    for i, (doc, metadata) in enumerate(zip(reranked['documents'][0], reranked['metadatas'][0])):
+        score = f"Rerank score: {scores[i]:.3f}" if scores else "Retrieval order"
+        print(f"\nChunk {i + 1} ({score}) Source: {metadata['source']}")
+        print(f"Preview: {doc[:150]}...")
+    return reranked
@@ -1,108 +1,394 @@
 import os
+import io
 import json
 import csv
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from docx import Document
 from PyPDF2 import PdfReader
 import pandas as pd
+from rag_extraction_cache import CACHED_EXTS, cached_extract, iter_cached_extract
+from rag_ingest_manifest import hash_file
+from rag_json_stream import iter_json_record_groups
 
-def load_documents_from_folder(folder_path):
+SUPPORTED_EXTS = {".txt", ".docx", ".pdf", ".csv", ".json", ".xlsx", ".md"}
+
+def _extract_segments(file_path, ext):
+    # The slow parsers: one text segment per PDF page, one for DOCX and XLSX
+    if ext == ".pdf":
+        reader = PdfReader(file_path)
+        return [page.extract_text() or "" for page in reader.pages]
+    if ext == ".docx":
+        doc = Document(file_path)
+        return ["\n".join([para.text for para in doc.paragraphs])]
+    if ext == ".xlsx":
+        df = pd.read_excel(file_path)
+        return [df.to_json(orient="records", indent=2, force_ascii=False)]
+    raise ValueError(f"No extractor for {ext} files")
+
+def _iter_pdf_pages(file_path):
+    # Keep the file open and extract one page at a time
+    with open(file_path, "rb") as f:
+        reader = PdfReader(f)
+        for page in reader.pages:
+            yield page.extract_text() or ""
+
+def iter_pdf_pages(file_path, use_cache=True):
+    """
+    Stream the page texts of a PDF. With the cache, pages are read from the
+    cache entry or written to it while they are extracted, one page at a time.
+    """
+    if not use_cache:
+        return _iter_pdf_pages(file_path)
+    return iter_cached_extract(hash_file(file_path), ".pdf", lambda: _iter_pdf_pages(file_path))
+
+def extract_segments(file_path, ext, use_cache=True):
+    """
+    Extract the text of a PDF, DOCX or XLSX file, using the on-disk
+    extraction cache so the same file content is only parsed once.
+    Returns: list of text segments (one per page for PDFs)
+    """
+    if not use_cache or ext not in CACHED_EXTS:
+        return _extract_segments(file_path, ext)
+    return cached_extract(hash_file(file_path), ext, lambda: _extract_segments(file_path, ext))
+
+def load_single_document(file_path, use_cache=True):
+    """
+    Load one supported document (TXT, DOCX, PDF, CSV, JSON, XLSX, MD).
+    Args: file_path (str): Path to the file.
+          use_cache (bool): Reuse text extracted earlier from the same
+              PDF/DOCX/XLSX content (see rag_extraction_cache).
+    Returns: dict: Dictionary with keys 'content', 'source', 'length'
+              and 'file_type', or None if the file type is not supported.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    content = ""
+
+    # ----- TXT -----
+    if ext == ".txt":
+        with open(file_path, "r", encoding="utf-8") as f:
+            content = f.read()
+
+    # ----- DOCX -----
+    elif ext == ".docx":
+        content = extract_segments(file_path, ext, use_cache)[0]
+
+    # ----- PDF -----
+    elif ext == ".pdf":
+        pages = extract_segments(file_path, ext, use_cache)
+        content = "\n".join(pages)
+
+    # ----- CSV -----
+    elif ext == ".csv":
+        rows = []
+        with open(file_path, "r", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            for row in reader:
+                if header:
+                    rows.append(dict(zip(header, row)))
+                else:
+                    rows.append(row)
+        content = json.dumps(rows, indent=2, ensure_ascii=False)
+
+    # ----- JSON -----
+    elif ext == ".json":
+        with open(file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        content = json.dumps(data, indent=2, ensure_ascii=False)
+
+    # ----- XLSX -----
+    elif ext == ".xlsx":
+        content = extract_segments(file_path, ext, use_cache)[0]
+
+    # ----- Markdown -----
+    elif ext == ".md":
+        with open(file_path, "r", encoding="utf-8") as f:
+            content = f.read()
+
+    else:
+        return None
+
+    return {
+        "content": content,
+        "source": file_path,
+        "length": len(content),
+        "file_type": ext.replace('.', '')
+    }
+
+def list_supported_files(folder_path):
+    """Return the paths of all supported files in a folder, sorted by name."""
+    return sorted(
+        os.path.join(folder_path, f)
+        for f in os.listdir(folder_path)
+        if os.path.splitext(f)[1].lower() in SUPPORTED_EXTS
+    )
+
+def _pdf_page_document(file_path, content, page_number):
+    return {
+        "content": content,
+        "source": file_path,
+        "length": len(content),
+        "file_type": "pdf",
+        "page": page_number
+    }
+
+def _format_rows(header, rows):
+    # Compact CSV text, one line per row, with the header as first line.
+    # Newlines inside cells are replaced so that every row stays on one line.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for row in [header] + rows:
+        writer.writerow(["" if value is None else str(value).replace("\n", " ") for value in row])
+    return buffer.getvalue().rstrip("\n")
+
+def _iter_table_rows(file_path, ext):
+    # Yields the header first, then the data rows, without loading the whole table
+    if ext == ".csv":
+        with open(file_path, "r", encoding="utf-8", newline="") as f:
+            yield from csv.reader(f)
+
+    elif ext == ".xlsx":
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            # Same sheet as pd.read_excel: the first one
+            yield from workbook.worksheets[0].iter_rows(values_only=True)
+        finally:
+            workbook.close()
+
+    else:
+        raise ValueError(f"{ext} is not a table format")
+
+def iter_table_row_groups(file_path, rows_per_group=50):
+    """
+    Stream a CSV or XLSX file in groups of rows instead of one big JSON text.
+    Every group is compact CSV text that starts with the header row, so it
+    can be understood on its own.
+    Args: file_path (str): Path to the CSV / XLSX file.
+          rows_per_group (int): Number of data rows per group.
+    Returns: generator: Document dictionaries with keys 'content', 'source',
+              'length', 'file_type', 'row_start' and 'row_end'
+              (1-based data row numbers, header not counted)
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    rows = _iter_table_rows(file_path, ext)
+    header = next(rows, None)
+    if header is None:
+        return
+
+    group = []
+    row_start = 1
+    for row_number, row in enumerate(rows, start=1):
+        group.append(row)
+        if len(group) == rows_per_group:
+            content = _format_rows(header, group)
+            yield {
+                "content": content,
+                "source": file_path,
+                "length": len(content),
+                "file_type": ext.replace('.', ''),
+                "row_start": row_start,
+                "row_end": row_number
+            }
+            group = []
+            row_start = row_number + 1
+
+    if group:
+        content = _format_rows(header, group)
+        yield {
+            "content": content,
+            "source": file_path,
+            "length": len(content),
+            "file_type": ext.replace('.', ''),
+            "row_start": row_start,
+            "row_end": row_start + len(group) - 1
+        }
+
+def iter_json_groups(file_path, records_per_group=50):
+    """
+    Stream a JSON file as groups of compact one-line records
+    (see rag_json_stream), without loading the whole file.
+    Returns: generator: Document dictionaries with keys 'content', 'source',
+              'length', 'file_type', 'row_start' and 'row_end'
+              (1-based record numbers)
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        for content, record_start, record_end in iter_json_record_groups(f, records_per_group):
+            yield {
+                "content": content,
+                "source": file_path,
+                "length": len(content),
+                "file_type": "json",
+                "row_start": record_start,
+                "row_end": record_end
+            }
+
+def iter_document_segments(file_path, split_pdf_pages=True, use_cache=True, rows_per_group=None,
+                           json_records_per_group=None):
+    """
+    Lazily load one document.
+    Args: file_path (str): Path to the file.
+          split_pdf_pages (bool): Yield PDFs page by page (with a 'page' key)
+              instead of as one document.
+          use_cache (bool): Use the extraction cache for PDF/DOCX/XLSX.
+          rows_per_group (int): If set, CSV and XLSX files are streamed in
+              groups of rows (see iter_table_row_groups).
+          json_records_per_group (int): If set, JSON files are streamed in
+              groups of top-level records (see iter_json_groups).
+    Returns: generator: Document dictionaries with the same keys as
+              load_single_document
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+
+    if ext in (".csv", ".xlsx") and rows_per_group:
+        yield from iter_table_row_groups(file_path, rows_per_group)
+        return
+
+    if ext == ".json" and json_records_per_group:
+        yield from iter_json_groups(file_path, json_records_per_group)
+        return
+
+    if ext == ".pdf" and split_pdf_pages:
+        for page_number, content in enumerate(iter_pdf_pages(file_path, use_cache), start=1):
+            yield _pdf_page_document(file_path, content, page_number)
+        return
+
+    document = load_single_document(file_path, use_cache)
+    if document is not None:
+        yield document
+
+def iter_documents_from_folder(folder_path, split_pdf_pages=True, use_cache=True, rows_per_group=None,
+                               json_records_per_group=None, failed_sources=None):
+    """
+    Streaming version of load_documents_from_folder: yields documents
+    (or single PDF pages) one at a time instead of building a list,
+    so only one document is kept in memory at once.
+    Args: folder_path (str): Path to the folder containing documents.
+          split_pdf_pages (bool): Yield PDFs page by page.
+          use_cache (bool): Use the extraction cache for PDF/DOCX/XLSX.
+          rows_per_group (int): Stream CSV / XLSX files in groups of rows.
+          json_records_per_group (int): Stream JSON files in groups of records.
+          failed_sources (set): If given, the files that failed to load (also
+              partway, after some of their documents were yielded) are added to it.
+    Returns: generator: Document dictionaries with keys 'content', 'source',
+              'length', 'file_type' (and 'page' for PDF pages,
+              'row_start' / 'row_end' for row groups)
+    """
+    print("=" * 60)
+    print("STEP 1: Streaming documents from a folder")
+    print("=" * 60)
+
+    if not os.path.isdir(folder_path):
+        print(f"Error: {folder_path} is not a valid directory.")
+        return
+
+    file_paths = list_supported_files(folder_path)
+
+    if not file_paths:
+        print("No supported files found in the folder.")
+        return
+
+    yield from iter_documents_from_files(file_paths, split_pdf_pages, use_cache, rows_per_group,
+                                         json_records_per_group, failed_sources)
+
+def iter_documents_from_files(file_paths, split_pdf_pages=True, use_cache=True, rows_per_group=None,
+                              json_records_per_group=None, failed_sources=None):
+    """
+    Same as iter_documents_from_folder, but for a given list of files
+    (e.g. only the files that changed since the last ingestion).
+    """
+    loaded_files = 0
+    for file_path in file_paths:
+        try:
+            segments = 0
+            documents = iter_document_segments(file_path, split_pdf_pages, use_cache, rows_per_group,
+                                               json_records_per_group)
+            for document in documents:
+                segments += 1
+                yield document
+
+            loaded_files += 1
+            print(f"Loaded: {file_path} ({segments} segment(s))")
+
+        except Exception as e:
+            print(f"Error loading {file_path}: {e}")
+            # Recorded before any document of the next file is yielded
+            if failed_sources is not None:
+                failed_sources.add(file_path)
+
+    print(f"\nTotal documents loaded: {loaded_files}")
+
+def _load_file_safely(file_path, use_cache=True):
+    # Runs inside the worker processes: errors are returned instead of raised
+    # so that one broken file does not stop the rest of the folder
+    try:
+        return load_single_document(file_path, use_cache), None
+    except Exception as e:
+        return None, str(e)
+
+def load_documents_from_folder(folder_path, num_workers=1, use_cache=True):
     """
     Load all supported documents (TXT, DOCX, PDF, CSV, JSON, XLSX, MD)
     from a given folder.
     Args: folder_path (str): Path to the folder containing documents.
+          num_workers (int): Number of processes used to parse the files.
+              1 parses them one after another, None uses all CPU cores.
+              (When using more than one worker, call this from inside
+              an `if __name__ == "__main__":` block.)
+          use_cache (bool): Reuse text extracted earlier from the same
+              PDF/DOCX/XLSX content.
     Returns: list: List of dictionaries with keys:
               'content', 'source', 'length', and 'file_type'
+              (always in file name order)
     """
     print("=" * 60)
     print("STEP 1: Loading documents from a folder")
     print("=" * 60)
 
-    supported_exts = {".txt", ".docx", ".pdf", ".csv", ".json", ".xlsx", ".md"}
     documents = []
 
     if not os.path.isdir(folder_path):
         print(f"Error: {folder_path} is not a valid directory.")
         return documents
 
-    file_paths = [
-        os.path.join(folder_path, f)
-        for f in os.listdir(folder_path)
-        if os.path.splitext(f)[1].lower() in supported_exts
-    ]
+    file_paths = list_supported_files(folder_path)
 
     if not file_paths:
         print("No supported files found in the folder.")
         return documents
 
-    for file_path in file_paths:
-        ext = os.path.splitext(file_path)[1].lower()
-        content = ""
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
 
-        try:
-            # ----- TXT -----
-            if ext == ".txt":
-                with open(file_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-
-            # ----- DOCX -----
-            elif ext == ".docx":
-                doc = Document(file_path)
-                content = "\n".join([para.text for para in doc.paragraphs])
-
-            # ----- PDF -----
-            elif ext == ".pdf":
-                reader = PdfReader(file_path)
-                pages = [page.extract_text() or "" for page in reader.pages]
-                content = "\n".join(pages)
-
-            # ----- CSV -----
-            elif ext == ".csv":
-                rows = []
-                with open(file_path, "r", encoding="utf-8") as f:
-                    reader = csv.reader(f)
-                    header = next(reader, None)
-                    for row in reader:
-                        if header:
-                            rows.append(dict(zip(header, row)))
-                        else:
-                            rows.append(row)
-                content = json.dumps(rows, indent=2, ensure_ascii=False)
-
-            # ----- JSON -----
-            elif ext == ".json":
-                with open(file_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                content = json.dumps(data, indent=2, ensure_ascii=False)
-
-            # ----- XLSX -----
-            elif ext == ".xlsx":
-                df = pd.read_excel(file_path)
-                content = df.to_json(orient="records", indent=2, force_ascii=False)
-
-            # ----- Markdown -----
-            elif ext == ".md":
-                with open(file_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-
-            else:
-                print(f"Skipping unsupported file type: {file_path}")
-                continue
-
-            # Append document info
-            documents.append({
-                "content": content,
-                "source": file_path,
-                "length": len(content),
-                "file_type": ext.replace('.', '')
-            })
+    load_file = partial(_load_file_safely, use_cache=use_cache)
 
-            print(f"Loaded: {file_path}")
-            print(f"  - Type: {ext}")
-            print(f"  - Characters: {len(content)}")
-            print(f"  - Words: {len(content.split())}")
+    if num_workers > 1:
+        # Parse the files in parallel, map() keeps the results in file order
+        print(f"Parsing {len(file_paths)} files with {num_workers} worker processes")
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(load_file, file_paths))
+    else:
+        results = [load_file(file_path) for file_path in file_paths]
 
-        except Exception as e:
-            print(f"Error loading {file_path}: {e}")
+    for file_path, (document, error) in zip(file_paths, results):
+        if error is not None:
+            print(f"Error loading {file_path}: {error}")
+            continue
+
+        if document is None:
+            print(f"Skipping unsupported file type: {file_path}")
+            continue
+
+        # Append document info
+        documents.append(document)
+
+        content = document["content"]
+        print(f"Loaded: {file_path}")
+        print(f"  - Type: .{document['file_type']}")
+        print(f"  - Characters: {len(content)}")
+        print(f"  - Words: {len(content.split())}")
 
     print(f"\nTotal documents loaded: {len(documents)}")
     return documents
\ No newline at end of file
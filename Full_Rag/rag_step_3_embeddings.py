@@ -1,31 +1,239 @@
-from sentence_transformers import SentenceTransformer
+import threading
+import time
+from collections import OrderedDict
 import numpy as np
+from rag_embedding_cache import get_cached_embeddings, make_embedding_key, normalize_text, put_cached_embeddings
+from rag_embedding_pool import encode_multi_process
+from rag_embedding_backend import EMBEDDING_BACKEND, load_sentence_transformer
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+# Pin a Hugging Face revision (commit hash) so cached vectors always match the model
+MODEL_REVISION = None
+
+# Number of query vectors kept in memory by embed_query
+QUERY_CACHE_SIZE = 256
 
 _model = None
+_model_key = None
+# The model can be loaded by the preload thread and a request at the same time
+_model_lock = threading.Lock()
+_preload_thread = None
 
-def get_embedder(model_name="all-MiniLM-L6-v2"):
-    global _model
+_query_cache = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+def get_embedder(model_name=MODEL_NAME, revision=MODEL_REVISION, backend=EMBEDDING_BACKEND):
+    """Return the shared embedding model, running on the configured backend (see rag_embedding_backend)."""
+    global _model, _model_key
     if _model is None:
-        _model = SentenceTransformer(model_name)
+        with _model_lock:
+            if _model is None:
+                model = load_sentence_transformer(model_name, revision, backend)
+                # Part of the embedding cache key (other backends give slightly different vectors)
+                _model_key = (model_name, revision, backend)
+                _model = model
     return _model
 
-def embed_texts(texts):
-    """Return list of vectors (numpy arrays) for a list of texts."""
+def preload_embedder_in_background():
+    """
+    Start loading the embedding model in a background thread, so the first
+    query does not wait for it. Safe to call on every app rerun.
+    """
+    global _preload_thread
+    if _model is None and (_preload_thread is None or not _preload_thread.is_alive()):
+        _preload_thread = threading.Thread(target=get_embedder, name="embedder-preload", daemon=True)
+        _preload_thread.start()
+
+def get_max_chunk_tokens():
+    """Largest chunk (in tokens) the model embeds without truncation: its window minus [CLS] and [SEP]."""
+    return get_embedder().max_seq_length - 2
+
+def make_token_budget_batches(token_lengths, max_batch_tokens=8192, max_batch_size=256):
+    """
+    Group texts of similar length into batches sized by a token budget.
+    Texts are sorted by token length, and a batch grows while
+    (longest text in the batch) x (batch size) stays within max_batch_tokens,
+    so short texts go in big batches and long texts in small ones.
+    Args:
+        token_lengths: Token length of every text
+        max_batch_tokens: Padded tokens allowed per batch
+        max_batch_size: Upper limit for the number of texts per batch
+    Returns: List of batches, each a list of text indexes
+    """
+    order = np.argsort(token_lengths, kind="stable")
+    batches = []
+    current = []
+
+    for idx in order:
+        # Sorted ascending, so this text is the longest of the batch so far
+        length = max(int(token_lengths[idx]), 1)
+        if current and (length * (len(current) + 1) > max_batch_tokens or len(current) >= max_batch_size):
+            batches.append(current)
+            current = []
+        current.append(int(idx))
+
+    if current:
+        batches.append(current)
+    return batches
+
+def _padding_efficiency(token_lengths, batches):
+    # Real tokens / tokens including padding
+    padded = sum(max(token_lengths[i] for i in batch) * len(batch) for batch in batches)
+    return sum(token_lengths) / padded if padded else 1.0
+
+def _encode_bucketed(model, texts, max_batch_tokens, out, rows):
+    # Encode with length-bucketed, token-budget batches, writing the vector of texts[i] to out[rows[i]]
+    token_lengths = [
+        len(ids) for ids in model.tokenizer(
+            texts, add_special_tokens=True, truncation=True, max_length=model.max_seq_length
+        )["input_ids"]
+    ]
+    batches = make_token_budget_batches(token_lengths, max_batch_tokens)
+
+    start_time = time.perf_counter()
+    for batch in batches:
+        out[rows[batch]] = model.encode(
+            [texts[i] for i in batch],
+            show_progress_bar=False,
+            batch_size=len(batch)
+        )
+    elapsed = time.perf_counter() - start_time
+
+    # Same texts in fixed batches of 32, for comparison
+    sorted_order = list(np.argsort(token_lengths, kind="stable"))
+    fixed_batches = [sorted_order[i:i + 32] for i in range(0, len(texts), 32)]
+
+    print(f"  - Batches: {len(batches)} (token budget {max_batch_tokens})")
+    print(f"  - Padding efficiency: {100 * _padding_efficiency(token_lengths, batches):.1f}% "
+          f"(fixed batches of 32: {100 * _padding_efficiency(token_lengths, fixed_batches):.1f}%)")
+    print(f"  - Throughput: {len(texts) / max(elapsed, 1e-9):.1f} texts/s, "
+          f"{sum(token_lengths) / max(elapsed, 1e-9):.0f} tokens/s")
+
+def l2_normalize_rows(embeddings, block_rows=4096):
+    """L2-normalize the rows of a float32 matrix in place, block by block (so memmaps are not loaded at once)."""
+    for start in range(0, len(embeddings), block_rows):
+        block = embeddings[start:start + block_rows]
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        # Zero vectors stay zero
+        np.divide(block, norms, out=block, where=norms > 0)
+    return embeddings
+
+def create_embedding_memmap(path, num_texts, dim=None):
+    """
+    Create a float32 .npy file on disk of shape (num_texts, dim), to pass as
+    out= to embed_texts when the vectors do not fit in memory.
+    Open it again later with np.load(path, mmap_mode="r").
+    """
+    if dim is None:
+        dim = get_embedder().get_sentence_embedding_dimension()
+    return np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(num_texts, dim))
+
+def _output_buffer(out, num_texts, dim):
+    # The matrix embed_texts writes into: a new one, or the caller's buffer / memmap
+    if out is None:
+        return np.empty((num_texts, dim), dtype=np.float32)
+    if out.shape != (num_texts, dim) or out.dtype != np.float32 or not out.flags.c_contiguous:
+        raise ValueError(
+            f"out must be a C-contiguous float32 array of shape {(num_texts, dim)}, "
+            f"got {out.dtype} array of shape {out.shape}"
+        )
+    return out
+
+def _query_cache_key(model, text):
+    # Same key for questions that only differ in whitespace, and in case for uncased models
+    text = normalize_text(text)
+    if getattr(model.tokenizer, "do_lower_case", False):
+        text = text.lower()
+    return (_model_key, text)
+
+def embed_query(text, normalize=True):
+    """
+    Return a (1, dim) float32 matrix for one query text.
+    Fast path for the chatbot: a single encode call without progress bar,
+    batching or step banners, and an in-memory LRU of the last
+    QUERY_CACHE_SIZE queries. The returned matrix is read-only.
+    """
+    model = get_embedder()
+    key = (_query_cache_key(model, text), normalize)
+
+    with _query_cache_lock:
+        vector = _query_cache.get(key)
+        if vector is not None:
+            _query_cache.move_to_end(key)
+            return vector
+
+    vector = model.encode(
+        text,
+        convert_to_numpy=True,
+        show_progress_bar=False,
+        normalize_embeddings=normalize
+    ).astype(np.float32, copy=False).reshape(1, -1)
+    vector.setflags(write=False)
+
+    with _query_cache_lock:
+        _query_cache[key] = vector
+        while len(_query_cache) > QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+    return vector
+
+def embed_texts(texts, use_cache=True, num_workers=1, max_batch_tokens=8192, normalize=False, out=None):
+    """
+    Return a C-contiguous float32 matrix with one vector per text.
+    With normalize, every vector is L2-normalized (unit length).
+    The vectors are written straight into out when given: a C-contiguous
+    float32 array or memmap of shape (len(texts), dim), see create_embedding_memmap.
+    With use_cache, vectors computed before (same model, revision and
+    whitespace-normalized text) are read from the embedding cache and only
+    the other texts are encoded.
+    num_workers > 1 (or None for one worker per 4 cores) encodes with a pool
+    of CPU worker processes, see rag_embedding_pool.
+    In a single process, texts are batched by length with max_batch_tokens
+    padded tokens per batch (see make_token_budget_batches).
+    """
     print("\n" + "=" * 25)
     print("STEP 3: Embedding")
     print("=" * 25)
 
     model = get_embedder()
+    embeddings = _output_buffer(out, len(texts), model.get_sentence_embedding_dimension())
+
+    missing = list(range(len(texts)))
+    if use_cache and texts:
+        keys = [make_embedding_key(text, *_model_key) for text in texts]
+        cached = get_cached_embeddings(keys)
+        missing = []
+        first_index = {}
+        for i, key in enumerate(keys):
+            if key in cached:
+                embeddings[i] = cached[key]
+            elif key not in first_index:
+                # Encode every distinct text only once
+                first_index[key] = i
+                missing.append(i)
+        print(f"  - Cache hits: {len(texts) - len(missing)}, to encode: {len(missing)}")
+
+    if missing:
+        # Create embeddings
+        rows = np.asarray(missing)
+        if num_workers is None or num_workers > 1:
+            embeddings[rows] = encode_multi_process([texts[i] for i in missing], *_model_key,
+                                                    num_workers=num_workers)
+        else:
+            _encode_bucketed(model, [texts[i] for i in missing], max_batch_tokens, embeddings, rows)
+
+        if use_cache:
+            # The cache keeps the vectors as the model returns them (before normalize)
+            put_cached_embeddings([keys[i] for i in missing], embeddings[rows])
+            # Texts that appeared more than once in this call
+            for i, key in enumerate(keys):
+                if key in first_index and first_index[key] != i:
+                    embeddings[i] = embeddings[first_index[key]]
+
+    if normalize:
+        l2_normalize_rows(embeddings)
 
-    # Create embeddings
-    embeddings = model.encode(
-        texts,
-        show_progress_bar=True,
-        batch_size=32
-        )
-    
     print(f"✓ Embeddings created")
     print(f"  - Shape: {embeddings.shape}")
     print(f"  - Each chunk is now a {embeddings.shape[1]}-dimensional vector")
     
-    return embeddings
\ No newline at end of file
+    return embeddings
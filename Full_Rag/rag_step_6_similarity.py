@@ -1,10 +1,117 @@
-def retrieve_relevant_chunks(query_embedding, collection, top_k=3):
+import numpy as np
+
+# Retrieved chunks previewed in the output
+MAX_PRINTED_CHUNKS = 10
+
+def get_distance_space(collection):
+    # Collections created without an index profile use Chroma's default, squared L2
+    return (collection.metadata or {}).get("hnsw:space", "l2")
+
+def distance_to_similarity(distance, space="l2"):
+    """Convert a distance of the given space to a cosine similarity (the vectors are L2-normalized)."""
+    if space == "l2":
+        # Squared L2 distance of unit vectors is 2 - 2 * cosine
+        return 1 - distance / 2
+    # cosine: 1 - cosine, ip: 1 - dot product
+    return 1 - distance
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuse ranked id lists (best first) with reciprocal rank fusion: score = sum of 1 / (k + rank).
+    Returns the ids ordered by fused score.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+def _fuse_keyword_hits(results, keyword_ids, collection, top_k):
+    # Single-query results of the top_k fused ids; chunks found only by keyword have no distance
+    fused_ids = reciprocal_rank_fusion([results['ids'][0], keyword_ids])[:top_k]
+    with_embeddings = results.get('embeddings') is not None
+    found = {}
+    for i, chunk_id in enumerate(results['ids'][0]):
+        found[chunk_id] = (results['documents'][0][i], results['distances'][0][i], results['metadatas'][0][i],
+                           results['embeddings'][0][i] if with_embeddings else None)
+
+    missing_ids = [chunk_id for chunk_id in fused_ids if chunk_id not in found]
+    if missing_ids:
+        include = ["documents", "metadatas"] + (["embeddings"] if with_embeddings else [])
+        stored = collection.get(ids=missing_ids, include=include)
+        for i, chunk_id in enumerate(stored['ids']):
+            found[chunk_id] = (stored['documents'][i], None, stored['metadatas'][i],
+                               stored['embeddings'][i] if with_embeddings else None)
+
+    fused_ids = [chunk_id for chunk_id in fused_ids if chunk_id in found]
+    fused = {
+        'ids': [fused_ids],
+        'documents': [[found[chunk_id][0] for chunk_id in fused_ids]],
+        'distances': [[found[chunk_id][1] for chunk_id in fused_ids]],
+        'metadatas': [[found[chunk_id][2] for chunk_id in fused_ids]]
+    }
+    if with_embeddings:
+        fused['embeddings'] = [[found[chunk_id][3] for chunk_id in fused_ids]]
+    return fused
+
+def select_diverse_chunks(query_embedding, results, top_k=3, lambda_mult=0.5):
+    """
+    Pick top_k chunks by maximal marginal relevance, so overlapping neighbours of the
+    same passage do not fill the prompt.
+    Args:
+        query_embedding: Query vector
+        results: Results of retrieve_relevant_chunks with include_embeddings=True (one query),
+                 or of rerank_chunks: its 'rerank_scores' are then the relevance to the query
+        top_k: Number of chunks to keep
+        lambda_mult: 1 = only relevance to the query, 0 = only difference to the chunks already picked
+    Returns: Results with the same keys, cut to the top_k picked chunks in pick order
+    """
+    embeddings = np.asarray(results['embeddings'][0], dtype=np.float32)
+    if len(embeddings) == 0:
+        return results
+    # Cosine similarities, also for vectors stored without normalization
+    embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+    rerank_scores = (results.get('rerank_scores') or [None])[0]
+    if rerank_scores is not None:
+        # Cross-encoder scores are unbounded logits: rescaled to [0, 1] to weigh like similarities
+        scores = np.asarray(rerank_scores, dtype=np.float32)
+        relevance = (scores - scores.min()) / max(float(scores.max() - scores.min()), 1e-12)
+    else:
+        relevance = embeddings @ query
+    # All pairwise similarities of the candidates in one product
+    pairwise = embeddings @ embeddings.T
+
+    selected = [int(np.argmax(relevance))]
+    # Highest similarity of every candidate to the chunks picked so far
+    max_similarity = pairwise[selected[0]].copy()
+    for _ in range(1, min(top_k, len(embeddings))):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[selected] = -np.inf
+        selected.append(int(np.argmax(scores)))
+        np.maximum(max_similarity, pairwise[selected[-1]], out=max_similarity)
+
+    print(f"Picked {len(selected)} of {len(embeddings)} chunks by maximal marginal relevance "
+          f"(lambda {lambda_mult})")
+    return {key: [[results[key][0][i] for i in selected]]
+            for key in ('ids', 'documents', 'distances', 'metadatas', 'embeddings', 'rerank_scores')
+            if results.get(key) is not None and results[key][0] is not None}
+
+def retrieve_relevant_chunks(query_embedding, collection, top_k=3, sources=None, keyword_ids=None,
+                             include_embeddings=False):
     """
     Search vector database for most relevant chunks.
     Args:
         query_embedding: Query vector
         collection: ChromaDB collection
         top_k: Number of results to return
+        sources: Only search the chunks of these sources (e.g. the documents a query was routed to),
+                 None = search all chunks
+        keyword_ids: Chunk ids ranked by the keyword (BM25) search, fused with the
+                     vector results by reciprocal rank fusion (None = vector search only)
+        include_embeddings: Also return the chunk vectors (for select_diverse_chunks)
     Returns: Dictionary with retrieved documents, distances, and metadata
     """
     print("\n" + "=" * 25)
@@ -12,26 +119,54 @@ def retrieve_relevant_chunks(query_embedding, collection, top_k=3):
     print("=" * 25)
     print(f"Searching for top {top_k} most relevant chunks...")
     
-    # Query the collection
-    results = collection.query(
-        query_embeddings=query_embedding,
-        n_results=top_k
-    )
+    space = get_distance_space(collection)
+    # With keyword hits, as many vector hits are fetched so both rankings are fused at the same depth
+    n_results = max(top_k, len(keyword_ids)) if keyword_ids else top_k
+    include = ["documents", "metadatas", "distances"] + (["embeddings"] if include_embeddings else [])
+
+    results = None
+    if sources:
+        print(f"Searching only the chunks of the {len(sources)} closest documents")
+        results = collection.query(
+            query_embeddings=query_embedding,
+            n_results=n_results,
+            where={"source": {"$in": list(sources)}},
+            include=include
+        )
+        if len(results['ids'][0]) < top_k:
+            # The routed documents have too few chunks, search all of them instead
+            results = None
+
+    if results is None:
+        # Query the collection
+        results = collection.query(
+            query_embeddings=query_embedding,
+            n_results=n_results,
+            include=include
+        )
+
+    if keyword_ids:
+        print(f"Fusing with {len(keyword_ids)} keyword (BM25) hits")
+        results = _fuse_keyword_hits(results, keyword_ids, collection, top_k)
     
     print(f"✓ Retrieved {len(results['documents'][0])} chunks")
     print("\nRetrieved chunks (ranked by relevance):")
     print("-" * 60)
     
+    # A large candidate set (for reranking) is only previewed in part
     for i, (doc, distance, metadata) in enumerate(zip(
-        results['documents'][0],
+        results['documents'][0][:MAX_PRINTED_CHUNKS],
         results['distances'][0],
         results['metadatas'][0]
     )):
-        similarity = 1 - distance  # Convert distance to similarity
-        
-        print(f"\nChunk {i + 1} (Similarity: {similarity:.3f})")
+        if distance is None:
+            print(f"\nChunk {i + 1} (Keyword match)")
+        else:
+            print(f"\nChunk {i + 1} (Similarity: {distance_to_similarity(distance, space):.3f})")
         print(f"Source: {metadata['source']}")
         print(f"Preview: {doc[:150]}...")
         print("-" * 60)
+    if len(results['documents'][0]) > MAX_PRINTED_CHUNKS:
+        print(f"... and {len(results['documents'][0]) - MAX_PRINTED_CHUNKS} more")
     
     return results
\ No newline at end of file
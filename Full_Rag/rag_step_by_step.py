@@ -1,9 +1,17 @@
 import os
-from rag_step_1_loading import load_documents_from_folder
-from rag_step_2_chunking import chunk_documents
-from rag_step_3_embeddings import embed_texts
-from rag_step_4_vector_db import get_db_collection
-from rag_step_6_similarity import retrieve_relevant_chunks
+import time
+from rag_step_1_loading import iter_documents_from_files, list_supported_files
+from rag_step_2_chunking import iter_chunk_documents
+from rag_dedup import ChunkDeduplicator
+from rag_step_3_embeddings import embed_query, embed_texts, get_embedder, get_max_chunk_tokens
+from rag_step_4_vector_db import get_db_collection, get_store_directory
+from rag_ingest_stream import ingest_chunk_stream
+from rag_vector_compression import compress_vectors, load_compression, load_or_fit_compression
+from rag_document_index import remove_from_document_index, route_query, update_document_index
+from rag_keyword_index import get_keyword_index
+from rag_ingest_manifest import load_manifest, save_manifest, scan_file_changes, update_manifest
+from rag_step_6_similarity import retrieve_relevant_chunks, select_diverse_chunks
+from rag_rerank import RERANK_CANDIDATES, load_reranker_in_background, rerank_chunks
 from rag_step_7_prompt import prepare_prompt
 from rag_step_8_call_llm import generate_answer
 from dotenv import load_dotenv
@@ -12,51 +20,156 @@ load_dotenv()
 current_dir = os.path.dirname(os.path.abspath(__file__))
 folder_path = os.path.join(current_dir, "sample_docs")
 
+#CSV / XLSX files are streamed in groups of this many rows (None = one JSON text per file)
+TABLE_ROWS_PER_GROUP = 50
+#JSON files are streamed in groups of this many top-level records (None = load the whole file)
+JSON_RECORDS_PER_GROUP = 50
+#chunks at least this similar (0-1) to an earlier chunk are not embedded again
+DEDUP_THRESHOLD = 0.9
+#compression of the stored vectors (see rag_compression_report.py for the recall of each setting)
+#None = keep all 384 dimensions, otherwise PCA to this many dimensions
+VECTOR_DIM = None
+#"float32" or "float16" (half the bytes in the NumPy store, Chroma keeps float32)
+VECTOR_DTYPE = "float32"
+#chunks read, embedded and upserted per batch (upserting one batch while the next is embedded)
+UPSERT_BATCH_SIZE = 1000
+#the query is first routed to this many closest documents, and only their chunks are searched
+#(None = search all chunks)
+TOP_DOCUMENTS = 5
+#chunks taken from the keyword (BM25) search and fused with the vector hits
+KEYWORD_TOP_K = 20
+#seconds the keyword search may take, its rarest query terms are scored first
+KEYWORD_TIME_BUDGET = 0.05
+#rerank the top RERANK_CANDIDATES chunks with a cross-encoder (False = keep the retrieval order)
+RERANK = True
+#seconds from the question to the end of reranking; reranking is skipped when it would take longer
+RERANK_DEADLINE = 1.0
+#pick the final chunks by maximal marginal relevance among the best MMR_CANDIDATES,
+#so overlapping neighbours of the same passage do not fill the prompt
+#(1 = only relevance, 0 = only diversity, None = keep the top chunks as ranked)
+MMR_LAMBDA = 0.5
+MMR_CANDIDATES = 10
 
-#step 1: load existing files
-source_list = load_documents_from_folder(folder_path)
 
-#step2: chunk the contents
-my_chunks_with_metadata = chunk_documents(source_list)
+#the cross-encoder loads while the documents are ingested
+if RERANK:
+    load_reranker_in_background()
 
-#prepare data for storage
+#Chroma by default, VECTOR_STORE=numpy in the .env file switches to the in-process NumPy store
+my_rag_collection = get_db_collection()
+#BM25 index of the chunk texts, updated together with the collection
+my_keyword_index = get_keyword_index(my_rag_collection)
+#the manifest and the compression are stored with the vectors they describe (one per backend)
+store_directory = get_store_directory(my_rag_collection)
 
-ids_list = [f"chunk_{i}" for i in range(len(my_chunks_with_metadata))]
-text_list = []
-metadata_list = []
+#step 0: find the files that changed since the last run
+manifest = load_manifest(store_directory)
+if my_rag_collection.count() == 0:
+    #an empty collection (new, emptied, or another backend) gets every file, whatever the manifest says
+    manifest["files"] = {}
+changes = scan_file_changes(list_supported_files(folder_path), manifest)
+files_to_ingest = changes["new"] + changes["modified"]
 
-for chunk in my_chunks_with_metadata:
-    text_list.append(chunk["text"])
-    metadata_list.append({
-        'source': chunk['source'],
-        'doc_id': chunk['doc_id'],
-        'chunk_id': chunk['chunk_id']
-    })
+def remove_files(file_paths):
+    #remove the vectors, document vectors and keyword postings of these files
+    if file_paths:
+        my_rag_collection.delete(where={"source": {"$in": list(file_paths)}})
+        remove_from_document_index(my_rag_collection, file_paths)
+        my_keyword_index.delete(sources=file_paths)
 
-#step 3: generate embeddings
-vectors_list = embed_texts(text_list)
+#remove the vectors of deleted files
+#(the outdated chunks of modified files are removed after chunking, unchanged chunks are kept)
+remove_files(changes["deleted"])
 
-#step 4: store into vector_db
-my_rag_collection = get_db_collection()
-my_rag_collection.upsert(
-        ids = ids_list,
-        embeddings = vectors_list,
-        documents = text_list,
-        metadatas = metadata_list
-    )
+if files_to_ingest:
+    #step 1: load the new / modified files (streamed one document / PDF page at a time)
+    #files that fail to load (also partway) are collected, their stored chunks are kept
+    load_failures = set()
+    source_list = iter_documents_from_files(files_to_ingest,
+                                            rows_per_group=TABLE_ROWS_PER_GROUP,
+                                            json_records_per_group=JSON_RECORDS_PER_GROUP,
+                                            failed_sources=load_failures)
+
+    #step2: chunk the contents (by tokens of the embedding model, so no chunk gets truncated)
+    #the chunks are produced lazily, one document after the other
+    chunk_stream = iter_chunk_documents(source_list,
+                                        chunk_size=get_max_chunk_tokens(),
+                                        overlap=32,
+                                        tokenizer=get_embedder().tokenizer)
+
+    collection_was_empty = my_rag_collection.count() == 0
+    compression_state = {}
+
+    def embed_batch(texts):
+        #step 3: generate embeddings
+        vectors = embed_texts(texts, normalize=True)
+
+        #step 3b: compress the vectors (the projection is fitted on the first batch and saved next to the collection)
+        if "compression" not in compression_state:
+            compression_state["compression"] = load_or_fit_compression(my_rag_collection.name, vectors,
+                                                                       dim=VECTOR_DIM, dtype=VECTOR_DTYPE,
+                                                                       refit=collection_was_empty,
+                                                                       persist_directory=store_directory)
+        return compress_vectors(vectors, compression_state["compression"])
+
+    #step 2b - 4: batch by batch, so memory holds one batch of chunks however many files are loaded:
+    #  - drop exact / near-duplicate chunks of the same file (repeated headers, footers, rows)
+    #  - give every chunk an id made from source, position and content hash (the same chunk always
+    #    gets the same id, and files never overwrite each other), skip the chunks already stored
+    #  - embed the new chunks and store them into vector_db (while the next batch is embedded)
+    #  - index them for keyword search, and remove the chunks of the old version of modified files
+    ingest_stats = ingest_chunk_stream(my_rag_collection, chunk_stream, embed_batch,
+                                       batch_size=UPSERT_BATCH_SIZE,
+                                       deduplicator=ChunkDeduplicator(threshold=DEDUP_THRESHOLD),
+                                       keyword_index=my_keyword_index,
+                                       failed_sources=load_failures)
+
+    #files that failed to load (also partway), or that had a failed batch, are left out of the manifest
+    #so they are retried next run
+    for file_path in ingest_stats["failed_sources"]:
+        changes["entries"].pop(file_path, None)
+
+    #files that loaded without error but gave no chunks (e.g. emptied): their old chunks are removed,
+    #and they stay in the manifest so they are not read again until they change
+    remove_files([file_path for file_path in changes["modified"]
+                  if file_path not in ingest_stats["sources"] and file_path not in ingest_stats["failed_sources"]])
+
+    #step 4b: update the document vectors (one per source) of the files whose chunks changed
+    update_document_index(my_rag_collection, sorted(ingest_stats["sources"]))
+else:
+    print("\nNo new or modified files, skipping loading, chunking and embedding")
+
+save_manifest(update_manifest(manifest, changes), store_directory)
 print("\n" + "=" * 25)
-print(f"STEP 4: Embedding: successfully added {my_rag_collection.count()} into vector database")
+print(f"STEP 4: Vector database now contains {my_rag_collection.count()} chunks")
 print("=" * 25)
 
 #step 5: write query and generate the embeddings of the query
 user_question = input("Enter your questions / query here: whats in your mind today?")
-question_list = []
-question_list.append(user_question)
+query_started = time.perf_counter()
+question_vector = embed_query(user_question)
+#the query is compressed the same way as the stored chunks
+question_vector = compress_vectors(question_vector, load_compression(my_rag_collection.name, store_directory))
+
+#step 6: route the query to the closest documents, then search only their chunks
+routed_sources = route_query(question_vector, my_rag_collection, TOP_DOCUMENTS)
+#exact identifiers (account codes, SKUs, names) are found by the keyword search over all documents
+#and fused with the vector hits
+keyword_hits = my_keyword_index.search(user_question, KEYWORD_TOP_K, time_budget=KEYWORD_TIME_BUDGET)
+final_candidates = MMR_CANDIDATES if MMR_LAMBDA is not None else 3
+result = retrieve_relevant_chunks(question_vector, my_rag_collection,
+                                  RERANK_CANDIDATES if RERANK else final_candidates,
+                                  sources=routed_sources,
+                                  keyword_ids=[chunk_id for chunk_id, _ in keyword_hits],
+                                  include_embeddings=MMR_LAMBDA is not None)
 
-question_vector = embed_texts(question_list)
+#step 6b: score the candidates with the cross-encoder and keep the best ones
+if RERANK:
+    result = rerank_chunks(user_question, result, final_candidates, deadline=query_started + RERANK_DEADLINE)
 
-#step 6: perform semantic / similarity search to get relevant chunks
-result = retrieve_relevant_chunks(question_vector, my_rag_collection, 3) #pick only top 3
+#step 6c: pick only 3 chunks that are relevant but not near-duplicates of each other
+if MMR_LAMBDA is not None:
+    result = select_diverse_chunks(question_vector, result, 3, MMR_LAMBDA)
 
 #step 7: prepare a prompt
 prompt = prepare_prompt(user_question, result['documents'][0])
@@ -0,0 +1,83 @@
+import sys
+import tempfile
+import time
+import chromadb
+import numpy as np
+from rag_ivf_store import IvfCollection
+from rag_numpy_store import NumpyCollection
+
+def _random_vectors(rows, dim, rng):
+    vectors = rng.standard_normal((rows, dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def _benchmark(name, open_collection, vectors, queries, top_k, batch_size):
+    ids = [f"chunk_{i}" for i in range(len(vectors))]
+    documents = [f"document {i}" for i in range(len(vectors))]
+    metadatas = [{"source": f"file_{i % 100}"} for i in range(len(vectors))]
+
+    start = time.perf_counter()
+    collection = open_collection()
+    for batch_start in range(0, len(vectors), batch_size):
+        batch_end = batch_start + batch_size
+        collection.upsert(ids=ids[batch_start:batch_end],
+                          embeddings=vectors[batch_start:batch_end],
+                          documents=documents[batch_start:batch_end],
+                          metadatas=metadatas[batch_start:batch_end])
+    upsert_seconds = time.perf_counter() - start
+    # The custom stores are closed first (the IVF store finishes its background compaction,
+    # a second instance must not open the directory meanwhile); Chroma has nothing to close
+    if hasattr(collection, "close"):
+        collection.close()
+
+    # Re-open, as a new process would
+    start = time.perf_counter()
+    collection = open_collection()
+    open_seconds = time.perf_counter() - start
+
+    latencies = []
+    found = []
+    for query in queries:
+        start = time.perf_counter()
+        result = collection.query(query_embeddings=query.reshape(1, -1), n_results=top_k)
+        latencies.append(time.perf_counter() - start)
+        found.append({int(chunk_id.split("_")[1]) for chunk_id in result["ids"][0]})
+
+    latencies = np.array(latencies) * 1000
+    print(f"  {name:7s} upsert {len(vectors) / upsert_seconds:9.0f} rows/s, open {open_seconds * 1000:7.1f} ms, "
+          f"query p50 {np.percentile(latencies, 50):6.2f} ms p99 {np.percentile(latencies, 99):6.2f} ms")
+    return found
+
+def compare_vector_stores(rows=20000, dim=384, num_queries=200, top_k=10, batch_size=5000, seed=0):
+    """Upsert the same random vectors into Chroma, the NumPy store and the IVF store, and compare speed and results."""
+    rng = np.random.default_rng(seed)
+    vectors = _random_vectors(rows, dim, rng)
+    queries = _random_vectors(num_queries, dim, rng)
+
+    # Exact top-k, for the recall of each store
+    scores = queries @ vectors.T
+    exact = [set(np.argpartition(-row, top_k)[:top_k].tolist()) for row in scores]
+
+    print(f"\nVector store benchmark: {rows} vectors of {dim} dims, {num_queries} queries, top {top_k}")
+    with tempfile.TemporaryDirectory() as directory:
+        chroma_found = _benchmark(
+            "chroma",
+            lambda: chromadb.PersistentClient(path=f"{directory}/chroma").get_or_create_collection("benchmark"),
+            vectors, queries, top_k, batch_size
+        )
+        numpy_found = _benchmark(
+            "numpy",
+            lambda: NumpyCollection("benchmark", persist_directory=f"{directory}/numpy"),
+            vectors, queries, top_k, batch_size
+        )
+        ivf_found = _benchmark(
+            "ivf",
+            lambda: IvfCollection("benchmark", persist_directory=f"{directory}/ivf", space="l2"),
+            vectors, queries, top_k, batch_size
+        )
+
+    for name, found in (("chroma", chroma_found), ("numpy", numpy_found), ("ivf", ivf_found)):
+        recall = np.mean([len(a & b) / top_k for a, b in zip(exact, found)])
+        print(f"  {name:7s} recall@{top_k}: {recall:.3f}")
+
+if __name__ == "__main__":
+    compare_vector_stores(rows=int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
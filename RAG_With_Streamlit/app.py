@@ -1,5 +1,10 @@
 import streamlit as st
+from pages.rag_step_3_embeddings import preload_embedder_in_background
+from pages.Chatbot.rag_rerank import load_reranker_in_background
 
+#start loading the embedding model and the reranker now, so the first chatbot question does not wait for them
+preload_embedder_in_background()
+load_reranker_in_background()
 
 # page = st.navigation(
 #     [
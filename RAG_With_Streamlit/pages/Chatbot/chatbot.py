@@ -1,7 +1,13 @@
 import streamlit as st
 import os
-from pages.rag_step_3_embeddings import embed_texts
-from pages.Chatbot.rag_step_6_similarity import retrieve_relevant_chunks
+import time
+from pages.rag_step_3_embeddings import embed_query
+from pages.rag_vector_compression import compress_vectors, load_compression
+from pages.rag_step_4_vector_db import get_store_directory
+from pages.rag_document_index import route_query
+from pages.rag_keyword_index import get_keyword_index
+from pages.Chatbot.rag_step_6_similarity import retrieve_relevant_chunks, select_diverse_chunks
+from pages.Chatbot.rag_rerank import RERANK_CANDIDATES, rerank_chunks
 from pages.Chatbot.rag_step_7_prompt import prepare_prompt
 from pages.Chatbot.rag_step_8_call_llm import generate_answer
 from dotenv import load_dotenv
@@ -17,10 +23,28 @@ def generate_response():
     user_msg = st.session_state.user_msg 
 
 
-    question_vector = embed_texts([st.session_state.user_msg])
-
-    #step 6: perform semantic / similarity search to get relevant chunks
-    result = retrieve_relevant_chunks(question_vector, st.session_state.rag_collection, 3) #pick only top 3
+    query_started = time.perf_counter()
+    question_vector = embed_query(st.session_state.user_msg)
+    #the query is compressed the same way as the stored chunks
+    question_vector = compress_vectors(question_vector, load_compression(st.session_state.rag_collection.name,
+                                                                         get_store_directory(st.session_state.rag_collection)))
+
+    #step 6: route the query to the 5 closest documents, then search only their chunks
+    routed_sources = route_query(question_vector, st.session_state.rag_collection, 5)
+    #exact identifiers (account codes, SKUs, names) are found by the keyword search (at most 50 ms)
+    #and fused with the vector hits
+    keyword_hits = get_keyword_index(st.session_state.rag_collection).search(user_msg, 20, time_budget=0.05)
+    result = retrieve_relevant_chunks(question_vector, st.session_state.rag_collection, RERANK_CANDIDATES,
+                                      sources=routed_sources,
+                                      keyword_ids=[chunk_id for chunk_id, _ in keyword_hits],
+                                      include_embeddings=True)
+
+    #step 6b: rerank the candidates with the cross-encoder and keep the best 10
+    #(skipped, keeping the retrieval order, when it would not finish within 1 s of the question)
+    result = rerank_chunks(user_msg, result, 10, deadline=query_started + 1.0)
+
+    #step 6c: pick only 3 chunks that are relevant but not near-duplicates of each other
+    result = select_diverse_chunks(question_vector, result, 3, lambda_mult=0.5)
 
     #step 7: prepare a prompt
     prompt = prepare_prompt(st.session_state.user_msg, result['documents'][0])   
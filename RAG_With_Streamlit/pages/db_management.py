@@ -1,5 +1,7 @@
 import streamlit as st
 from pages.rag_step_4_vector_db import get_db_collection
+from pages.rag_document_index import remove_from_document_index
+from pages.rag_keyword_index import get_keyword_index
 
 st.title("🗃️ Vector Database Management")
     
@@ -67,6 +69,8 @@ if collection:
                 if st.button("🗑️ Delete File", key=f"delete_{file_name}"):
                     # Delete all chunks from this file using where filter
                     collection.delete(where={"source": file_name})
+                    remove_from_document_index(collection, [file_name])
+                    get_keyword_index(collection).delete(sources=[file_name])
                     st.success(f"✅ Deleted {len(chunks)} chunks from {file_name}")
                     st.rerun() #to rerun the page and the updated DB appear
             
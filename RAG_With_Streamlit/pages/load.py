@@ -1,8 +1,20 @@
 import streamlit as st
-from pages.step_1_loading import load_documents_from_streamlit_files
-from pages.rag_step_2_chunking import chunk_documents
-from pages.rag_step_3_embeddings import embed_texts
-from pages.rag_step_4_vector_db import get_db_collection
+from pages.step_1_loading import iter_documents_from_streamlit_files
+from pages.rag_step_2_chunking import iter_chunk_documents
+from pages.rag_dedup import ChunkDeduplicator
+from pages.rag_step_3_embeddings import embed_texts, get_embedder, get_max_chunk_tokens
+from pages.rag_step_4_vector_db import get_db_collection, get_store_directory
+from pages.rag_ingest_stream import ingest_chunk_stream
+from pages.rag_vector_compression import compress_vectors, load_or_fit_compression
+from pages.rag_document_index import update_document_index
+from pages.rag_keyword_index import get_keyword_index
+
+#compression of the stored vectors: None = keep all 384 dimensions, otherwise PCA to this many dimensions
+VECTOR_DIM = None
+#"float32" or "float16" (half the bytes in the NumPy store, Chroma keeps float32)
+VECTOR_DTYPE = "float32"
+#chunks read, embedded and upserted per batch (upserting one batch while the next is embedded)
+UPSERT_BATCH_SIZE = 1000
 
 
 
@@ -28,44 +40,68 @@ uploaded_files = st.file_uploader(
 if uploaded_files:
     st.success(f"✅ {len(uploaded_files)} file(s) uploaded successfully!")
 
-    #step 1: load existing files
-    source_list = load_documents_from_streamlit_files(uploaded_files)
-
-
-    #step2: chunk the contents
-    my_chunks_with_metadata = chunk_documents(source_list)
-    st.success(f"✂️ Step 2: Created {len(my_chunks_with_metadata)} chunks from documents")
-
+    #step 1: load existing files (streamed one document / PDF page at a time)
+    #files that fail to load (also partway) are collected, their stored chunks are kept
+    load_failures = set()
+    source_list = iter_documents_from_streamlit_files(uploaded_files, json_records_per_group=50,
+                                                      failed_sources=load_failures)
 
-    #prepare data for storage
 
-    ids_list = [f"chunk_{i}" for i in range(len(my_chunks_with_metadata))]
-    text_list = []
-    metadata_list = []
+    #step2: chunk the contents (by tokens of the embedding model, so no chunk gets truncated)
+    #the chunks are produced lazily, one document after the other
+    chunk_stream = iter_chunk_documents(source_list,
+                                        chunk_size=get_max_chunk_tokens(),
+                                        overlap=32,
+                                        tokenizer=get_embedder().tokenizer)
 
-    for chunk in my_chunks_with_metadata:
-        text_list.append(chunk["text"])
-        metadata_list.append({
-            'source': chunk['source'],
-            'doc_id': chunk['doc_id'],
-            'chunk_id': chunk['chunk_id']
-        })
-
-    #step 3: generate embeddings
-    vectors_list = embed_texts(text_list)
-    st.success(f"🧮 Step 3: Generated embeddings for {len(vectors_list)} chunks")
-
-    #step 4: store into vector_db
     my_rag_collection = get_db_collection()
-    my_rag_collection.upsert(
-            ids = ids_list,
-            embeddings = vectors_list,
-            documents = text_list,
-            metadatas = metadata_list
-        )
-    
+    collection_was_empty = my_rag_collection.count() == 0
+    compression_state = {}
+
+    def embed_batch(texts):
+        #step 3: generate embeddings
+        vectors = embed_texts(texts, normalize=True)
+
+        #step 3b: compress the vectors (the projection is fitted on the first batch and saved next to the collection)
+        if "compression" not in compression_state:
+            compression_state["compression"] = load_or_fit_compression(my_rag_collection.name, vectors,
+                                                                       dim=VECTOR_DIM, dtype=VECTOR_DTYPE,
+                                                                       refit=collection_was_empty,
+                                                                       persist_directory=get_store_directory(my_rag_collection))
+        return compress_vectors(vectors, compression_state["compression"])
+
+    #step 2b - 4, batch by batch so memory holds one batch of chunks however much is uploaded:
+    #drop duplicate chunks of the same file, skip chunks that are already stored (ids are made from
+    #source, position and content hash, so a new upload never overwrites the chunks of an earlier one),
+    #embed and store the rest, index them for keyword search and remove the outdated chunks of re-uploaded files
+    ingest_stats = ingest_chunk_stream(my_rag_collection, chunk_stream, embed_batch,
+                                       batch_size=UPSERT_BATCH_SIZE,
+                                       deduplicator=ChunkDeduplicator(threshold=0.9),
+                                       keyword_index=get_keyword_index(my_rag_collection),
+                                       failed_sources=load_failures)
+    loaded_documents = len(ingest_stats["sources"])
+    st.success(f"✂️ Step 2: Created {ingest_stats['chunks']} chunks from documents")
+    if ingest_stats["duplicates"]:
+        st.success(f"🧹 Step 2b: Skipped {ingest_stats['duplicates']} duplicate chunks")
+    if ingest_stats["removed"]:
+        st.success(f"🔄 Removed {ingest_stats['removed']} outdated chunks of re-uploaded files")
+    if ingest_stats["existing"]:
+        st.success(f"⏭️ Skipped {ingest_stats['existing']} chunks that are already in the vector database")
+    embedded_chunks = ingest_stats["upserted"] + len(ingest_stats["failed_ids"])
+    st.success(f"🧮 Step 3: Generated embeddings for {embedded_chunks} chunks "
+               f"({ingest_stats['embed_rows_per_sec']:.0f} chunks/s)")
+    if ingest_stats["failed_ids"]:
+        st.error(f"⚠️ {len(ingest_stats['failed_ids'])} chunks could not be stored, please upload their files again")
+    if load_failures:
+        st.error(f"⚠️ Could not read {', '.join(sorted(load_failures))} completely, their earlier chunks were kept; "
+                 f"please upload them again")
+
+    #step 4b: update the document vectors (one per file) used to route queries
+    update_document_index(my_rag_collection, sorted(ingest_stats["sources"]))
+
     st.session_state.rag_collection = my_rag_collection
-    st.success(f"🗄️ Step 4: Successfully added {my_rag_collection.count()} chunks into vector database")
+    st.success(f"🗄️ Step 4: Successfully added {ingest_stats['upserted']} chunks into vector database "
+               f"({ingest_stats['upsert_rows_per_sec']:.0f} chunks/s), it now contains {my_rag_collection.count()} chunks")
 
     st.subheader("📊 Processing Summary")
     col1, col2, col3, col4 = st.columns(4)
@@ -73,8 +109,8 @@ if uploaded_files:
     with col1:
         st.metric("Original Files", len(uploaded_files))
     with col2:
-        st.metric("Loaded Documents", len(source_list))
+        st.metric("Loaded Documents", loaded_documents)
     with col3:
-        st.metric("Text Chunks", len(my_chunks_with_metadata))
+        st.metric("Text Chunks", ingest_stats["chunks"])
     with col4:
         st.metric("Vector DB Entries", my_rag_collection.count())
\ No newline at end of file
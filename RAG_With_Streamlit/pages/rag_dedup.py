@@ -0,0 +1,155 @@
+import re
+import zlib
+import hashlib
+import numpy as np
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+def _normalize(text):
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+def _shingles(normalized_text, size=5):
+    # Character shingles, hashed to 32-bit integers
+    if len(normalized_text) <= size:
+        pieces = [normalized_text]
+    else:
+        pieces = {normalized_text[i:i + size] for i in range(len(normalized_text) - size + 1)}
+    return np.array([zlib.crc32(p.encode("utf-8")) for p in pieces], dtype=np.uint64)
+
+def minhash_signatures(texts, num_perm=64, shingle_size=5, seed=42):
+    """
+    Compute a MinHash signature for every text.
+    Two signatures agree in a fraction of positions that estimates the
+    Jaccard similarity of the texts' character shingles.
+    Returns: NumPy array of shape (len(texts), num_perm)
+    """
+    # Random hash functions (a * x + b) % prime, a and b small enough to never overflow uint64
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+
+    signatures = np.full((len(texts), num_perm), _MAX_HASH, dtype=np.uint64)
+    for i, text in enumerate(texts):
+        shingles = _shingles(_normalize(text), shingle_size)
+        # All permutations of all shingles at once: (shingles, num_perm)
+        hashed = ((shingles[:, None] * a[None, :] + b[None, :]) % _MERSENNE_PRIME) & _MAX_HASH
+        signatures[i] = hashed.min(axis=0)
+    return signatures
+
+class ChunkDeduplicator:
+    """
+    Drop exact and near-duplicate chunks before embedding them, within each source.
+    Exact duplicates (same normalized text) are found with a hash, near
+    duplicates with MinHash + locality-sensitive hashing: chunks that share a
+    band of their signature are compared, and a chunk is dropped when its
+    estimated similarity to an earlier kept chunk of the same source is at least threshold.
+    Chunks are only compared within their source: a dropped chunk is covered by a
+    stored chunk of the same file, so deleting another file can never lose its text.
+    Chunks arrive grouped by source (as iter_chunk_documents yields them) and can
+    be passed in batches; the state of the current source carries over between batches.
+    """
+
+    def __init__(self, threshold=0.9, num_perm=64, bands=16):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.kept_count = 0
+        self.dropped_count = 0
+        self.total_chars = 0
+        self.saved_chars = 0
+        self._start_source(None)
+
+    def _start_source(self, source):
+        self._source = source
+        self._exact_index = {}
+        self._band_buckets = [{} for _ in range(self.bands)]
+        # Signatures and chunk_ids of the kept chunks of the current source
+        self._signatures = []
+        self._kept_chunk_ids = []
+
+    def deduplicate(self, chunks):
+        """
+        Args:
+            chunks: List of chunk dictionaries from iter_chunk_documents
+        Returns: (kept chunks, dropped chunks). Every dropped chunk gets a
+                 'duplicate_of' key with the chunk_id of the kept chunk of the same
+                 source it duplicates, and a 'similarity' key.
+        """
+        signatures = minhash_signatures([chunk['text'] for chunk in chunks], self.num_perm)
+        rows_per_band = self.num_perm // self.bands
+        kept = []
+        dropped = []
+
+        for i, chunk in enumerate(chunks):
+            if chunk['source'] != self._source:
+                self._start_source(chunk['source'])
+            self.total_chars += len(chunk['text'])
+
+            # 1. Exact duplicates
+            text_hash = hashlib.sha1(_normalize(chunk['text']).encode("utf-8")).hexdigest()
+            if text_hash in self._exact_index:
+                dropped.append({**chunk, 'duplicate_of': self._exact_index[text_hash], 'similarity': 1.0})
+                continue
+
+            # 2. Near duplicates: kept chunks that share at least one band
+            band_keys = [
+                signatures[i, band * rows_per_band:(band + 1) * rows_per_band].tobytes()
+                for band in range(self.bands)
+            ]
+            candidates = set()
+            for bucket, key in zip(self._band_buckets, band_keys):
+                candidates.update(bucket.get(key, ()))
+
+            best_match, best_similarity = None, 0.0
+            if candidates:
+                candidate_rows = np.fromiter(candidates, dtype=np.int64)
+                similarities = (np.stack([self._signatures[row] for row in candidate_rows]) == signatures[i]).mean(axis=1)
+                best = int(similarities.argmax())
+                best_match, best_similarity = int(candidate_rows[best]), float(similarities[best])
+
+            if best_match is not None and best_similarity >= self.threshold:
+                dropped.append({**chunk, 'duplicate_of': self._kept_chunk_ids[best_match],
+                                'similarity': best_similarity})
+                continue
+
+            row = len(self._signatures)
+            self._signatures.append(signatures[i])
+            self._kept_chunk_ids.append(chunk['chunk_id'])
+            self._exact_index[text_hash] = chunk['chunk_id']
+            for bucket, key in zip(self._band_buckets, band_keys):
+                bucket.setdefault(key, []).append(row)
+            kept.append(chunk)
+
+        self.kept_count += len(kept)
+        self.dropped_count += len(dropped)
+        self.saved_chars += sum(len(chunk['text']) for chunk in dropped)
+        return kept, dropped
+
+    def print_summary(self):
+        print(f"Similarity threshold: {self.threshold} (within each source)")
+        print(f"  - Kept chunks: {self.kept_count}")
+        print(f"  - Dropped duplicates: {self.dropped_count}")
+        print(f"  - Embedding work saved: {self.dropped_count} chunks, "
+              f"{self.saved_chars} characters ({100 * self.saved_chars / max(self.total_chars, 1):.1f}%)")
+
+def deduplicate_chunks(chunks, threshold=0.9, num_perm=64, bands=16):
+    """
+    Drop exact and near-duplicate chunks of the same source (see ChunkDeduplicator).
+    Args:
+        chunks: List of chunk dictionaries from chunk_documents
+        threshold: Minimum similarity (0-1) to treat two chunks as duplicates
+        num_perm: Length of the MinHash signatures
+        bands: Number of LSH bands (num_perm must be divisible by it)
+    Returns: (kept chunks, dropped chunks), see ChunkDeduplicator.deduplicate
+    """
+    print("\n" + "=" * 25)
+    print("STEP 2b: Removing duplicate chunks")
+    print("=" * 25)
+
+    deduplicator = ChunkDeduplicator(threshold, num_perm, bands)
+    kept, dropped = deduplicator.deduplicate(chunks)
+    deduplicator.print_summary()
+    return kept, dropped
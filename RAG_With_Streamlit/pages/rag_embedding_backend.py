@@ -0,0 +1,86 @@
+import os
+from sentence_transformers import SentenceTransformer
+from dotenv import load_dotenv
+# The backend is read when this module is imported, so load the .env file here
+load_dotenv()
+
+# "torch" (default), "onnx" or "onnx-int8", e.g. set EMBEDDING_BACKEND=onnx-int8 in the .env file
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+
+# Int8 (dynamically quantized) ONNX graph inside the model folder / Hugging Face repo.
+# all-MiniLM-L6-v2 ships model_quint8_avx2.onnx, model_qint8_avx512.onnx,
+# model_qint8_avx512_vnni.onnx and model_qint8_arm64.onnx; pick the one for your CPU.
+ONNX_INT8_FILE = os.getenv("EMBEDDING_ONNX_INT8_FILE", "onnx/model_quint8_avx2.onnx")
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+def _onnx_model_kwargs(num_threads, file_name=None):
+    """
+    Build the model_kwargs of an ONNX Runtime backed SentenceTransformer.
+    Args:
+        num_threads: Intra-op threads of the ONNX Runtime session (None: all cores)
+        file_name: ONNX graph inside the model folder (None: onnx/model.onnx)
+    """
+    model_kwargs = {}
+    if file_name is not None:
+        model_kwargs["file_name"] = file_name
+    if num_threads is not None:
+        import onnxruntime
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = num_threads
+        session_options.inter_op_num_threads = 1
+        model_kwargs["session_options"] = session_options
+    return model_kwargs
+
+def load_sentence_transformer(model_name, revision=None, backend=EMBEDDING_BACKEND, num_threads=None, **kwargs):
+    """
+    Load a SentenceTransformer with the given backend.
+    Args:
+        model_name: Model name or local folder
+        revision: Model revision
+        backend: "torch" (PyTorch), "onnx" (ONNX Runtime) or
+                 "onnx-int8" (ONNX Runtime with the int8 quantized graph)
+        num_threads: Threads of the ONNX Runtime session (None: all cores), ignored for torch
+        kwargs: Passed on to SentenceTransformer (e.g. device)
+    Returns: SentenceTransformer, with the same encode() for every backend
+    """
+    if backend == "torch":
+        return SentenceTransformer(model_name, revision=revision, **kwargs)
+    if backend == "onnx":
+        # Uses onnx/model.onnx of the model, or exports it on the fly (pip install sentence-transformers[onnx])
+        return SentenceTransformer(
+            model_name,
+            revision=revision,
+            backend="onnx",
+            model_kwargs=_onnx_model_kwargs(num_threads),
+            **kwargs
+        )
+    if backend == "onnx-int8":
+        return SentenceTransformer(
+            model_name,
+            revision=revision,
+            backend="onnx",
+            model_kwargs=_onnx_model_kwargs(num_threads, ONNX_INT8_FILE),
+            **kwargs
+        )
+    raise ValueError(f"Unknown embedding backend '{backend}', use one of {BACKENDS}")
+
+def export_int8_onnx_model(model_name, output_dir, quantization_config="avx2"):
+    """
+    Export a model to ONNX and quantize it to int8, for models that do not ship
+    a quantized graph. Use output_dir as model name afterwards, and set
+    ONNX_INT8_FILE to the printed file.
+    Args:
+        model_name: Model name or local folder
+        output_dir: Folder to save the model and its ONNX graphs in
+        quantization_config: "arm64", "avx2", "avx512" or "avx512_vnni"
+    """
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    model = SentenceTransformer(model_name, backend="onnx")
+    model.save(output_dir)
+    export_dynamic_quantized_onnx_model(model, quantization_config, output_dir)
+
+    prefix = "quint8" if quantization_config == "avx2" else "qint8"
+    print(f"Exported int8 model: {output_dir}/onnx/model_{prefix}_{quantization_config}.onnx")
@@ -0,0 +1,128 @@
+import os
+import sqlite3
+import hashlib
+import threading
+import time
+import numpy as np
+
+DEFAULT_CACHE_PATH = "./embedding_cache/embeddings.sqlite"
+DEFAULT_MAX_CACHE_BYTES = 1024 * 1024 * 1024  # 1 GB of vectors
+# An eviction goes down to this fraction of the limit, so the next writes do not evict again at once
+EVICT_TO_FRACTION = 0.9
+
+_connection = None
+_lock = threading.Lock()
+# Bytes of vectors in the cache as far as this process knows (None = not counted yet).
+# Replaced entries are counted again, so it can only be too high: the table is then just scanned earlier
+_cache_bytes = None
+
+def get_cache_connection(cache_path=DEFAULT_CACHE_PATH):
+    global _connection
+
+    if _connection is None:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        # Streamlit runs the pages in different threads, access is guarded by _lock
+        _connection = sqlite3.connect(cache_path, check_same_thread=False)
+        _connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        _connection.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings(last_used)")
+        _connection.commit()
+
+    return _connection
+
+def normalize_text(text):
+    # Texts that only differ in whitespace get the same vector
+    return " ".join(text.split())
+
+def make_embedding_key(text, model_name, model_revision, backend="torch"):
+    key_text = f"{model_name}|{model_revision or 'default'}|{normalize_text(text)}"
+    if backend != "torch":
+        key_text = f"{backend}|{key_text}"
+    return hashlib.sha256(key_text.encode("utf-8")).hexdigest()
+
+def get_cached_embeddings(keys, batch_size=500):
+    """
+    Look up vectors in the cache.
+    Returns: dict key -> float32 vector for the keys found
+    """
+    found = {}
+    unique_keys = list(dict.fromkeys(keys))
+
+    with _lock:
+        connection = get_cache_connection()
+        for i in range(0, len(unique_keys), batch_size):
+            batch = unique_keys[i:i + batch_size]
+            placeholders = ",".join("?" * len(batch))
+            rows = connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+            ).fetchall()
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+
+        # Mark the hits as recently used for the eviction
+        if found:
+            now = time.time()
+            connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(now, key) for key in found]
+            )
+            connection.commit()
+
+    return found
+
+def put_cached_embeddings(keys, vectors, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """Store float32 vectors in the cache, then evict the least recently used ones if it is too big."""
+    now = time.time()
+    rows = [
+        (key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+        for key, vector in zip(keys, vectors)
+    ]
+
+    with _lock:
+        connection = get_cache_connection()
+        connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows
+        )
+        connection.commit()
+        _track_cache_write(connection, sum(len(row[1]) for row in rows), max_bytes)
+
+def _track_cache_write(connection, added_bytes, max_bytes):
+    # Keep a running size instead of summing the table on every put; the table is
+    # only scanned (and evicted) when the size is unknown or goes over max_bytes
+    global _cache_bytes
+    if _cache_bytes is None or _cache_bytes + added_bytes > max_bytes:
+        _cache_bytes = _evict(connection, max_bytes)
+    else:
+        _cache_bytes += added_bytes
+
+def _cache_size(connection):
+    return connection.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()
+
+def _evict(connection, max_bytes):
+    # Returns the bytes left in the cache
+    count, total_bytes = _cache_size(connection)
+    if total_bytes <= max_bytes or count == 0:
+        return total_bytes
+
+    # Remove enough of the oldest entries to get back under the limit (with some room)
+    average_size = total_bytes / count
+    to_remove = int((total_bytes - max_bytes * EVICT_TO_FRACTION) / average_size) + 1
+    connection.execute(
+        "DELETE FROM embeddings WHERE key IN "
+        "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (to_remove,)
+    )
+    connection.commit()
+    return _cache_size(connection)[1]
+
+def clear_embedding_cache():
+    """Remove all cached vectors."""
+    global _cache_bytes
+    with _lock:
+        _cache_bytes = 0
+        connection = get_cache_connection()
+        connection.execute("DELETE FROM embeddings")
+        connection.commit()
+        connection.execute("VACUUM")
+    print("Embedding cache cleared")
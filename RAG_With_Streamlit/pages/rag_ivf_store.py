@@ -0,0 +1,597 @@
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import numpy as np
+
+DISTANCE_SPACES = ("l2", "cosine", "ip")
+
+# Vectors handled at once when copying, so memory stays bounded
+_BLOCK_ROWS = 65536
+# Bytes of the (rows x centroids) score matrix computed at once when assigning vectors to partitions
+_ASSIGN_BLOCK_BYTES = 64 * 1024 * 1024
+# Training points per centroid that k-means needs to give useful partitions
+_POINTS_PER_CENTROID = 39
+# Largest k-means training sample (about 200 MB of 384-dimensional vectors), whatever the collection size
+_MAX_TRAINING_ROWS = 131072
+_KEY_PATTERN = re.compile(r"^\w+$")
+# A where filter matching at most this many rows is searched exactly, without the partitions
+_EXACT_FILTER_ROWS = 50000
+
+def _kmeans(vectors, k, iterations=20, seed=0):
+    # Spherical k-means (dot product assignment, normalized centroids) on an in-memory sample
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    assignments = None
+    for _ in range(iterations):
+        new_assignments = _assign(vectors, centroids)
+        if assignments is not None and np.array_equal(new_assignments, assignments):
+            break
+        assignments = new_assignments
+        # Sums per partition one dimension at a time with bincount (np.add.at is an unbuffered, slow loop)
+        sums = np.empty_like(centroids)
+        for j in range(vectors.shape[1]):
+            sums[:, j] = np.bincount(assignments, weights=vectors[:, j], minlength=k)
+        counts = np.bincount(assignments, minlength=k)
+        # Empty partitions restart from a random point
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.maximum(norms, 1e-12)
+    return centroids.astype(np.float32)
+
+def _assign(vectors, centroids):
+    # Nearest centroid of every vector, in blocks small enough that the float32 scores
+    # (and the block itself) stay within _ASSIGN_BLOCK_BYTES, however many centroids there are
+    block_rows = max(1, _ASSIGN_BLOCK_BYTES // (4 * max(centroids.shape)))
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_rows):
+        block = np.asarray(vectors[start:start + block_rows], dtype=np.float32)
+        assignments[start:start + block_rows] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+def _partition_count(rows):
+    # About 4 * sqrt(n) partitions, as many as the (capped) training sample has enough points for
+    return max(1, min(int(4 * np.sqrt(rows)), min(rows, _MAX_TRAINING_ROWS) // _POINTS_PER_CENTROID))
+
+def _where_sql(where):
+    # Chroma-style where filter as an SQL condition on the JSON metadata column
+    clauses = []
+    params = []
+    for key, condition in where.items():
+        if key in ("$and", "$or"):
+            parts = [_where_sql(part) for part in condition]
+            clauses.append("(" + f" {key[1:].upper()} ".join(clause for clause, _ in parts) + ")")
+            for _, part_params in parts:
+                params.extend(part_params)
+            continue
+
+        if not _KEY_PATTERN.match(key):
+            raise ValueError(f"Unsupported metadata key in where filter: {key}")
+        # Literal path (not a parameter), so the expression index on source can be used
+        field = f"json_extract(metadata, '$.{key}')"
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for operator, operand in condition.items():
+            if operator == "$eq":
+                clauses.append(f"{field} = ?")
+                params.append(operand)
+            elif operator == "$ne":
+                clauses.append(f"({field} IS NULL OR {field} != ?)")
+                params.append(operand)
+            elif operator in ("$in", "$nin"):
+                negate = "NOT " if operator == "$nin" else ""
+                clauses.append(f"{field} {negate}IN ({', '.join('?' * len(operand))})")
+                params.extend(operand)
+            else:
+                raise ValueError(f"Unsupported where operator: {operator}")
+    return " AND ".join(clauses) or "1", params
+
+class IvfCollection:
+    """
+    Disk-resident IVF index with the collection methods the RAG steps use
+    (upsert, query, get, delete, count), for corpora that do not fit in RAM.
+    Vectors are clustered into k-means partitions. Every upsert writes a new
+    immutable segment: its vectors sorted by partition, as memory-mapped
+    float16 codes (scanned) and float32 vectors (rescoring), plus the
+    partition offsets and a live-row bitmap. ids, documents and metadata are
+    in a SQLite table, together with the segment list, so rows never point to
+    a segment the store does not know (or the other way round) after a crash. A query scans only the nprobe partitions nearest to
+    the query in every segment, then rescores the best
+    n_results x rescore_factor candidates with the float32 vectors.
+    A background compaction merges small segments (and segments with many
+    deleted rows), and retrains the partitions when the corpus has outgrown them.
+    Open one instance per directory (get_db_collection keeps a single one).
+    """
+
+    max_batch_size = 100000
+
+    def __init__(self, name, persist_directory="./ivf_store", space="cosine", nprobe=8, rescore_factor=4,
+                 min_segment_rows=50000, max_small_segments=8):
+        if space not in DISTANCE_SPACES:
+            raise ValueError(f"Unknown distance space '{space}', use one of {DISTANCE_SPACES}")
+        self.name = name
+        self.space = space
+        self.nprobe = nprobe
+        self.rescore_factor = rescore_factor
+        self.min_segment_rows = min_segment_rows
+        self.max_small_segments = max_small_segments
+        self.directory = os.path.join(persist_directory, name)
+        os.makedirs(os.path.join(self.directory, "segments"), exist_ok=True)
+
+        # _lock guards the segment list, live bitmaps and the table; one compaction runs at a time
+        self._lock = threading.RLock()
+        self._compaction_lock = threading.Lock()
+        self._compaction_thread = None
+
+        self._conn = sqlite3.connect(os.path.join(self.directory, "rows.sqlite"), check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rows "
+                "(id TEXT PRIMARY KEY, segment INTEGER, position INTEGER, document TEXT, metadata TEXT)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS rows_location ON rows (segment, position)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS rows_source ON rows (json_extract(metadata, '$.source'))")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+
+        row = self._conn.execute("SELECT value FROM state WHERE key = 'state'").fetchone()
+        legacy_state_path = os.path.join(self.directory, "state.json")
+        if row is not None:
+            self._state = json.loads(row[0])
+        elif os.path.exists(legacy_state_path):
+            # Stores written before the state moved into SQLite
+            with open(legacy_state_path, "r", encoding="utf-8") as f:
+                self._state = json.load(f)
+            with self._conn:
+                self._save_state()
+            os.remove(legacy_state_path)
+        else:
+            self._state = {"segments": [], "next_segment": 0, "next_centroids": 0}
+
+        # Segments written by an upsert / compaction that did not commit
+        known_segments = {str(segment["id"]) for segment in self._state["segments"]}
+        for entry in os.listdir(os.path.join(self.directory, "segments")):
+            if entry not in known_segments:
+                shutil.rmtree(os.path.join(self.directory, "segments", entry), ignore_errors=True)
+        self._centroids = {
+            version: np.load(self._centroids_path(version))
+            for version in {segment["centroids"] for segment in self._state["segments"]}
+        }
+        self._segments = {segment["id"]: self._open_segment(segment["id"]) for segment in self._state["segments"]}
+
+    @property
+    def metadata(self):
+        # Same key as Chroma's collection metadata, for code that reads the distance space
+        return {"hnsw:space": self.space}
+
+    def _centroids_path(self, version):
+        return os.path.join(self.directory, f"centroids_{version}.npy")
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.directory, "segments", str(segment_id))
+
+    def _open_segment(self, segment_id):
+        path = self._segment_path(segment_id)
+        return {
+            "codes": np.load(os.path.join(path, "codes.npy"), mmap_mode="r"),
+            "vectors": np.load(os.path.join(path, "vectors.npy"), mmap_mode="r"),
+            "offsets": np.load(os.path.join(path, "offsets.npy")),
+            "live": np.load(os.path.join(path, "live.npy"), mmap_mode="r+")
+        }
+
+    def _save_state(self):
+        # Inside the caller's transaction, so the segment list commits together with the rows
+        self._conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('state', ?)",
+                           (json.dumps(self._state),))
+
+    def _train_centroids(self, sample, total_rows):
+        # Partitions for total_rows vectors, trained on a sample of them
+        k = min(_partition_count(total_rows), max(1, len(sample) // _POINTS_PER_CENTROID))
+        centroids = _kmeans(np.asarray(sample, dtype=np.float32), k)
+        with self._lock:
+            version = self._state["next_centroids"]
+            self._state["next_centroids"] += 1
+            np.save(self._centroids_path(version), centroids)
+            self._centroids[version] = centroids
+        return version
+
+    def _new_segment_id(self):
+        with self._lock:
+            segment_id = self._state["next_segment"]
+            self._state["next_segment"] += 1
+        return segment_id
+
+    def _write_segment(self, segment_id, blocks, centroids_version, total_rows):
+        """
+        Write a segment from blocks of vectors (blocks() is called twice), sorted
+        by partition. Returns the position of every input row in the segment.
+        """
+        centroids = self._centroids[centroids_version]
+        assignments = np.concatenate([_assign(block, centroids) for block in blocks()])
+        counts = np.bincount(assignments, minlength=len(centroids))
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        # Stable sort: rows keep their input order inside a partition
+        positions = np.empty(total_rows, dtype=np.int64)
+        positions[np.argsort(assignments, kind="stable")] = np.arange(total_rows)
+
+        path = self._segment_path(segment_id)
+        os.makedirs(path, exist_ok=True)
+        dim = centroids.shape[1]
+        codes = np.lib.format.open_memmap(os.path.join(path, "codes.npy"), mode="w+",
+                                          dtype=np.float16, shape=(total_rows, dim))
+        vectors = np.lib.format.open_memmap(os.path.join(path, "vectors.npy"), mode="w+",
+                                            dtype=np.float32, shape=(total_rows, dim))
+        start = 0
+        for block in blocks():
+            block = np.asarray(block, dtype=np.float32)
+            block_positions = positions[start:start + len(block)]
+            vectors[block_positions] = block
+            codes[block_positions] = block
+            start += len(block)
+        codes.flush()
+        vectors.flush()
+        del codes, vectors
+        np.save(os.path.join(path, "offsets.npy"), offsets)
+        np.save(os.path.join(path, "live.npy"), np.ones(total_rows, dtype=bool))
+        return positions
+
+    def count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+
+    def wait(self):
+        """Wait until a background compaction has finished."""
+        thread = self._compaction_thread
+        if thread is not None:
+            thread.join()
+
+    def close(self):
+        """
+        Wait for the background compaction and close the SQLite file. Call this
+        before opening the directory again (only one instance per directory).
+        """
+        self.wait()
+        self._conn.close()
+
+    def _mark_dead(self, locations):
+        for segment_id, position in locations:
+            self._segments[segment_id]["live"][position] = False
+        for segment in {segment_id for segment_id, _ in locations}:
+            self._segments[segment]["live"].flush()
+
+    def _locations_of(self, ids):
+        locations = {}
+        for start in range(0, len(ids), 900):
+            batch = ids[start:start + 900]
+            for chunk_id, segment_id, position in self._conn.execute(
+                f"SELECT id, segment, position FROM rows WHERE id IN ({', '.join('?' * len(batch))})", batch
+            ):
+                locations[chunk_id] = (segment_id, position)
+        return locations
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or len(embeddings) != len(ids):
+            raise ValueError("embeddings must be a matrix with one row per id")
+        if not ids:
+            return
+        documents = documents if documents is not None else [None] * len(ids)
+        metadatas = metadatas if metadatas is not None else [None] * len(ids)
+
+        # The last row of an id repeated in one call wins
+        last_index = {chunk_id: i for i, chunk_id in enumerate(ids)}
+        keep = sorted(last_index.values())
+        if len(keep) != len(ids):
+            embeddings = embeddings[keep]
+            ids = [ids[i] for i in keep]
+            documents = [documents[i] for i in keep]
+            metadatas = [metadatas[i] for i in keep]
+
+        with self._lock:
+            if self._centroids:
+                dim = next(iter(self._centroids.values())).shape[1]
+                if embeddings.shape[1] != dim:
+                    raise ValueError(
+                        f"Embedding dimension {embeddings.shape[1]} does not match collection dimensionality {dim}"
+                    )
+                version = max(self._centroids)
+            else:
+                version = self._train_centroids(embeddings, len(embeddings))
+
+            # Overwritten rows stay in their old segment until compaction, marked dead
+            # once the new rows are committed
+            old_locations = list(self._locations_of(ids).values())
+
+            segment_id = self._new_segment_id()
+            positions = self._write_segment(segment_id, lambda: [embeddings], version, len(embeddings))
+            self._segments[segment_id] = self._open_segment(segment_id)
+            self._state["segments"].append({"id": segment_id, "centroids": version, "rows": len(embeddings)})
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO rows (id, segment, position, document, metadata) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (chunk_id, segment_id, position, document,
+                         json.dumps(metadata) if metadata is not None else None)
+                        for chunk_id, position, document, metadata in zip(ids, positions.tolist(), documents, metadatas)
+                    ]
+                )
+                self._save_state()
+            self._mark_dead(old_locations)
+
+        self._compact_in_background_if_needed()
+
+    def _rows_result(self, records, include):
+        # records: (id, segment, position, document, metadata json) tuples
+        result = {"ids": [record[0] for record in records]}
+        result["documents"] = [record[3] for record in records] if "documents" in include else None
+        result["metadatas"] = [json.loads(record[4]) if record[4] else None for record in records] \
+            if "metadatas" in include else None
+        if "embeddings" in include:
+            dim = next(iter(self._centroids.values())).shape[1] if self._centroids else 0
+            embeddings = np.empty((len(records), dim), dtype=np.float32)
+            for i, record in enumerate(records):
+                embeddings[i] = self._segments[record[1]]["vectors"][record[2]]
+            result["embeddings"] = embeddings
+        else:
+            result["embeddings"] = None
+        return result
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("metadatas", "documents")):
+        with self._lock:
+            where_clause, params = _where_sql(where) if where else ("1", [])
+            if ids is not None:
+                found = {}
+                for start in range(0, len(ids), 900):
+                    batch = ids[start:start + 900]
+                    for record in self._conn.execute(
+                        f"SELECT id, segment, position, document, metadata FROM rows "
+                        f"WHERE id IN ({', '.join('?' * len(batch))}) AND {where_clause}",
+                        batch + params
+                    ):
+                        found[record[0]] = record
+                records = [found[chunk_id] for chunk_id in ids if chunk_id in found]
+                records = records[offset or 0:]
+                if limit is not None:
+                    records = records[:limit]
+            else:
+                records = self._conn.execute(
+                    f"SELECT id, segment, position, document, metadata FROM rows WHERE {where_clause} "
+                    f"ORDER BY rowid LIMIT ? OFFSET ?",
+                    params + [-1 if limit is None else limit, offset or 0]
+                ).fetchall()
+            return self._rows_result(records, include)
+
+    def delete(self, ids=None, where=None):
+        with self._lock:
+            if ids is None and not where:
+                raise ValueError("delete needs ids or a where filter")
+            records = self.get(ids=ids, where=where, include=())["ids"]
+            locations = self._locations_of(records)
+            self._mark_dead(list(locations.values()))
+            with self._conn:
+                self._conn.executemany("DELETE FROM rows WHERE id = ?", [(chunk_id,) for chunk_id in records])
+
+    def _distances(self, query, vectors):
+        scores = vectors @ query
+        if self.space == "l2":
+            return float(np.dot(query, query)) + np.einsum("ij,ij->i", vectors, vectors) - 2 * scores
+        if self.space == "cosine":
+            norms = np.linalg.norm(vectors, axis=1) * max(float(np.linalg.norm(query)), 1e-12)
+            return 1 - scores / np.maximum(norms, 1e-12)
+        return 1 - scores
+
+    def _allowed_locations(self, locations):
+        # Rows matching a where filter, as a bitmap per segment
+        allowed = {segment_id: np.zeros(len(segment["live"]), dtype=bool)
+                   for segment_id, segment in self._segments.items()}
+        for segment_id, position in locations:
+            allowed[segment_id][position] = True
+        return allowed
+
+    def _search_exact(self, query, n_results, locations):
+        # Exact search over a few filtered rows (e.g. the chunks of some sources)
+        if not locations:
+            return []
+        vectors = np.empty((len(locations), len(query)), dtype=np.float32)
+        for i, (segment_id, position) in enumerate(locations):
+            vectors[i] = self._segments[segment_id]["vectors"][position]
+        distances = self._distances(query, vectors)
+        order = np.argsort(distances, kind="stable")[:n_results]
+        return [(locations[i][0], locations[i][1], float(distances[i])) for i in order]
+
+    def _search(self, query, n_results, allowed):
+        # Coarse scan of the probed partitions, then exact rescoring of the best candidates
+        candidate_segments = []
+        candidate_positions = []
+        candidate_scores = []
+        probes = {
+            version: np.argsort(-(centroids @ query))[:self.nprobe]
+            for version, centroids in self._centroids.items()
+        }
+        for segment in self._state["segments"]:
+            arrays = self._segments[segment["id"]]
+            live = arrays["live"] if allowed is None else allowed[segment["id"]]
+            for partition in probes[segment["centroids"]]:
+                start, end = arrays["offsets"][partition], arrays["offsets"][partition + 1]
+                if start == end:
+                    continue
+                positions = np.arange(start, end)[live[start:end]]
+                if len(positions) == 0:
+                    continue
+                codes = arrays["codes"][start:end][positions - start]
+                candidate_scores.append(codes.astype(np.float32) @ query)
+                candidate_positions.append(positions)
+                candidate_segments.append(np.full(len(positions), segment["id"]))
+
+        if not candidate_scores:
+            return []
+        scores = np.concatenate(candidate_scores)
+        positions = np.concatenate(candidate_positions)
+        segments = np.concatenate(candidate_segments)
+
+        shortlist = min(len(scores), n_results * self.rescore_factor)
+        best = np.argpartition(-scores, shortlist - 1)[:shortlist]
+        vectors = np.empty((shortlist, len(query)), dtype=np.float32)
+        for i, index in enumerate(best):
+            vectors[i] = self._segments[segments[index]]["vectors"][positions[index]]
+        distances = self._distances(query, vectors)
+        order = np.argsort(distances, kind="stable")[:n_results]
+        return [(int(segments[best[i]]), int(positions[best[i]]), float(distances[i])) for i in order]
+
+    def query(self, query_embeddings, n_results=10, where=None,
+              include=("metadatas", "documents", "distances")):
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        if query_embeddings.ndim == 1:
+            query_embeddings = query_embeddings.reshape(1, -1)
+
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": [], "embeddings": []}
+        with self._lock:
+            allowed = None
+            exact_locations = None
+            if where:
+                where_clause, params = _where_sql(where)
+                locations = self._conn.execute(
+                    f"SELECT segment, position FROM rows WHERE {where_clause} ORDER BY segment, position", params
+                ).fetchall()
+                if len(locations) <= _EXACT_FILTER_ROWS:
+                    exact_locations = locations
+                else:
+                    allowed = self._allowed_locations(locations)
+
+            for query in query_embeddings:
+                if exact_locations is not None:
+                    hits = self._search_exact(query, n_results, exact_locations)
+                else:
+                    hits = self._search(query, n_results, allowed)
+                records = []
+                distances = []
+                for segment_id, position, distance in hits:
+                    record = self._conn.execute(
+                        "SELECT id, segment, position, document, metadata FROM rows WHERE segment = ? AND position = ?",
+                        (segment_id, position)
+                    ).fetchone()
+                    # A row overwritten just before a crash can still be live in its old segment
+                    if record is not None:
+                        records.append(record)
+                        distances.append(distance)
+                found = self._rows_result(records, include)
+                result["ids"].append(found["ids"])
+                result["documents"].append(found["documents"])
+                result["metadatas"].append(found["metadatas"])
+                result["embeddings"].append(found["embeddings"])
+                result["distances"].append(distances)
+
+        for key in ("documents", "metadatas", "embeddings", "distances"):
+            if key not in include:
+                result[key] = None
+        return result
+
+    def _segments_to_compact(self):
+        # Small segments, and segments where at least half of the rows are deleted
+        small = []
+        for segment in self._state["segments"]:
+            live_rows = int(np.count_nonzero(self._segments[segment["id"]]["live"]))
+            if live_rows < self.min_segment_rows or live_rows * 2 <= segment["rows"]:
+                small.append(segment)
+        return small
+
+    def _needs_retraining(self):
+        # The latest partitions were trained on far fewer vectors than the collection holds now
+        return len(self._centroids[max(self._centroids)]) * 4 <= _partition_count(self.count())
+
+    def _compact_in_background_if_needed(self):
+        with self._lock:
+            if len(self._segments_to_compact()) <= self.max_small_segments and not self._needs_retraining():
+                return
+            if self._compaction_thread is not None and self._compaction_thread.is_alive():
+                return
+            self._compaction_thread = threading.Thread(target=self.compact, name="ivf-compaction", daemon=True)
+            self._compaction_thread.start()
+
+    def compact(self):
+        """
+        Merge small segments (or, when the partitions are too few for the
+        collection, all segments with new partitions) into one segment.
+        Reads and writes happen outside the main lock, so queries and upserts
+        keep running; rows deleted meanwhile are marked dead in the new segment.
+        """
+        with self._compaction_lock:
+            with self._lock:
+                if not self._state["segments"]:
+                    return
+                retrain = self._needs_retraining()
+                sources = list(self._state["segments"]) if retrain else self._segments_to_compact()
+                if len(sources) < 2 and not retrain:
+                    return
+                arrays = {segment["id"]: self._segments[segment["id"]] for segment in sources}
+                # Snapshot of the live rows being copied
+                copied = {segment_id: np.flatnonzero(np.array(segment["live"]))
+                          for segment_id, segment in arrays.items()}
+                version = max(self._centroids)
+
+            total_rows = sum(len(positions) for positions in copied.values())
+            if total_rows == 0:
+                # Only deleted rows left: nothing to copy
+                self._drop_segments(set(arrays))
+                return
+
+            def blocks():
+                for source_id, source_positions in copied.items():
+                    for start in range(0, len(source_positions), _BLOCK_ROWS):
+                        yield arrays[source_id]["vectors"][source_positions[start:start + _BLOCK_ROWS]]
+
+            if retrain:
+                # Random sample of at most 256 points per partition and _MAX_TRAINING_ROWS in all,
+                # read block by block
+                sample_size = min(total_rows, 256 * _partition_count(total_rows), _MAX_TRAINING_ROWS)
+                rng = np.random.default_rng(0)
+                sample = np.concatenate([block[rng.random(len(block)) < sample_size / total_rows]
+                                         for block in blocks()])
+                version = self._train_centroids(sample if len(sample) else next(blocks()), total_rows)
+
+            segment_id = self._new_segment_id()
+            positions = self._write_segment(segment_id, blocks, version, total_rows)
+            new_segment = self._open_segment(segment_id)
+
+            with self._lock:
+                moves = []
+                start = 0
+                for source_id, source_positions in copied.items():
+                    new_positions = positions[start:start + len(source_positions)]
+                    start += len(source_positions)
+                    # Deleted or overwritten while compacting
+                    still_live = np.array(arrays[source_id]["live"][source_positions])
+                    new_segment["live"][new_positions[~still_live]] = False
+                    moves.extend(zip(new_positions[still_live].tolist(), [source_id] * int(still_live.sum()),
+                                     source_positions[still_live].tolist()))
+                new_segment["live"].flush()
+                self._state["segments"].append({"id": segment_id, "centroids": version, "rows": total_rows})
+                self._segments[segment_id] = new_segment
+                # The moved rows and the new segment list commit in one transaction
+                self._drop_segments(set(arrays), [
+                    ("UPDATE rows SET segment = ?, position = ? WHERE segment = ? AND position = ?",
+                     [(segment_id, new_position, source_id, old_position)
+                      for new_position, source_id, old_position in moves])
+                ])
+
+    def _drop_segments(self, segment_ids, statements=()):
+        # Remove merged segments, and the partitions no segment uses any more
+        # (statements: (sql, rows) run in the same transaction as the segment list update)
+        with self._lock:
+            self._state["segments"] = [segment for segment in self._state["segments"]
+                                       if segment["id"] not in segment_ids]
+            for segment_id in segment_ids:
+                del self._segments[segment_id]
+            with self._conn:
+                for sql, rows in statements:
+                    self._conn.executemany(sql, rows)
+                self._save_state()
+
+            used_versions = {segment["centroids"] for segment in self._state["segments"]}
+            for unused in set(self._centroids) - used_versions - {max(self._centroids)}:
+                del self._centroids[unused]
+                os.remove(self._centroids_path(unused))
+
+        for segment_id in segment_ids:
+            shutil.rmtree(self._segment_path(segment_id), ignore_errors=True)
@@ -0,0 +1,168 @@
+import json
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+class ValueTooLarge(Exception):
+    pass
+
+class _JsonStreamReader:
+    # Keeps only a small text buffer of the file, already parsed text is dropped
+
+    def __init__(self, file_obj, read_size):
+        self.file_obj = file_obj
+        self.read_size = read_size
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self, size=None):
+        data = self.file_obj.read(size or self.read_size)
+        if not data:
+            self.eof = True
+            return False
+        self.text = self.text[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character ("" at the end of the file)."""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.read_more():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Invalid JSON: expected '{char}' but found '{self.peek()}'")
+        self.pos += 1
+
+    def decode_value(self, max_chars=None):
+        """
+        Decode the next JSON value, reading more of the file until it is complete.
+        With max_chars, raises ValueTooLarge (without consuming anything) for a value
+        whose text is longer, so a big array or object can be walked item by item instead.
+        """
+        self.peek()
+        read_size = self.read_size
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if max_chars is not None and len(self.text) - self.pos > max_chars:
+                    raise ValueTooLarge()
+                # Value not complete yet: read bigger blocks so large items need few retries
+                read_size *= 2
+                if not self.read_more(read_size):
+                    raise
+                continue
+
+            # A number cut at the end of the buffer (e.g. "12" of "12.5") continues in the next block
+            if isinstance(value, (int, float)) and not self.eof:
+                if end >= len(self.text) or self.text[end] not in _WHITESPACE + ",]}":
+                    if self.read_more():
+                        continue
+
+            if max_chars is not None and end - self.pos > max_chars and isinstance(value, (list, dict)):
+                raise ValueTooLarge()
+            self.pos = end
+            return value
+
+def _nest(path, value):
+    # Put a value back under the object keys it was found at: ["a", "b"] -> {"a": {"b": value}}
+    for key in reversed(path):
+        value = {key: value}
+    return value
+
+def _iter_container(reader, path, max_record_chars):
+    # Walk the array / object at the reader position and yield its items
+    if reader.peek() == "[":
+        reader.pos += 1
+        if reader.peek() == "]":
+            reader.pos += 1
+            return
+        while True:
+            yield from _iter_value(reader, path, max_record_chars)
+            if reader.peek() == ",":
+                reader.pos += 1
+            else:
+                reader.expect("]")
+                return
+
+    reader.expect("{")
+    if reader.peek() == "}":
+        reader.pos += 1
+        return
+    while True:
+        key = reader.decode_value()
+        reader.expect(":")
+        yield from _iter_value(reader, path + [key], max_record_chars)
+        if reader.peek() == ",":
+            reader.pos += 1
+        else:
+            reader.expect("}")
+            return
+
+def _iter_value(reader, path, max_record_chars):
+    # One item, unless it is too large: then arrays / objects are walked and long strings split
+    try:
+        value = reader.decode_value(max_record_chars)
+    except ValueTooLarge:
+        if reader.peek() in ("[", "{"):
+            yield from _iter_container(reader, path, max_record_chars)
+            return
+        # A string has no items to walk: it is read whole and split below
+        value = reader.decode_value()
+
+    if isinstance(value, str) and len(value) > max_record_chars:
+        for start in range(0, len(value), max_record_chars):
+            yield _nest(path, value[start:start + max_record_chars])
+    else:
+        yield _nest(path, value)
+
+def iter_json_items(file_obj, read_size=64 * 1024, max_record_chars=16 * 1024):
+    """
+    Yield the items of a JSON file one at a time without loading the whole file.
+    Arrays yield their elements, objects yield {key: value} for every member,
+    any other value is yielded as it is. An item longer than max_record_chars is
+    not yielded whole: an array or object is walked the same way (a member array,
+    e.g. {"records": [...]}, yields {"records": element} for every element) and a
+    long string is split into pieces, so memory stays bounded by max_record_chars.
+    Args:
+        file_obj: File opened in text mode
+        read_size: Number of characters read from the file at once
+        max_record_chars: Largest item (as JSON text) yielded whole
+    Returns: Generator of parsed items
+    """
+    reader = _JsonStreamReader(file_obj, read_size)
+    first_char = reader.peek()
+
+    if first_char in ("[", "{"):
+        yield from _iter_container(reader, [], max_record_chars)
+    elif first_char:
+        yield from _iter_value(reader, [], max_record_chars)
+
+def iter_json_record_groups(file_obj, records_per_group=50, max_record_chars=16 * 1024):
+    """
+    Stream a JSON file as groups of compact one-line records.
+    Args:
+        file_obj: File opened in text mode
+        records_per_group: Number of items per group
+        max_record_chars: Largest item kept as one record (see iter_json_items)
+    Returns: Generator of (text, first record number, last record number),
+             record numbers start at 1
+    """
+    group = []
+    record_start = 1
+    for record_number, item in enumerate(iter_json_items(file_obj, max_record_chars=max_record_chars), start=1):
+        group.append(json.dumps(item, ensure_ascii=False, separators=(",", ":")))
+        if len(group) == records_per_group:
+            yield "\n".join(group), record_start, record_number
+            group = []
+            record_start = record_number + 1
+
+    if group:
+        yield "\n".join(group), record_start, record_start + len(group) - 1
@@ -0,0 +1,191 @@
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+# Words, and identifiers joined by - . / _ (account codes, SKUs, dates) kept as one token
+_TOKEN_PATTERN = re.compile(r"\w+(?:[-./]\w+)*")
+
+def tokenize(text):
+    # Lowercased tokens; a compound identifier also gives its parts, so "SKU-1042" matches "sku-1042" and "1042"
+    tokens = []
+    for token in _TOKEN_PATTERN.findall((text or "").lower()):
+        tokens.append(token)
+        parts = re.split(r"[-./]", token)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part)
+    return tokens
+
+class KeywordIndex:
+    """
+    BM25 inverted index of the chunk texts, in a SQLite file (<name>_keywords.sqlite).
+    Tables: chunks (integer doc, id, source, length), terms (integer term id, term),
+    postings (term id, doc, term frequency) and stats (chunk count, total length).
+    Postings only hold integers, so the index stays a fraction of the corpus size;
+    chunk ids are looked up for the final top_k only. Upserts and deletes only
+    touch the postings of the chunks they change.
+    """
+
+    def __init__(self, name, persist_directory="./keyword_index", k1=1.2, b=0.75):
+        self.name = name
+        self.k1 = k1
+        self.b = b
+        os.makedirs(persist_directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(persist_directory, f"{name}_keywords.sqlite"),
+                                     check_same_thread=False)
+        with self._conn:
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(chunks)")]
+            if columns and "doc" not in columns:
+                # Index with text ids in the postings: dropped, get_keyword_index builds it again
+                for table in ("postings", "chunks", "stats"):
+                    self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks (doc INTEGER PRIMARY KEY, id TEXT UNIQUE, source TEXT, length INTEGER)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS terms (term_id INTEGER PRIMARY KEY, term TEXT UNIQUE)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS postings (term INTEGER, doc INTEGER, tf INTEGER, PRIMARY KEY (term, doc)) "
+                "WITHOUT ROWID"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value INTEGER)")
+            self._conn.execute("INSERT OR IGNORE INTO stats VALUES ('chunk_count', 0), ('total_length', 0)")
+
+    def _stats(self):
+        return dict(self._conn.execute("SELECT key, value FROM stats"))
+
+    def _term_ids(self, terms, create=False):
+        # term -> term id, adding the missing terms when create is set
+        terms = list(terms)
+        if create:
+            self._conn.executemany("INSERT OR IGNORE INTO terms (term) VALUES (?)", [(term,) for term in terms])
+        term_ids = {}
+        for start in range(0, len(terms), 900):
+            batch = terms[start:start + 900]
+            term_ids.update(self._conn.execute(
+                f"SELECT term, term_id FROM terms WHERE term IN ({', '.join('?' * len(batch))})", batch
+            ))
+        return term_ids
+
+    def _delete_ids(self, ids):
+        # Remove chunks and their postings, keeping the stats in step (inside the caller's transaction)
+        removed_count = 0
+        removed_length = 0
+        for chunk_id in ids:
+            row = self._conn.execute("SELECT doc, length FROM chunks WHERE id = ?", (chunk_id,)).fetchone()
+            if row is None:
+                continue
+            self._conn.execute("DELETE FROM postings WHERE doc = ?", (row[0],))
+            self._conn.execute("DELETE FROM chunks WHERE doc = ?", (row[0],))
+            removed_count += 1
+            removed_length += row[1]
+        self._conn.execute("UPDATE stats SET value = value - ? WHERE key = 'chunk_count'", (removed_count,))
+        self._conn.execute("UPDATE stats SET value = value - ? WHERE key = 'total_length'", (removed_length,))
+        return removed_count
+
+    def count(self):
+        with self._lock:
+            return self._stats()["chunk_count"]
+
+    def upsert(self, ids, documents, metadatas=None):
+        metadatas = metadatas if metadatas is not None else [None] * len(ids)
+        with self._lock, self._conn:
+            self._delete_ids(ids)
+            term_counts = [Counter(tokenize(document)) for document in documents]
+            term_ids = self._term_ids(set().union(*term_counts), create=True)
+            total_length = 0
+            for chunk_id, terms, metadata in zip(ids, term_counts, metadatas):
+                length = sum(terms.values())
+                doc = self._conn.execute("INSERT INTO chunks (id, source, length) VALUES (?, ?, ?)",
+                                         (chunk_id, (metadata or {}).get("source"), length)).lastrowid
+                self._conn.executemany("INSERT INTO postings (term, doc, tf) VALUES (?, ?, ?)",
+                                       [(term_ids[term], doc, tf) for term, tf in terms.items()])
+                total_length += length
+            self._conn.execute("UPDATE stats SET value = value + ? WHERE key = 'chunk_count'", (len(ids),))
+            self._conn.execute("UPDATE stats SET value = value + ? WHERE key = 'total_length'", (total_length,))
+
+    def delete(self, ids=None, sources=None):
+        """Delete chunks by id and / or all chunks of the given sources. Returns the number deleted."""
+        with self._lock, self._conn:
+            ids = list(ids or [])
+            for source in sources or []:
+                ids.extend(chunk_id for (chunk_id,) in
+                           self._conn.execute("SELECT id FROM chunks WHERE source = ?", (source,)))
+            return self._delete_ids(ids)
+
+    def search(self, query, top_k=10, sources=None, time_budget=None):
+        """
+        Rank chunks by BM25 score for the query.
+        Args:
+            query: Query text
+            top_k: Number of chunk ids to return
+            sources: Only score chunks of these sources (None = all)
+            time_budget: Seconds to spend; query terms are scored rarest first, and the
+                         terms left when the budget runs out are skipped (the rarest is always scored)
+        Returns: List of (chunk id, score), best first
+        """
+        started = time.perf_counter()
+        with self._lock:
+            stats = self._stats()
+            if stats["chunk_count"] == 0:
+                return []
+            average_length = stats["total_length"] / stats["chunk_count"]
+
+            term_ids = self._term_ids(dict.fromkeys(tokenize(query)))
+            document_frequency = {
+                term_id: self._conn.execute("SELECT COUNT(*) FROM postings WHERE term = ?", (term_id,)).fetchone()[0]
+                for term_id in term_ids.values()
+            }
+            source_filter = ""
+            source_params = []
+            if sources:
+                source_filter = f" AND c.source IN ({', '.join('?' * len(sources))})"
+                source_params = list(sources)
+
+            # Every term is scored (an identifier can be in most chunks of a small corpus or a
+            # spreadsheet), rarest first: the common terms with the longest postings are the
+            # ones left out when the time budget runs out
+            terms = sorted((term_id for term_id, df in document_frequency.items() if df > 0),
+                           key=document_frequency.get)
+
+            scores = {}
+            for i, term_id in enumerate(terms):
+                if i > 0 and time_budget is not None and time.perf_counter() - started > time_budget:
+                    break
+                df = document_frequency[term_id]
+                idf = math.log(1 + (stats["chunk_count"] - df + 0.5) / (df + 0.5))
+                for doc, tf, length in self._conn.execute(
+                    "SELECT p.doc, p.tf, c.length FROM postings p JOIN chunks c ON c.doc = p.doc "
+                    f"WHERE p.term = ?{source_filter}", [term_id] + source_params
+                ):
+                    norm = self.k1 * (1 - self.b + self.b * length / average_length)
+                    scores[doc] = scores.get(doc, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+            if not best:
+                return []
+            chunk_ids = dict(self._conn.execute(
+                f"SELECT doc, id FROM chunks WHERE doc IN ({', '.join('?' * len(best))})", [doc for doc, _ in best]
+            ))
+        return [(chunk_ids[doc], score) for doc, score in best]
+
+_keyword_indexes = {}
+
+def get_keyword_index(collection, persist_directory="./keyword_index"):
+    """
+    Return the keyword index of a chunk collection. A collection stored before the
+    index existed is indexed from its stored documents on first use.
+    """
+    if collection.name not in _keyword_indexes:
+        keyword_index = KeywordIndex(collection.name, persist_directory)
+        if keyword_index.count() == 0 and collection.count() > 0:
+            stored = collection.get(include=["documents", "metadatas"])
+            print(f"Building the keyword index of {len(stored['ids'])} chunks...")
+            keyword_index.upsert(stored["ids"], stored["documents"], stored["metadatas"])
+        _keyword_indexes[collection.name] = keyword_index
+    return _keyword_indexes[collection.name]
@@ -1,4 +1,37 @@
+import hashlib
+import re
+import numpy as np
+
+# A sentence ends with . ! or ? followed by whitespace, a paragraph with an empty line
+_BOUNDARY_PATTERN = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+_WORD_BOUNDARY_PATTERN = re.compile(r"\s+")
+_NON_WHITESPACE_PATTERN = re.compile(r"\S")
+_TRAILING_WHITESPACE_PATTERN = re.compile(r"\s+\Z")
+
+
+class LazyChunk(dict):
+    """
+    Chunk dictionary that holds only the offsets of its text: chunk['text'] is
+    sliced from the document content the first time it is read (and kept).
+    """
+
+    def __init__(self, content, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._content = content
+
+    def __missing__(self, key):
+        if key != 'text' or self._content is None:
+            raise KeyError(key)
+        text = self['text'] = self._content[self['start']:self['end']]
+        self._content = None
+        return text
+
+
 def chunk_text(text, chunk_size=500, overlap=50):
+    if overlap >= chunk_size:
+        # The window would never move forward
+        raise ValueError("overlap must be smaller than chunk_size")
+
     chunks = []
     start = 0
 
@@ -13,34 +46,384 @@ def chunk_text(text, chunk_size=500, overlap=50):
     return chunks
 
 
-def chunk_documents(documents, chunk_size=500, overlap=50):
+def find_boundaries(text, pattern=_BOUNDARY_PATTERN):
+    """Return a sorted NumPy array of the positions where a sentence or paragraph starts (one regex pass)."""
+    return np.fromiter((m.end() for m in pattern.finditer(text)), dtype=np.int64)
+
+
+def _last_boundary(boundaries, low, high):
+    # Last boundary b with low < b <= high, or None
+    i = np.searchsorted(boundaries, high, side="right") - 1
+    if i >= 0 and boundaries[i] > low:
+        return int(boundaries[i])
+    return None
+
+
+def _first_boundary(boundaries, low, high):
+    # First boundary b with low <= b < high, or None
+    i = np.searchsorted(boundaries, low, side="left")
+    if i < len(boundaries) and boundaries[i] < high:
+        return int(boundaries[i])
+    return None
+
+
+def chunk_spans(text, chunk_size=500, overlap=50, snap_to_boundaries=True):
+    """
+    Compute chunk windows as character offsets, without copying any text.
+    With snap_to_boundaries, a window ends at the last sentence / paragraph
+    boundary inside it (if that keeps at least half of the chunk size, else
+    at the last word boundary) and the overlap starts at a boundary too.
+    Args:
+        text: Text to chunk
+        chunk_size: Maximum chunk size in characters
+        overlap: Overlap between neighbouring chunks in characters
+        snap_to_boundaries: Move windows to sentence / paragraph boundaries
+    Returns: (starts, ends) NumPy arrays, text[starts[i]:ends[i]] is chunk i
+             (leading / trailing whitespace excluded)
+    """
+    if overlap >= chunk_size:
+        # The window would never move forward
+        raise ValueError("overlap must be smaller than chunk_size")
+
+    # Sentence / paragraph boundaries first, word boundaries as fallback
+    boundary_levels = []
+    if snap_to_boundaries:
+        boundary_levels = [find_boundaries(text), find_boundaries(text, _WORD_BOUNDARY_PATTERN)]
+
+    text_length = len(text)
+    starts = []
+    ends = []
+
+    start = 0
+    while start < text_length:
+        end = min(start + chunk_size, text_length)
+
+        if end < text_length:
+            for boundaries in boundary_levels:
+                snapped_end = _last_boundary(boundaries, start + chunk_size // 2, end)
+                if snapped_end is not None:
+                    end = snapped_end
+                    break
+
+        # Whitespace at both ends of the window is left out (regex searches, not a loop per character)
+        first = _NON_WHITESPACE_PATTERN.search(text, start, end)
+        if first is not None:
+            trailing = _TRAILING_WHITESPACE_PATTERN.search(text, first.start(), end)
+            starts.append(first.start())
+            ends.append(trailing.start() if trailing is not None else end)
+        if end >= text_length:
+            break
+
+        next_start = max(end - overlap, start + 1)
+        for boundaries in boundary_levels:
+            snapped_start = _first_boundary(boundaries, next_start, end)
+            if snapped_start is not None:
+                next_start = snapped_start
+                break
+        start = next_start
+
+    return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+
+def chunk_texts_by_tokens(texts, tokenizer, max_tokens, overlap_tokens=32):
+    """
+    Chunk texts by tokens of the embedding model, so no chunk is truncated by the model.
+    All texts are tokenized together in one batched call of the (fast) tokenizer.
+    Windows are moved to word boundaries, so a chunk never starts or ends inside a word.
+    Args:
+        texts: List of texts
+        tokenizer: Fast Hugging Face tokenizer (e.g. get_embedder().tokenizer)
+        max_tokens: Maximum number of tokens per chunk (without special tokens)
+        overlap_tokens: Overlap between neighbouring chunks in tokens
+    Returns: For every text a list of (chunk text, start, end) with character offsets
+    """
+    if overlap_tokens >= max_tokens:
+        raise ValueError("overlap_tokens must be smaller than max_tokens")
+    if not getattr(tokenizer, "is_fast", False):
+        raise ValueError("Token chunking needs a fast tokenizer (for the character offsets)")
+
+    encodings = tokenizer(
+        texts,
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+        verbose=False
+    )
+
+    all_chunks = []
+    for text_idx, text in enumerate(texts):
+        offsets = encodings["offset_mapping"][text_idx]
+        word_ids = encodings.word_ids(text_idx)
+        num_tokens = len(offsets)
+
+        chunks = []
+        start = 0
+        while start < num_tokens:
+            end = min(start + max_tokens, num_tokens)
+
+            # Do not cut a word at the end of the window (unless the word fills the whole window)
+            if end < num_tokens:
+                word_end = end
+                while word_end > start + 1 and word_ids[word_end] == word_ids[word_end - 1]:
+                    word_end -= 1
+                if word_end > start + 1:
+                    end = word_end
+
+            char_start, char_end = offsets[start][0], offsets[end - 1][1]
+            chunks.append((text[char_start:char_end], char_start, char_end))
+
+            if end >= num_tokens:
+                break
+
+            # Start the next window at the beginning of a word
+            next_start = max(end - overlap_tokens, start + 1)
+            while next_start > start + 1 and word_ids[next_start] == word_ids[next_start - 1]:
+                next_start -= 1
+            start = next_start
+
+        all_chunks.append(chunks)
+
+    return all_chunks
+
+
+def chunk_row_group(text, row_start, chunk_size=500, has_header=True, line_lengths=None, split_row=None):
+    """
+    Chunk a table row group (header line + one line per row) between rows.
+    Every chunk starts with the header line, so it can be understood on its own.
+    Args:
+        text: Row group text from iter_table_row_groups (or a group of
+              JSON records from iter_json_record_groups, without header)
+        row_start: Row number of the first row in the group
+        chunk_size: Maximum chunk size in characters (in the unit of line_lengths)
+        has_header: Whether the first line is a header line
+        line_lengths: Size of every line in another unit (e.g. tokens),
+                      by default the number of characters
+        split_row: Function (row, size) -> list of row pieces of at most size, used
+                   for a row longer than a chunk; every piece gets the header line
+                   (None = a longer row still becomes its own chunk)
+    Returns: List of (chunk text, first row, last row, piece), piece is the
+             number of the piece of a split row (0, 1, ...), else None
+    """
+    lines = text.split("\n")
+    if line_lengths is None:
+        # +1 for the newline between lines
+        line_lengths = [len(line) + 1 for line in lines]
+
+    if has_header:
+        header, rows = [lines[0]], lines[1:]
+        header_length, row_lengths = line_lengths[0], line_lengths[1:]
+    else:
+        header, rows = [], lines
+        header_length, row_lengths = 0, line_lengths
+
+    chunks = []
+    current_rows = []
+    current_length = header_length
+    first_row = row_start
+
+    for row_number, (row, row_length) in enumerate(zip(rows, row_lengths), start=row_start):
+        if current_rows and current_length + row_length > chunk_size:
+            chunks.append(("\n".join(header + current_rows), first_row, row_number - 1, None))
+            current_rows = []
+            current_length = header_length
+            first_row = row_number
+
+        if split_row is not None and header_length + row_length > chunk_size:
+            # The row alone does not fit: split it, the pieces keep the row number and are numbered
+            # (at least half a chunk per piece, even with a very long header)
+            pieces = split_row(row, max(chunk_size - header_length, chunk_size // 2))
+            for piece_number, piece in enumerate(pieces):
+                chunks.append(("\n".join(header + [piece]), row_number, row_number, piece_number))
+            first_row = row_number + 1
+            continue
+
+        current_rows.append(row)
+        current_length += row_length
+
+    if current_rows:
+        chunks.append(("\n".join(header + current_rows), first_row, first_row + len(current_rows) - 1, None))
+
+    return chunks
+
+
+def _iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _chunk_batch(batch, chunk_size, overlap, tokenizer, snap_to_boundaries):
+    # Returns for every document of the batch the list of its chunks as dictionaries
+    # with 'text' and 'start' / 'end' (or 'row_start' / 'row_end' for row groups)
+    if tokenizer is not None:
+        # One batched tokenizer call for all normal documents of the batch
+        plain_texts = [doc['content'] for doc in batch if 'row_start' not in doc]
+        token_chunks = iter(chunk_texts_by_tokens(plain_texts, tokenizer, chunk_size, overlap) if plain_texts else [])
+
+    results = []
+    for doc in batch:
+        if 'row_start' in doc:
+            # Table row groups / JSON record groups are cut between rows; only a row longer
+            # than a chunk is split, so the embedder does not truncate it
+            has_header = doc['file_type'] != 'json'
+            line_lengths = None
+            if tokenizer is not None:
+                lines = doc['content'].split("\n")
+                line_lengths = [len(ids) for ids in tokenizer(lines, add_special_tokens=False)["input_ids"]]
+                split_row = lambda row, size: [
+                    text for text, _, _ in chunk_texts_by_tokens([row], tokenizer, size, min(overlap, size // 2))[0]
+                ]
+            else:
+                split_row = lambda row, size: [
+                    row[start:end] for start, end in zip(*chunk_spans(row, size, min(overlap, size // 2),
+                                                                      snap_to_boundaries))
+                ]
+            row_chunks = chunk_row_group(doc['content'], doc['row_start'], chunk_size, has_header,
+                                         line_lengths, split_row)
+            results.append([
+                {'text': text, 'row_start': first_row, 'row_end': last_row,
+                 **({'row_piece': piece} if piece is not None else {})}
+                for text, first_row, last_row, piece in row_chunks
+            ])
+        elif tokenizer is not None:
+            results.append([
+                {'text': text, 'start': start, 'end': end}
+                for text, start, end in next(token_chunks)
+            ])
+        else:
+            # Only the offsets: the text is sliced when a consumer reads it (see LazyChunk)
+            starts, ends = chunk_spans(doc['content'], chunk_size, overlap, snap_to_boundaries)
+            results.append([{'start': int(start), 'end': int(end)} for start, end in zip(starts, ends)])
+
+    return results
+
+
+def iter_chunk_documents(documents, chunk_size=500, overlap=50, tokenizer=None, batch_size=32,
+                         snap_to_boundaries=True):
+    """
+    Chunk documents one at a time and yield the chunks as they are created.
+    Args:
+        documents: List or generator of document dictionaries
+                   (e.g. from iter_documents_from_folder)
+        chunk_size: Chunk size in characters (in tokens when a tokenizer is given)
+        overlap: Overlap between neighbouring chunks in characters (or tokens)
+        tokenizer: Tokenizer of the embedding model to chunk by tokens
+                   (see chunk_texts_by_tokens), None to chunk by characters
+        batch_size: Number of documents tokenized together in token mode
+        snap_to_boundaries: In character mode, end chunks at sentence /
+                   paragraph boundaries (see chunk_spans)
+    Returns: Generator of chunk dictionaries (LazyChunk: in character mode 'text'
+             is only sliced when read), with 'start' / 'end' character offsets
+             into the document content (the page for PDF pages)
+    """
+    if overlap >= chunk_size:
+        raise ValueError("overlap must be smaller than chunk_size")
+
+    unit = "tokens" if tokenizer is not None else "characters"
     print("\n" + "=" * 25)
     print("STEP 2: Chunking Documents")
     print("=" * 25)
-    print(f"Chunk size: {chunk_size} characters")
-    print(f"Overlap: {overlap} characters")
+    print(f"Chunk size: {chunk_size} {unit}")
+    print(f"Overlap: {overlap} {unit}")
 
-    all_chunks = []
+    total_chunks = 0
+    doc_idx = -1
+    current_source = None
+    chunk_idx = 0
 
-    for doc_idx, doc in enumerate(documents):
-        #chunk the document
-        chunks = chunk_text(doc['content'], chunk_size,overlap)
+    # Without a tokenizer there is nothing to batch, keep one document at a time
+    batches = _iter_batches(documents, batch_size if tokenizer is not None else 1)
 
-        #Add metadata to each chunk
+    for batch in batches:
+        batch_chunks = _chunk_batch(batch, chunk_size, overlap, tokenizer, snap_to_boundaries)
+        for doc, chunks in zip(batch, batch_chunks):
+            # Pages of the same file keep the same doc_id and continue its chunk numbering
+            if doc['source'] != current_source:
+                doc_idx += 1
+                current_source = doc['source']
+                chunk_idx = 0
 
-        for chunk_idx, chunk in enumerate(chunks):
-           all_chunks.append({
-                'text': chunk,
-                'source': doc['source'],
-                'doc_id': doc_idx,
-                'chunk_id': chunk_idx,
-                'chunk_length': len(chunk)
-            })
-           
-        print(f"Document {doc_idx + 1}: {doc['source']}")
-        print(f"  - Created {len(chunks)} chunks")
+            #Add metadata to each chunk
 
-    print(f"\nTotal chunks created: {len(all_chunks)}")
+            for chunk in chunks:
+                chunk_with_metadata = LazyChunk(doc['content'])
+                if 'text' in chunk:
+                    chunk_with_metadata['text'] = chunk['text']
+                chunk_with_metadata.update({
+                    'source': doc['source'],
+                    'doc_id': doc_idx,
+                    'chunk_id': chunk_idx,
+                    'chunk_length': len(chunk['text']) if 'text' in chunk else chunk['end'] - chunk['start']
+                })
+                if 'page' in doc:
+                    chunk_with_metadata['page'] = doc['page']
+                if 'start' in chunk:
+                    chunk_with_metadata['start'] = chunk['start']
+                    chunk_with_metadata['end'] = chunk['end']
+                if 'row_start' in chunk:
+                    chunk_with_metadata['row_start'] = chunk['row_start']
+                    chunk_with_metadata['row_end'] = chunk['row_end']
+                if 'row_piece' in chunk:
+                    chunk_with_metadata['row_piece'] = chunk['row_piece']
 
-    return all_chunks
-    
\ No newline at end of file
+                chunk_idx += 1
+                yield chunk_with_metadata
+
+            total_chunks += len(chunks)
+            page_info = f" (page {doc['page']})" if 'page' in doc else ""
+            if 'row_start' in doc:
+                page_info = f" (rows {doc['row_start']}-{doc['row_end']})"
+            print(f"Document {doc_idx + 1}: {doc['source']}{page_info}")
+            print(f"  - Created {len(chunks)} chunks")
+
+    print(f"\nTotal chunks created: {total_chunks}")
+
+
+def chunk_documents(documents, chunk_size=500, overlap=50, tokenizer=None, snap_to_boundaries=True):
+    return list(iter_chunk_documents(documents, chunk_size, overlap, tokenizer,
+                                     snap_to_boundaries=snap_to_boundaries))
+
+def make_chunk_id(chunk):
+    """
+    Deterministic id of a chunk: its source, position and a hash of its text.
+    The same chunk always gets the same id, so re-ingesting a file can skip
+    the chunks that are already stored, and files never overwrite each other.
+    """
+    position = []
+    if 'page' in chunk:
+        position.append(f"p{chunk['page']}")
+    if 'start' in chunk:
+        position.append(f"c{chunk['start']}-{chunk['end']}")
+    elif 'row_start' in chunk:
+        position.append(f"r{chunk['row_start']}-{chunk['row_end']}")
+        # Pieces of one split row share the row range
+        if 'row_piece' in chunk:
+            position.append(f"s{chunk['row_piece']}")
+    else:
+        position.append(f"n{chunk['chunk_id']}")
+
+    content_hash = hashlib.sha256(chunk['text'].encode("utf-8")).hexdigest()[:16]
+    return f"{chunk['source']}#{'.'.join(position)}#{content_hash}"
+
+def make_chunk_metadata(chunk):
+    """Metadata stored with a chunk: its source, numbering and position in the source."""
+    metadata = {
+        'source': chunk['source'],
+        'doc_id': chunk['doc_id'],
+        'chunk_id': chunk['chunk_id']
+    }
+    if 'page' in chunk:
+        metadata['page'] = chunk['page']
+    if 'start' in chunk:
+        metadata['start'] = chunk['start']
+        metadata['end'] = chunk['end']
+    if 'row_start' in chunk:
+        metadata['row_start'] = chunk['row_start']
+        metadata['row_end'] = chunk['row_end']
+    if 'row_piece' in chunk:
+        metadata['row_piece'] = chunk['row_piece']
+    return metadata
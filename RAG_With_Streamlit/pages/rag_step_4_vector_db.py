@@ -1,9 +1,31 @@
 #pip install chromadb
+import os
+import queue
+import threading
+import time
 import chromadb
+from pages.rag_ivf_store import IvfCollection
+from pages.rag_numpy_store import NumpyCollection
 
 _vector_db_client = None
 _my_db_collection = None
 
+# HNSW settings of the named index profiles, set when a collection is created.
+# All use the cosine space, the stored vectors are L2-normalized.
+# M: links per node, construction_ef / search_ef: candidates kept while building / searching
+INDEX_PROFILES = {
+    "low-latency": {"hnsw:space": "cosine", "hnsw:M": 12, "hnsw:construction_ef": 100, "hnsw:search_ef": 32},
+    "balanced": {"hnsw:space": "cosine", "hnsw:M": 16, "hnsw:construction_ef": 200, "hnsw:search_ef": 64},
+    "high-recall": {"hnsw:space": "cosine", "hnsw:M": 32, "hnsw:construction_ef": 400, "hnsw:search_ef": 200}
+}
+DEFAULT_INDEX_PROFILE = "balanced"
+
+def get_index_metadata(profile=DEFAULT_INDEX_PROFILE):
+    """Collection metadata for an index profile (the profile name is recorded with it)."""
+    if profile not in INDEX_PROFILES:
+        raise ValueError(f"Unknown index profile '{profile}', use one of {list(INDEX_PROFILES)}")
+    return {"index_profile": profile, **INDEX_PROFILES[profile]}
+
 def get_vector_db_client(persist_directory = "./chroma_persist"):
     global _vector_db_client
 
@@ -12,17 +34,177 @@ def get_vector_db_client(persist_directory = "./chroma_persist"):
 
     return _vector_db_client
 
-def get_db_collection(my_db_collection_name = "my_demo_rag_collection"):
+def get_db_collection(my_db_collection_name = "my_demo_rag_collection", backend=None, profile=None):
+    """
+    Return the collection the RAG steps read and write.
+    backend: "chroma" (default), "numpy" (in-process exact search on a memory-mapped
+             matrix, see rag_numpy_store) or "ivf" (disk-resident partitioned index for
+             corpora larger than RAM, see rag_ivf_store), by default read from the VECTOR_STORE env variable
+    profile: Index profile used when the collection is created (see INDEX_PROFILES),
+             by default read from the INDEX_PROFILE env variable
+    """
     global _my_db_collection
     
-    if _my_db_collection is None:
+    backend = backend or os.getenv("VECTOR_STORE", "chroma")
+    profile = profile or os.getenv("INDEX_PROFILE", DEFAULT_INDEX_PROFILE)
+    index_metadata = get_index_metadata(profile)
+    if _my_db_collection is None and backend == "numpy":
+        # Exact search has no index, only the distance space applies
+        _my_db_collection = NumpyCollection(my_db_collection_name, space=index_metadata["hnsw:space"])
+    elif _my_db_collection is None and backend == "ivf":
+        _my_db_collection = IvfCollection(my_db_collection_name, space=index_metadata["hnsw:space"])
+    elif _my_db_collection is None:
         client = get_vector_db_client()
         existing_collections = [c.name for c in client.list_collections()]
 
         # Check if it exists
         if my_db_collection_name in existing_collections:
             _my_db_collection = client.get_collection(name=my_db_collection_name)
+            # The space and HNSW settings are fixed when a collection is created
+            current_profile = (_my_db_collection.metadata or {}).get("index_profile")
+            if current_profile != profile:
+                print(f"Collection '{my_db_collection_name}' was created with index profile "
+                      f"'{current_profile or 'chroma default (l2)'}', delete it to use '{profile}'")
         else:
-            _my_db_collection = client.create_collection(name=my_db_collection_name)
+            _my_db_collection = client.create_collection(name=my_db_collection_name, metadata=index_metadata)
 
     return _my_db_collection
+
+def get_store_directory(collection):
+    """
+    Folder of the store holding a collection's vectors. The files that describe
+    those vectors (ingest manifest, compression) are kept there, so switching
+    VECTOR_STORE never reads the state of another backend's vectors.
+    """
+    if isinstance(collection, (NumpyCollection, IvfCollection)):
+        return collection.directory
+    return "./chroma_persist"
+
+def get_max_upsert_batch_size(collection, default=5000):
+    # Largest number of rows the store accepts in one upsert (for Chroma it depends on the sqlite build)
+    if isinstance(collection, (NumpyCollection, IvfCollection)):
+        return collection.max_batch_size
+    client = get_vector_db_client()
+    if hasattr(client, "get_max_batch_size"):
+        return client.get_max_batch_size()
+    return getattr(client, "max_batch_size", default)
+
+def find_existing_ids(collection, ids, batch_size=None):
+    """Return the set of ids that are already in the collection (checked in bulk, without loading vectors)."""
+    batch_size = batch_size or get_max_upsert_batch_size(collection)
+    existing = set()
+    for start in range(0, len(ids), batch_size):
+        existing.update(collection.get(ids=ids[start:start + batch_size], include=[])["ids"])
+    return existing
+
+def delete_stale_chunks(collection, sources, keep_ids):
+    """
+    Delete the chunks of the given sources whose id is not in keep_ids
+    (the chunks of an older version of the file). Returns the ids deleted.
+    """
+    if not sources:
+        return []
+    stored_ids = collection.get(where={"source": {"$in": list(sources)}}, include=[])["ids"]
+    stale_ids = [chunk_id for chunk_id in stored_ids if chunk_id not in keep_ids]
+
+    batch_size = get_max_upsert_batch_size(collection)
+    for start in range(0, len(stale_ids), batch_size):
+        collection.delete(ids=stale_ids[start:start + batch_size])
+    return stale_ids
+
+def _upsert_with_retry(collection, batch, max_retries, retry_delay):
+    # Returns True when the batch was written, retrying only this batch on errors
+    for attempt in range(max_retries + 1):
+        try:
+            collection.upsert(**batch)
+            return True
+        except Exception as e:
+            if attempt == max_retries:
+                print(f"  - Upsert of {len(batch['ids'])} rows failed after {max_retries + 1} attempts: {e}")
+                return False
+            print(f"  - Upsert failed ({e}), retrying in {retry_delay * 2 ** attempt:.1f}s")
+            time.sleep(retry_delay * 2 ** attempt)
+
+def bulk_upsert(collection, ids, documents, metadatas, embed_fn, batch_size=1000, queue_size=2,
+                max_retries=3, retry_delay=1.0):
+    """
+    Embed and upsert the rows given as lists ids, documents, metadatas
+    (same arguments and result as bulk_upsert_batches).
+    """
+    rows = [{"ids": ids, "documents": documents, "metadatas": metadatas}]
+    return bulk_upsert_batches(collection, rows, embed_fn, batch_size, queue_size, max_retries, retry_delay)
+
+def bulk_upsert_batches(collection, row_batches, embed_fn, batch_size=1000, queue_size=2,
+                        max_retries=3, retry_delay=1.0):
+    """
+    Embed and upsert rows in batches, writing one batch while the next one is embedded.
+    The rows arrive as an iterable of batches, which can be a generator that reads
+    them while earlier ones are written; they are cut again to batch_size.
+    A bounded queue sits between the two stages (embedding in this thread,
+    upserting in a writer thread), so at most queue_size embedded batches
+    wait in memory. Batches are never larger than Chroma's max batch size.
+    A failed upsert is retried (with exponential backoff) for that batch only.
+    Args:
+        collection: ChromaDB collection
+        row_batches: Iterable of dictionaries with the lists "ids", "documents" and "metadatas"
+        embed_fn: Function turning a list of texts into a matrix of vectors
+        batch_size: Rows per batch
+        queue_size: Embedded batches allowed to wait for the writer
+        max_retries: Retries per failed batch
+    Returns: Dictionary with the upserted row count, the ids and sources of failed batches
+             and rows/s per stage
+    """
+    batch_size = max(1, min(batch_size, get_max_upsert_batch_size(collection)))
+    batches = queue.Queue(maxsize=queue_size)
+    stats = {"upserted": 0, "failed_ids": [], "failed_sources": set(), "embed_seconds": 0.0, "upsert_seconds": 0.0}
+
+    def writer():
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            start_time = time.perf_counter()
+            if _upsert_with_retry(collection, batch, max_retries, retry_delay):
+                stats["upserted"] += len(batch["ids"])
+            else:
+                stats["failed_ids"].extend(batch["ids"])
+                stats["failed_sources"].update(metadata["source"] for metadata in batch["metadatas"]
+                                               if metadata and "source" in metadata)
+            stats["upsert_seconds"] += time.perf_counter() - start_time
+
+    writer_thread = threading.Thread(target=writer, name="chroma-writer", daemon=True)
+    start_time = time.perf_counter()
+    writer_thread.start()
+    rows = 0
+    try:
+        for row_batch in row_batches:
+            ids, documents, metadatas = row_batch["ids"], row_batch["documents"], row_batch["metadatas"]
+            for start in range(0, len(ids), batch_size):
+                end = start + batch_size
+                embed_start = time.perf_counter()
+                embeddings = embed_fn(documents[start:end])
+                stats["embed_seconds"] += time.perf_counter() - embed_start
+                rows += len(ids[start:end])
+                # Blocks while the writer is queue_size batches behind
+                batches.put({
+                    "ids": ids[start:end],
+                    "embeddings": embeddings,
+                    "documents": documents[start:end],
+                    "metadatas": metadatas[start:end]
+                })
+    finally:
+        batches.put(None)
+        writer_thread.join()
+    stats["total_seconds"] = time.perf_counter() - start_time
+
+    stats["embed_rows_per_sec"] = rows / max(stats["embed_seconds"], 1e-9)
+    stats["upsert_rows_per_sec"] = stats["upserted"] / max(stats["upsert_seconds"], 1e-9)
+    stats["rows_per_sec"] = stats["upserted"] / max(stats["total_seconds"], 1e-9)
+
+    print(f"\n✓ Bulk upsert: {stats['upserted']}/{rows} rows in batches of {batch_size}")
+    print(f"  - Embedding: {stats['embed_rows_per_sec']:.1f} rows/s")
+    print(f"  - Upsert: {stats['upsert_rows_per_sec']:.1f} rows/s")
+    print(f"  - Overall: {stats['rows_per_sec']:.1f} rows/s ({stats['total_seconds']:.1f}s)")
+    if stats["failed_ids"]:
+        print(f"  - Failed: {len(stats['failed_ids'])} rows")
+    return stats
@@ -0,0 +1,185 @@
+import os
+import numpy as np
+
+# "pca" fits a projection on the vectors, "truncate" keeps the first dimensions
+# (only for Matryoshka-trained models, all-MiniLM-L6-v2 is not one)
+COMPRESSION_METHODS = ("pca", "truncate")
+# Only the NumPy store keeps float16 vectors (half the bytes). Chroma's HNSW index and
+# the IVF store convert them to float32, so there float16 only rounds the values and
+# the dimension reduction is what makes the collection smaller
+VECTOR_DTYPES = ("float32", "float16")
+# Bytes per stored value of every vector store for each dtype
+_STORED_ITEMSIZE = {"numpy": {"float32": 4, "float16": 2}, "chroma / ivf": {"float32": 4, "float16": 4}}
+
+def get_compression_path(collection_name, persist_directory="./chroma_persist"):
+    # Stored next to the collection (in its backend's folder, see get_store_directory),
+    # so it moves / gets deleted together with it
+    return os.path.join(persist_directory, f"{collection_name}_compression.npz")
+
+def fit_compression(embeddings, dim=None, dtype="float32", method="pca"):
+    """
+    Fit the compression for a collection.
+    Args:
+        embeddings: (n, d) float32 matrix of uncompressed vectors
+        dim: Target dimension (None = keep all d dimensions)
+        dtype: "float32" or "float16" (half the bytes per value)
+        method: "pca" or "truncate" (PCA on fewer vectors than dim falls back to truncation)
+    Returns: Dictionary with method, dim, dtype and components (None = no projection)
+    """
+    if dtype not in VECTOR_DTYPES:
+        raise ValueError(f"Unknown vector dtype '{dtype}', use one of {VECTOR_DTYPES}")
+    if method not in COMPRESSION_METHODS:
+        raise ValueError(f"Unknown compression method '{method}', use one of {COMPRESSION_METHODS}")
+
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    full_dim = embeddings.shape[1]
+    compression = {"method": method, "dim": full_dim, "dtype": dtype, "components": None}
+    if dim is None or dim >= full_dim:
+        return compression
+
+    if method == "pca" and len(embeddings) < dim:
+        # Fewer vectors than dimensions do not determine a dim-dimensional projection
+        print(f"  - PCA to {dim} dimensions needs at least {dim} vectors, got {len(embeddings)}: "
+              f"keeping the first {dim} dimensions instead")
+        method = compression["method"] = "truncate"
+
+    if method == "truncate":
+        compression["components"] = np.eye(full_dim, dtype=np.float32)[:dim]
+    else:
+        # Eigenvectors of the d x d second-moment matrix, largest first. Not mean-centered:
+        # the search compares dot products, and those are kept best by the uncentered projection
+        eigenvalues, eigenvectors = np.linalg.eigh(embeddings.T @ embeddings)
+        order = np.argsort(eigenvalues)[::-1][:dim]
+        compression["components"] = np.ascontiguousarray(eigenvectors[:, order].T, dtype=np.float32)
+        explained = eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12)
+        print(f"  - PCA {full_dim} -> {dim} dimensions keeps {100 * explained:.1f}% of the energy")
+
+    compression["dim"] = dim
+    return compression
+
+def compress_vectors(embeddings, compression=None):
+    """
+    Apply a compression to document or query vectors (the same way for both).
+    Projected vectors are L2-normalized again. Without compression the vectors are returned as they are.
+    """
+    if compression is None:
+        return embeddings
+
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if compression["components"] is not None:
+        embeddings = embeddings @ compression["components"].T
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        np.divide(embeddings, norms, out=embeddings, where=norms > 0)
+
+    return np.ascontiguousarray(embeddings, dtype=compression["dtype"])
+
+def save_compression(compression, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    arrays = {"method": compression["method"], "dim": compression["dim"], "dtype": compression["dtype"]}
+    if compression["components"] is not None:
+        arrays["components"] = compression["components"]
+    # Write to a temporary file first, so a crash never leaves a half written projection
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+def load_compression(collection_name, persist_directory="./chroma_persist"):
+    """Return the compression stored for a collection, or None if its vectors are uncompressed."""
+    path = get_compression_path(collection_name, persist_directory)
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as data:
+        return {
+            "method": str(data["method"]),
+            "dim": int(data["dim"]),
+            "dtype": str(data["dtype"]),
+            "components": data["components"] if "components" in data else None
+        }
+
+def load_or_fit_compression(collection_name, embeddings, dim=None, dtype="float32", method="pca",
+                            refit=False, persist_directory="./chroma_persist"):
+    """
+    Return the compression of a collection, fitting and saving it on the first ingest.
+    A stored compression is kept, because the vectors already in the collection
+    were compressed with it; pass refit=True when the collection is empty.
+    Without refit, a collection with no stored compression holds uncompressed
+    vectors, so asking for a compression raises (delete the collection to compress it).
+    Returns None when nothing is compressed (dim None and float32).
+    """
+    compression = None if refit else load_compression(collection_name, persist_directory)
+    if compression is not None:
+        # A PCA fitted on too few vectors was stored as a truncation (see fit_compression)
+        fallback = (compression["method"], method) == ("truncate", "pca")
+        if (compression["method"] != method and not fallback) or compression["dtype"] != dtype or \
+                (dim is not None and compression["dim"] != dim):
+            raise ValueError(
+                f"Collection '{collection_name}' was stored with {compression['method']} "
+                f"{compression['dim']} dims {compression['dtype']}; delete it to change the compression"
+            )
+        if fallback:
+            print(f"Collection '{collection_name}' keeps the first {compression['dim']} dimensions "
+                  f"(too few vectors for PCA when it was created); delete it to fit PCA")
+        return compression
+
+    path = get_compression_path(collection_name, persist_directory)
+    if not refit and (dim is not None or dtype != "float32"):
+        raise ValueError(
+            f"Collection '{collection_name}' holds uncompressed vectors; "
+            f"delete it to store them with {method} {dim or 'all'} dims {dtype}"
+        )
+    if dim is None and dtype == "float32":
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+
+    compression = fit_compression(embeddings, dim, dtype, method)
+    save_compression(compression, path)
+    return compression
+
+def _top_k(queries, corpus, k, query_indexes):
+    scores = queries.astype(np.float32) @ corpus.astype(np.float32).T
+    # A query vector taken from the corpus must not find itself
+    scores[np.arange(len(queries)), query_indexes] = -np.inf
+    return np.argpartition(-scores, k, axis=1)[:, :k]
+
+def recall_at_k_report(embeddings, settings, k=10, num_queries=200, seed=0):
+    """
+    Compare compressed with uncompressed exact search.
+    Args:
+        embeddings: (n, d) matrix of normalized, uncompressed vectors
+        settings: List of (dim, dtype, method) tuples to try (dim None = full)
+        k: Number of neighbours compared
+        num_queries: Vectors of the corpus used as queries
+    Returns: List of dictionaries with the settings, the stored bytes_per_vector of
+             every vector store (float16 stays float16 only in the NumPy store) and recall
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    k = min(k, len(embeddings) - 2)
+    rng = np.random.default_rng(seed)
+    query_indexes = rng.choice(len(embeddings), size=min(num_queries, len(embeddings)), replace=False)
+    baseline = _top_k(embeddings[query_indexes], embeddings, k, query_indexes)
+    baseline_bytes = embeddings.shape[1] * 4
+
+    print(f"\nRecall@{k} on {len(query_indexes)} queries against float32 {embeddings.shape[1]} dims:")
+    report = []
+    for dim, dtype, method in settings:
+        compression = fit_compression(embeddings, dim, dtype, method)
+        corpus = compress_vectors(embeddings, compression)
+        found = _top_k(corpus[query_indexes], corpus, k, query_indexes)
+        recall = np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(baseline, found)])
+        bytes_per_vector = {store: compression["dim"] * itemsize[dtype]
+                            for store, itemsize in _STORED_ITEMSIZE.items()}
+        stored = ", ".join(f"{store} {size} bytes/vector ({size / baseline_bytes:.0%})"
+                           for store, size in bytes_per_vector.items())
+
+        print(f"  - {compression['method']:8s} {compression['dim']:4d} dims {dtype:7s}: "
+              f"recall {recall:.3f}, {stored}")
+        report.append({
+            "dim": compression["dim"],
+            "dtype": dtype,
+            "method": compression["method"],
+            "bytes_per_vector": bytes_per_vector,
+            "recall": float(recall)
+        })
+    return report
@@ -1,10 +1,13 @@
 # modified_document_loader.py
 import os
+import io
 import json
 import csv
 from docx import Document
 from PyPDF2 import PdfReader
 import pandas as pd
+from pages.rag_extraction_cache import CACHED_EXTS, cached_extract, hash_bytes, iter_cached_extract
+from pages.rag_json_stream import iter_json_record_groups
 
 def load_documents_from_folder(folder_path):
     """
@@ -110,7 +113,108 @@ def load_documents_from_folder(folder_path):
 
 
 
-def load_documents_from_streamlit_files(uploaded_files):
+def _extract_streamlit_segments(uploaded_file, ext):
+    # The slow parsers: one text segment per PDF page, one for DOCX and XLSX
+    # Reset file pointer to beginning
+    uploaded_file.seek(0)
+    if ext == ".pdf":
+        reader = PdfReader(uploaded_file)
+        return [page.extract_text() or "" for page in reader.pages]
+    if ext == ".docx":
+        doc = Document(uploaded_file)
+        return ["\n".join([para.text for para in doc.paragraphs])]
+    if ext == ".xlsx":
+        df = pd.read_excel(uploaded_file)
+        return [df.to_json(orient="records", indent=2, force_ascii=False)]
+    raise ValueError(f"No extractor for {ext} files")
+
+
+def _iter_streamlit_pdf_pages(uploaded_file):
+    uploaded_file.seek(0)
+    for page in PdfReader(uploaded_file).pages:
+        yield page.extract_text() or ""
+
+
+def extract_streamlit_segments(uploaded_file, ext, use_cache=True):
+    """
+    Extract the text of an uploaded PDF, DOCX or XLSX file, using the on-disk
+    extraction cache so the same file content is only parsed once.
+    Returns: list of text segments (one per page for PDFs)
+    """
+    if not use_cache or ext not in CACHED_EXTS:
+        return _extract_streamlit_segments(uploaded_file, ext)
+    content_hash = hash_bytes(uploaded_file.getvalue())
+    return cached_extract(content_hash, ext, lambda: _extract_streamlit_segments(uploaded_file, ext))
+
+
+def load_single_streamlit_file(uploaded_file, use_cache=True):
+    """
+    Load one Streamlit uploaded file.
+    Args: uploaded_file: Streamlit UploadedFile
+          use_cache (bool): Reuse text extracted earlier from the same
+              PDF/DOCX/XLSX content (see rag_extraction_cache).
+    Returns: dict: Dictionary with keys 'content', 'source', 'length'
+              and 'file_type', or None if the file type is not supported.
+    """
+    file_name = uploaded_file.name
+    ext = os.path.splitext(file_name)[1].lower()
+    content = ""
+
+    # ----- TXT -----
+    if ext == ".txt":
+        content = uploaded_file.getvalue().decode("utf-8")
+
+    # ----- DOCX -----
+    elif ext == ".docx":
+        content = extract_streamlit_segments(uploaded_file, ext, use_cache)[0]
+
+    # ----- PDF -----
+    elif ext == ".pdf":
+        pages = extract_streamlit_segments(uploaded_file, ext, use_cache)
+        content = "\n".join(pages)
+
+    # ----- CSV -----
+    elif ext == ".csv":
+        # Reset file pointer to beginning
+        uploaded_file.seek(0)
+        text_content = uploaded_file.getvalue().decode("utf-8")
+        reader = csv.reader(text_content.splitlines())
+        rows = []
+        header = next(reader, None)
+        for row in reader:
+            if header:
+                rows.append(dict(zip(header, row)))
+            else:
+                rows.append(row)
+        content = json.dumps(rows, indent=2, ensure_ascii=False)
+
+    # ----- JSON -----
+    elif ext == ".json":
+        # Reset file pointer to beginning
+        uploaded_file.seek(0)
+        data = json.load(uploaded_file)
+        content = json.dumps(data, indent=2, ensure_ascii=False)
+
+    # ----- XLSX -----
+    elif ext == ".xlsx":
+        content = extract_streamlit_segments(uploaded_file, ext, use_cache)[0]
+
+    # ----- Markdown -----
+    elif ext == ".md":
+        content = uploaded_file.getvalue().decode("utf-8")
+
+    else:
+        return None
+
+    return {
+        "content": content,
+        "source": file_name,
+        "length": len(content),
+        "file_type": ext.replace('.', '')
+    }
+
+
+def load_documents_from_streamlit_files(uploaded_files, use_cache=True):
     """
     Modified version of the above function that works directly with Streamlit uploaded files without needing to pass the path of folder
     Load all supported documents directly from Streamlit uploaded files
@@ -127,76 +231,20 @@ def load_documents_from_streamlit_files(uploaded_files):
 
     for uploaded_file in uploaded_files:
         file_name = uploaded_file.name
-        ext = os.path.splitext(file_name)[1].lower()
-        content = ""
 
         try:
-            # ----- TXT -----
-            if ext == ".txt":
-                content = uploaded_file.getvalue().decode("utf-8")
-
-            # ----- DOCX -----
-            elif ext == ".docx":
-                # Reset file pointer to beginning
-                uploaded_file.seek(0)
-                doc = Document(uploaded_file)
-                content = "\n".join([para.text for para in doc.paragraphs])
+            document = load_single_streamlit_file(uploaded_file, use_cache)
 
-            # ----- PDF -----
-            elif ext == ".pdf":
-                # Reset file pointer to beginning
-                uploaded_file.seek(0)
-                reader = PdfReader(uploaded_file)
-                pages = [page.extract_text() or "" for page in reader.pages]
-                content = "\n".join(pages)
-
-            # ----- CSV -----
-            elif ext == ".csv":
-                # Reset file pointer to beginning
-                uploaded_file.seek(0)
-                text_content = uploaded_file.getvalue().decode("utf-8")
-                reader = csv.reader(text_content.splitlines())
-                rows = []
-                header = next(reader, None)
-                for row in reader:
-                    if header:
-                        rows.append(dict(zip(header, row)))
-                    else:
-                        rows.append(row)
-                content = json.dumps(rows, indent=2, ensure_ascii=False)
-
-            # ----- JSON -----
-            elif ext == ".json":
-                # Reset file pointer to beginning
-                uploaded_file.seek(0)
-                data = json.load(uploaded_file)
-                content = json.dumps(data, indent=2, ensure_ascii=False)
-
-            # ----- XLSX -----
-            elif ext == ".xlsx":
-                # Reset file pointer to beginning
-                uploaded_file.seek(0)
-                df = pd.read_excel(uploaded_file)
-                content = df.to_json(orient="records", indent=2, force_ascii=False)
-
-            # ----- Markdown -----
-            elif ext == ".md":
-                content = uploaded_file.getvalue().decode("utf-8")
-
-            else:
+            if document is None:
                 print(f"Skipping unsupported file type: {file_name}")
                 continue
 
             # Append document info
-            documents.append({
-                "content": content,
-                "source": file_name,
-                "length": len(content),
-                "file_type": ext.replace('.', '')
-            })
+            documents.append(document)
 
+            content = document["content"]
             print(f"Loaded: {file_name}")
-            print(f"  - Type: {ext}")
+            print(f"  - Type: .{document['file_type']}")
             print(f"  - Characters: {len(content)}")
             print(f"  - Words: {len(content.split())}")
 
@@ -207,5 +255,91 @@ def load_documents_from_streamlit_files(uploaded_files):
     return documents
 
 
+def iter_streamlit_json_groups(uploaded_file, records_per_group=50):
+    """
+    Stream an uploaded JSON file as groups of compact one-line records
+    (see rag_json_stream) instead of parsing and re-serializing it at once.
+    Returns: generator: Document dictionaries with 'row_start' / 'row_end'
+              (1-based record numbers)
+    """
+    uploaded_file.seek(0)
+    text_file = io.TextIOWrapper(uploaded_file, encoding="utf-8")
+    try:
+        for content, record_start, record_end in iter_json_record_groups(text_file, records_per_group):
+            yield {
+                "content": content,
+                "source": uploaded_file.name,
+                "length": len(content),
+                "file_type": "json",
+                "row_start": record_start,
+                "row_end": record_end
+            }
+    finally:
+        # Do not let the wrapper close the uploaded file
+        text_file.detach()
+
+
+def iter_documents_from_streamlit_files(uploaded_files, split_pdf_pages=True, use_cache=True,
+                                        json_records_per_group=None, failed_sources=None):
+    """
+    Streaming version of load_documents_from_streamlit_files: yields documents
+    (or single PDF pages with a 'page' key) one at a time instead of building
+    a list, so only one document's text is kept in memory at once.
+    With json_records_per_group set, JSON files are streamed in groups of
+    top-level records (with 'row_start' / 'row_end').
+    With failed_sources (a set), the names of the files that failed to load
+    (also partway, after some of their documents were yielded) are added to it.
+    """
+    print("=" * 60)
+    print("STEP 1: Streaming documents from Streamlit uploaded files")
+    print("=" * 60)
+
+    if not uploaded_files:
+        print("No files provided.")
+        return
 
+    loaded_files = 0
+    for uploaded_file in uploaded_files:
+        file_name = uploaded_file.name
+        ext = os.path.splitext(file_name)[1].lower()
+
+        try:
+            segments = 0
+            if ext == ".pdf" and split_pdf_pages:
+                # Extract one page at a time (with the cache: read from it, or written to it page by page)
+                pages = _iter_streamlit_pdf_pages(uploaded_file)
+                if use_cache:
+                    pages = iter_cached_extract(hash_bytes(uploaded_file.getvalue()), ext,
+                                                lambda: _iter_streamlit_pdf_pages(uploaded_file))
+
+                for page_number, content in enumerate(pages, start=1):
+                    segments += 1
+                    yield {
+                        "content": content,
+                        "source": file_name,
+                        "length": len(content),
+                        "file_type": "pdf",
+                        "page": page_number
+                    }
+            elif ext == ".json" and json_records_per_group:
+                for document in iter_streamlit_json_groups(uploaded_file, json_records_per_group):
+                    segments += 1
+                    yield document
+            else:
+                document = load_single_streamlit_file(uploaded_file, use_cache)
+                if document is None:
+                    print(f"Skipping unsupported file type: {file_name}")
+                    continue
+                segments += 1
+                yield document
+
+            loaded_files += 1
+            print(f"Loaded: {file_name} ({segments} segment(s))")
+
+        except Exception as e:
+            print(f"Error loading {file_name}: {e}")
+            # Recorded before any document of the next file is yielded
+            if failed_sources is not None:
+                failed_sources.add(file_name)
 
+    print(f"\nTotal documents loaded: {loaded_files}")